@@ -1,26 +1,619 @@
-from fastapi import FastAPI, APIRouter, Query, HTTPException
+from fastapi import FastAPI, APIRouter, Query, Header, HTTPException, BackgroundTasks
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from pymongo import ReadPreference, ReturnDocument, InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
 import os
+import sys
 import logging
+import logging.handlers
+import queue
+import contextvars
+import atexit
+import contextlib
+import functools
+import random
+import threading
+import traceback
+import mmap
+import struct
+import fcntl
+import tempfile
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime
+import asyncio
+import hashlib
+import ipaddress
+import json
+import math
+import time
+import re
+import numpy as np
+import pandas as pd
+import heapq
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
 from enum import Enum
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Logging
+# Records are put on a bounded queue by the calling thread and formatted as JSON lines and written
+# by a background listener thread, so a slow stderr never stalls the event loop.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# "logger=rate,..." share of INFO and lower records kept for high-volume loggers
+LOG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, rate in (entry.split("=") for entry in os.environ.get("LOG_SAMPLE_RATES", "uvicorn.access=1.0").split(",") if entry)
+}
+
+correlation_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("correlation_id", default=None)
+log_stats: Counter = Counter()
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "correlationId", None):
+            entry["correlationId"] = record.correlationId
+        if getattr(record, "traceId", None):
+            entry["traceId"] = record.traceId
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread; drops and counts them when the queue is full"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Capture what depends on the calling context now; leave the JSON encoding to the listener
+        record.correlationId = correlation_id.get()
+        span = current_span.get()
+        record.traceId = span.traceId if span else None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats["dropped"] += 1
+
+class LogSampler(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = LOG_SAMPLE_RATES.get(record.name)
+        if rate is None or record.levelno > logging.INFO or random.random() < rate:
+            return True
+        log_stats["sampled"] += 1
+        return False
+
+def configure_logging() -> logging.handlers.QueueListener:
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonLogFormatter())
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(records)
+    handler.addFilter(LogSampler())
+    listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    # uvicorn installs its own synchronous handlers before loading the app
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    return listener
+
+def log_metrics() -> str:
+    return "\n".join([
+        "# HELP hospot_log_records_dropped_total Log records dropped because the log queue was full",
+        "# TYPE hospot_log_records_dropped_total counter",
+        f"hospot_log_records_dropped_total {log_stats['dropped']}",
+        "# HELP hospot_log_records_sampled_total Log records skipped by sampling",
+        "# TYPE hospot_log_records_sampled_total counter",
+        f"hospot_log_records_sampled_total {log_stats['sampled']}",
+    ]) + "\n"
+
+log_listener = configure_logging()
+logger = logging.getLogger(__name__)
+
+class CorrelationIdMiddleware:
+    """Tags everything logged while handling a request with its X-Request-ID, generating one if absent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex
+        token = correlation_id.set(request_id)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            correlation_id.reset(token)
+
+# Tracing
+# Sampled requests get a server span, and every StorageCollection call or cursor iteration made while
+# handling them a child span. Finished spans go through a bounded queue to an exporter on a background
+# thread.
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.1))
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "memory")  # memory, file:<path> or none
+TRACE_QUEUE_SIZE = 10000
+TRACE_BATCH_SIZE = 512
+TRACE_MEMORY_LIMIT = 5000  # spans kept by the in-memory exporter
+_TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+class Span:
+    __slots__ = ("traceId", "spanId", "parentId", "name", "attributes", "status", "start", "end")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.traceId = trace_id
+        self.spanId = os.urandom(8).hex()
+        self.parentId = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.status = "ok"
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+
+    def finish(self):
+        self.end = time.time_ns()
+        span_processor.submit(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.traceId,
+            "spanId": self.spanId,
+            "parentId": self.parentId,
+            "name": self.name,
+            "attributes": self.attributes,
+            "status": self.status,
+            "startTime": self.start,
+            "durationMs": (self.end - self.start) / 1e6 if self.end else None,
+        }
+
+class SpanExporter:
+    """Receives batches of finished spans on the processor thread"""
+
+    def export(self, spans: List[Span]):
+        raise NotImplementedError
+
+class InMemorySpanExporter(SpanExporter):
+    def __init__(self, limit: int = TRACE_MEMORY_LIMIT):
+        self.spans = deque(maxlen=limit)
+
+    def export(self, spans: List[Span]):
+        self.spans.extend(spans)
+
+    def trace(self, trace_id: str) -> List[Span]:
+        return sorted((span for span in list(self.spans) if span.traceId == trace_id), key=lambda span: span.start)
+
+class JsonFileSpanExporter(SpanExporter):
+    """Appends one JSON span per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: List[Span]):
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+
+class BatchSpanProcessor:
+    def __init__(self, exporter: Optional[SpanExporter]):
+        self.exporter = exporter
+        self.queue = queue.Queue(TRACE_QUEUE_SIZE)
+        self.dropped = 0
+        if exporter is not None:
+            threading.Thread(target=self._run, name="span-exporter", daemon=True).start()
+
+    def submit(self, span: Span):
+        if self.exporter is None:
+            return
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export(batch)
+            except Exception:
+                logging.getLogger(__name__).exception("Span export failed")
+
+def make_span_exporter(setting: str) -> Optional[SpanExporter]:
+    if setting == "memory":
+        return InMemorySpanExporter()
+    if setting.startswith("file:"):
+        return JsonFileSpanExporter(setting[len("file:"):])
+    return None
+
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+span_processor = BatchSpanProcessor(make_span_exporter(TRACE_EXPORTER))
+
+@contextlib.contextmanager
+def child_span(name: str, **attributes):
+    """Span under the current one; a no-op outside a sampled trace"""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = Span(name, parent.traceId, parent.spanId, attributes)
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "error"
+        span.attributes["error"] = repr(e)
+        raise
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+def result_attributes(result) -> Dict[str, Any]:
+    """Document counts from a Motor call's return value"""
+    if isinstance(result, list):
+        return {"db.documents_returned": len(result)}
+    if isinstance(result, dict) or result is None:
+        return {"db.documents_returned": int(result is not None)}
+    if isinstance(result, int):
+        return {"db.count": result}
+    attributes = {}
+    for field in ("inserted_count", "matched_count", "modified_count", "deleted_count", "upserted_count"):
+        value = getattr(result, field, None)
+        if isinstance(value, int):
+            attributes[f"db.{field}"] = value
+    if hasattr(result, "inserted_ids"):
+        attributes["db.inserted_count"] = len(result.inserted_ids)
+    elif hasattr(result, "inserted_id"):
+        attributes["db.inserted_count"] = 1
+    return attributes
+
+def traced_operation(method):
+    """Wrap a StorageCollection/StorageCursor coroutine in a span named after the Mongo operation"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if current_span.get() is None:
+            return await method(self, *args, **kwargs)
+        operation = vars(self).get("operation", method.__name__)  # StorageCollection proxies unknown attributes to Motor
+        with child_span(f"mongo.{operation} {self.collection_name}", **{
+            "db.system": "mongodb", "db.collection": self.collection_name, "db.operation": operation
+        }) as span:
+            result = await method(self, *args, **kwargs)
+            span.attributes.update(result_attributes(result))
+            return result
+    return wrapper
+
+class TracingMiddleware:
+    """Server span per request, continuing the caller's trace from a W3C traceparent header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        match = _TRACEPARENT.fullmatch(dict(scope["headers"]).get(b"traceparent", b"").decode("latin-1").strip())
+        if match:
+            trace_id, parent_id, sampled = match.group(1), match.group(2), int(match.group(3), 16) & 1
+        else:
+            trace_id, parent_id, sampled = os.urandom(16).hex(), None, random.random() < TRACE_SAMPLE_RATE
+        if not sampled:
+            return await self.app(scope, receive, send)
+
+        span = Span(f"{scope['method']} {scope['path']}", trace_id, parent_id, {"http.method": scope["method"], "http.target": scope["path"]})
+        token = current_span.set(span)
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                span.attributes["http.status_code"] = message["status"]
+                if message["status"] >= 500:
+                    span.status = "error"
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except BaseException as e:
+            span.status = "error"
+            span.attributes["error"] = repr(e)
+            raise
+        finally:
+            route = scope.get("route")
+            if route is not None:
+                span.name = f"{scope['method']} {route.path}"
+                span.attributes["http.route"] = route.path
+            current_span.reset(token)
+            span.finish()
+
+# Storage format
+# Ids are stored as BSON binary UUIDs (16 bytes instead of a 36 character string),
+# calendar dates as BSON dates and distances as numbers of km. The API keeps the
+# string forms; StorageDatabase translates in both directions.
+STORAGE_FIELD_KINDS = {
+    "id": "id",
+    "medicineId": "id",
+    "orderId": "id",
+    "prescriptionId": "id",
+    "prescriptionIds": "id",
+    "expiryDate": "date",
+    "distance": "distance",
+}
+
+# Until the background migration has converted every document, id filters also match the old string form
+legacy_storage_formats = True
+
+def storage_id(value):
+    """Stored form of an id; values that aren't UUIDs (e.g. external ids) are kept as they are"""
+    if isinstance(value, str):
+        try:
+            return uuid.UUID(value)
+        except ValueError:
+            return value
+    return value
+
+def _storage_scalar(kind: str, value):
+    if kind == "id":
+        return storage_id(value)
+    if kind == "date" and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    if kind == "distance" and isinstance(value, str):
+        match = re.fullmatch(r"\s*([\d.]+)\s*(km|m)?\s*", value)
+        if match:
+            return float(match.group(1)) / (1000 if match.group(2) == "m" else 1)
+    return value
+
+def _storage_condition(kind: str, value, query: bool, legacy: bool):
+    if isinstance(value, list):
+        return [_storage_condition(kind, item, query, legacy) for item in value]
+    if query and isinstance(value, dict):
+        converted = {}
+        for operator, operand in value.items():
+            if kind == "id" and legacy and operator in ("$eq", "$ne", "$in", "$nin"):
+                operands = operand if isinstance(operand, list) else [operand]
+                variants = [v for item in operands for v in dict.fromkeys([storage_id(item), item])]
+                converted[{"$eq": "$in", "$ne": "$nin"}.get(operator, operator)] = variants
+            elif isinstance(operand, dict):
+                converted[operator] = _storage_condition(kind, operand, query, legacy)  # $not, $elemMatch
+            else:
+                # Ranges and other comparisons only make sense against the canonical form
+                converted[operator] = _storage_condition(kind, operand, False, False)
+        return converted
+    if isinstance(value, dict):
+        return to_storage(value, query, legacy)
+    stored = _storage_scalar(kind, value)
+    if query and kind == "id" and legacy and stored is not value:
+        return {"$in": [stored, value]}
+    return stored
+
+def to_storage(value, query: bool = False, legacy: Optional[bool] = None):
+    """Convert a document, update or (with query=True) filter from API to storage form.
+
+    While legacy formats may remain, id equality in filters also matches the old string form.
+    Pass legacy=False for upsert filters, whose equality fields become the inserted document.
+    """
+    if legacy is None:
+        legacy = legacy_storage_formats
+    if isinstance(value, list):
+        return [to_storage(item, query, legacy) for item in value]
+    if not isinstance(value, dict):
+        return value
+    converted = {}
+    for key, item in value.items():
+        kind = STORAGE_FIELD_KINDS.get(key.rsplit(".", 1)[-1])
+        converted[key] = _storage_condition(kind, item, query, legacy) if kind else to_storage(item, query, legacy)
+    return converted
+
+def from_storage(value, key: Optional[str] = None):
+    """Convert a stored document back to the API's string forms"""
+    if isinstance(value, dict):
+        return {k: from_storage(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [from_storage(item, key) for item in value]
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    kind = STORAGE_FIELD_KINDS.get(key)
+    if kind == "date" and isinstance(value, datetime):
+        return value.date().isoformat()
+    if kind == "distance" and isinstance(value, (int, float)):
+        return f"{value:g} km"
+    return value
+
+class StorageCursor:
+    def __init__(self, cursor, collection_name: str = "", operation: str = "find"):
+        self._cursor = cursor
+        self.collection_name = collection_name
+        self.operation = operation
+        self._iteration_span: Optional[Span] = None
+        self._iteration_started = False
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, *args, **kwargs):
+        self._cursor.skip(*args, **kwargs)
+        return self
+
+    def limit(self, *args, **kwargs):
+        self._cursor.limit(*args, **kwargs)
+        return self
+
+    @traced_operation
+    async def to_list(self, length):
+        return [from_storage(document) for document in await self._cursor.to_list(length)]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._iteration_started:
+            # One span over the whole iteration, from the first fetch until the cursor runs out or is dropped.
+            # It isn't made current, since the caller's own work runs between documents.
+            self._iteration_started = True
+            parent = current_span.get()
+            if parent is not None:
+                self._iteration_span = Span(f"mongo.{self.operation} {self.collection_name}", parent.traceId, parent.spanId, {
+                    "db.system": "mongodb", "db.collection": self.collection_name, "db.operation": self.operation,
+                    "db.iteration": True, "db.documents_returned": 0
+                })
+        try:
+            document = await self._cursor.__anext__()
+        except StopAsyncIteration:
+            self._finish_iteration()
+            raise
+        except BaseException as e:
+            if self._iteration_span is not None:
+                self._iteration_span.status = "error"
+                self._iteration_span.attributes["error"] = repr(e)
+            self._finish_iteration()
+            raise
+        if self._iteration_span is not None:
+            self._iteration_span.attributes["db.documents_returned"] += 1
+        return from_storage(document)
+
+    def _finish_iteration(self):
+        span, self._iteration_span = self._iteration_span, None
+        if span is not None:
+            span.finish()
+
+    def __del__(self):
+        # A loop that breaks early abandons the cursor rather than exhausting it
+        self._finish_iteration()
+
+class StorageCollection:
+    """Motor collection that stores compact ids and native dates but speaks API strings"""
+
+    def __init__(self, collection):
+        self.raw = collection
+        self.collection_name = collection.name
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def find(self, filter=None, *args, **kwargs):
+        return StorageCursor(self.raw.find(to_storage(filter or {}, query=True), *args, **kwargs), self.collection_name, "find")
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        return StorageCursor(self.raw.aggregate(to_storage(pipeline, query=True), *args, **kwargs), self.collection_name, "aggregate")
+
+    @traced_operation
+    async def find_one(self, filter=None, *args, **kwargs):
+        return from_storage(await self.raw.find_one(to_storage(filter or {}, query=True), *args, **kwargs))
+
+    @traced_operation
+    async def count_documents(self, filter, *args, **kwargs):
+        return await self.raw.count_documents(to_storage(filter, query=True), *args, **kwargs)
+
+    @traced_operation
+    async def insert_one(self, document, *args, **kwargs):
+        return await self.raw.insert_one(to_storage(document), *args, **kwargs)
+
+    @traced_operation
+    async def insert_many(self, documents, *args, **kwargs):
+        return await self.raw.insert_many([to_storage(document) for document in documents], *args, **kwargs)
+
+    @traced_operation
+    async def update_one(self, filter, update, *args, array_filters=None, **kwargs):
+        return await self.raw.update_one(
+            to_storage(filter, query=True, legacy=False if kwargs.get("upsert") else None), to_storage(update), *args,
+            array_filters=to_storage(array_filters, query=True), **kwargs
+        )
+
+    @traced_operation
+    async def update_many(self, filter, update, *args, array_filters=None, **kwargs):
+        return await self.raw.update_many(
+            to_storage(filter, query=True, legacy=False if kwargs.get("upsert") else None), to_storage(update), *args,
+            array_filters=to_storage(array_filters, query=True), **kwargs
+        )
+
+    @traced_operation
+    async def find_one_and_update(self, filter, update, *args, array_filters=None, **kwargs):
+        return from_storage(await self.raw.find_one_and_update(
+            to_storage(filter, query=True, legacy=False if kwargs.get("upsert") else None), to_storage(update), *args,
+            array_filters=to_storage(array_filters, query=True), **kwargs
+        ))
+
+    @traced_operation
+    async def delete_one(self, filter, *args, **kwargs):
+        return await self.raw.delete_one(to_storage(filter, query=True), *args, **kwargs)
+
+    @traced_operation
+    async def delete_many(self, filter, *args, **kwargs):
+        return await self.raw.delete_many(to_storage(filter, query=True), *args, **kwargs)
+
+    @traced_operation
+    async def bulk_write(self, requests, *args, **kwargs):
+        return await self.raw.bulk_write([_storage_operation(request) for request in requests], *args, **kwargs)
+
+def _storage_operation(request):
+    if isinstance(request, InsertOne):
+        return InsertOne(to_storage(request._doc))
+    if isinstance(request, (UpdateOne, UpdateMany)):
+        return type(request)(
+            to_storage(request._filter, query=True, legacy=False if request._upsert else None), to_storage(request._doc),
+            upsert=request._upsert, array_filters=to_storage(request._array_filters, query=True)
+        )
+    if isinstance(request, ReplaceOne):
+        return ReplaceOne(
+            to_storage(request._filter, query=True, legacy=False if request._upsert else None), to_storage(request._doc), upsert=request._upsert
+        )
+    if isinstance(request, (DeleteOne, DeleteMany)):
+        return type(request)(to_storage(request._filter, query=True))
+    return request
+
+class StorageDatabase:
+    def __init__(self, database):
+        self.raw = database
+
+    def __getattr__(self, name):
+        return StorageCollection(self.raw[name])
+
+    def __getitem__(self, name):
+        return StorageCollection(self.raw[name])
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+client = AsyncIOMotorClient(mongo_url, uuidRepresentation="standard")
+db = StorageDatabase(client[os.environ['DB_NAME']])
+# Read-mostly background work (index builds, reports) goes to secondaries when available
+secondary_db = StorageDatabase(client.get_database(os.environ['DB_NAME'], read_preference=ReadPreference.SECONDARY_PREFERRED))
 
 # Create the main app without a prefix
 app = FastAPI()
+app.add_middleware(TracingMiddleware)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -42,6 +635,7 @@ class Hospital(BaseModel):
     rating: float = 4.5
     distance: str = "2.5 km"
     emergency: bool = True
+    changeVersion: int = 0
 
 class HospitalCreate(BaseModel):
     name: str
@@ -75,6 +669,11 @@ class MedicineType(str, Enum):
     OTC = "Over-the-Counter"
     PRESCRIPTION = "Prescription Required"
 
+class StockBatch(BaseModel):
+    lotNumber: str
+    quantity: int
+    expiryDate: str
+
 class Medicine(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -86,8 +685,9 @@ class Medicine(BaseModel):
     sideEffects: List[str] = []
     activeIngredients: List[str] = []
     manufacturer: str
-    expiryDate: str
+    expiryDate: str  # expiry of the longest-dated lot in stock; the medicine is unsellable after it
     inStock: int
+    batches: List[StockBatch] = []
     imageUrl: Optional[str] = None
     prescriptionRequired: bool
     minAge: Optional[int] = None
@@ -95,6 +695,7 @@ class Medicine(BaseModel):
     warnings: List[str] = []
     usage: str
     createdAt: datetime = Field(default_factory=datetime.now)
+    changeVersion: int = 0
 
 class MedicineCreate(BaseModel):
     name: str
@@ -108,6 +709,7 @@ class MedicineCreate(BaseModel):
     manufacturer: str
     expiryDate: str
     inStock: int
+    batches: List[StockBatch] = []  # when given, inStock and expiryDate are derived from the lots
     imageUrl: Optional[str] = None
     prescriptionRequired: bool
     minAge: Optional[int] = None
@@ -122,21 +724,36 @@ class Prescription(BaseModel):
     doctorName: str
     hospitalName: str
     prescriptionDate: datetime
-    medicines: List[Dict[str, Any]]  # [{"medicineId": str, "medicineName": str, "dosage": str, "duration": str}]
+    medicines: List[Dict[str, Any]]  # [{"medicineId": str, "medicineName": str, "dosage": str, "duration": str, "quantity": int, "quantityRemaining": int}]
     notes: Optional[str] = None
     imageUrl: Optional[str] = None  # Prescription image
     isUsed: bool = False
     createdAt: datetime = Field(default_factory=datetime.now)
 
+class PrescriptionMedicine(BaseModel):
+    medicineId: Optional[str] = None
+    medicineName: str
+    dosage: Optional[str] = None
+    duration: Optional[str] = None
+    quantity: int = Field(1, gt=0)
+
 class PrescriptionCreate(BaseModel):
     userId: str
     doctorName: str
     hospitalName: str
     prescriptionDate: datetime
-    medicines: List[Dict[str, Any]]
+    medicines: List[PrescriptionMedicine]
     notes: Optional[str] = None
     imageUrl: Optional[str] = None
 
+class PrescriptionLineRedemption(BaseModel):
+    medicineId: Optional[str] = None
+    line: Optional[int] = None  # index into Prescription.medicines, for lines not linked to the catalog
+    quantity: int = Field(1, gt=0)
+
+class PrescriptionRedemption(BaseModel):
+    lines: List[PrescriptionLineRedemption] = []  # no lines redeems whatever is left
+
 # Shopping Cart Models
 class CartItem(BaseModel):
     medicineId: str
@@ -186,6 +803,7 @@ class Order(BaseModel):
     estimatedDelivery: Optional[datetime] = None
     notes: Optional[str] = None
     prescriptionIds: List[str] = []
+    interactionWarnings: List[Dict[str, Any]] = []
 
 class OrderCreate(BaseModel):
     userId: str
@@ -197,6 +815,134 @@ class OrderCreate(BaseModel):
     notes: Optional[str] = None
     prescriptionIds: List[str] = []
 
+# Statuses each order status may move to; delivered and cancelled are final
+ORDER_TRANSITIONS = {
+    OrderStatus.PENDING: {OrderStatus.CONFIRMED, OrderStatus.CANCELLED},
+    OrderStatus.CONFIRMED: {OrderStatus.PREPARING, OrderStatus.CANCELLED},
+    OrderStatus.PREPARING: {OrderStatus.OUT_FOR_DELIVERY, OrderStatus.CANCELLED},
+    OrderStatus.OUT_FOR_DELIVERY: {OrderStatus.DELIVERED},
+    OrderStatus.DELIVERED: set(),
+    OrderStatus.CANCELLED: set(),
+}
+
+class OrderEvent(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    orderId: str
+    userId: str
+    status: OrderStatus
+    previousStatus: Optional[OrderStatus] = None
+    at: datetime = Field(default_factory=datetime.now)
+
+class BulkOrderFilter(BaseModel):
+    status: OrderStatus
+    userId: Optional[str] = None
+    orderedBefore: Optional[datetime] = None
+
+class BulkOrderStatusUpdate(BaseModel):
+    status: OrderStatus
+    orderIds: List[str] = []
+    filter: Optional[BulkOrderFilter] = None  # used when orderIds is empty
+
+class OrderStatusOutcome(str, Enum):
+    UPDATED = "updated"
+    NOT_FOUND = "not_found"
+    INVALID_TRANSITION = "invalid_transition"
+    CONFLICT = "conflict"
+
+class OrderStatusResult(BaseModel):
+    orderId: str
+    outcome: OrderStatusOutcome
+    previousStatus: Optional[OrderStatus] = None
+
+class BulkOrderStatusResponse(BaseModel):
+    status: OrderStatus
+    updated: int
+    results: List[OrderStatusResult]
+
+# Autocomplete Models
+class SuggestionScope(str, Enum):
+    MEDICINES = "medicines"
+    HOSPITALS = "hospitals"
+
+class Suggestion(BaseModel):
+    text: str
+    type: str
+    id: Optional[str] = None
+
+# Fuzzy Search Models
+class MedicineMatch(BaseModel):
+    medicine: Medicine
+    score: float
+
+# Drug Interaction Models
+class InteractionSeverity(str, Enum):
+    MINOR = "minor"
+    MODERATE = "moderate"
+    MAJOR = "major"
+
+class InteractionWarning(BaseModel):
+    medicines: List[str]
+    ingredients: List[str]
+    severity: InteractionSeverity
+    description: str
+
+class InteractionCheckRequest(BaseModel):
+    medicineIds: List[str]
+    userId: Optional[str] = None  # include the user's active prescriptions
+
+# Recommendation Models
+class RelatedMedicine(BaseModel):
+    medicineId: str
+    medicineName: str
+    score: float
+
+# Dashboard Models
+class OrderSummary(BaseModel):
+    id: str
+    status: OrderStatus
+    totalAmount: float
+    orderDate: datetime
+    estimatedDelivery: Optional[datetime] = None
+    itemCount: int = 0
+
+class DashboardCounts(BaseModel):
+    cartItems: int = 0
+    orders: int = 0
+    activePrescriptions: int = 0
+
+class UserDashboard(BaseModel):
+    cart: Cart
+    recentOrders: List[OrderSummary] = []
+    activePrescriptions: List[Prescription] = []
+    counts: DashboardCounts
+
+# Sync Models
+class SyncCollection(str, Enum):
+    HOSPITALS = "hospitals"
+    MEDICINES = "medicines"
+
+class CatalogSync(BaseModel):
+    version: int  # pass back as `since` on the next sync
+    hasMore: bool
+    upserts: List[Dict[str, Any]]
+    deletes: List[str]
+
+# Inventory Models
+class InventoryAlertType(str, Enum):
+    LOW_STOCK = "low_stock"
+    NEAR_EXPIRY = "near_expiry"
+
+class InventoryAlert(BaseModel):
+    key: str
+    type: InventoryAlertType
+    medicineId: str
+    medicineName: str
+    lotNumber: Optional[str] = None
+    expiryDate: Optional[str] = None
+    inStock: Optional[int] = None
+    detectedAt: datetime
+    lastSeenAt: datetime
+
 # Initialize dummy hospital data
 async def init_dummy_data():
     """Initialize the database with dummy hospital data"""
@@ -780,187 +1526,2490 @@ async def init_medicine_data():
         await db.medicines.insert_many(dummy_medicines)
         logger.info("Dummy medicine data initialized")
 
-# API Routes
-@api_router.get("/")
-async def root():
-    return {"message": "Hospot API - Find & Book Hospital Beds in Real Time"}
+# Initialize drug interaction rules
+async def init_interaction_data():
+    """Initialize the database with baseline drug interaction rules.
 
-@api_router.get("/hospitals", response_model=List[Hospital])
-async def get_hospitals(search: Optional[str] = Query(None, description="Search hospitals by name or location")):
-    """Get all hospitals or search hospitals by name/location"""
-    
-    if search:
-        # Case-insensitive search in name and location fields
-        query = {
-            "$or": [
-                {"name": {"$regex": search, "$options": "i"}},
-                {"location": {"$regex": search, "$options": "i"}},
-                {"address": {"$regex": search, "$options": "i"}}
-            ]
-        }
-    else:
-        query = {}
-    
-    hospitals = await db.hospitals.find(query).to_list(100)
-    
-    # Sort by availability (hospitals with more beds first) and rating
-    def sort_key(hospital):
-        total_beds = hospital['availableBeds']['ICU'] + hospital['availableBeds']['General'] + hospital['availableBeds']['Special']
-        return (-total_beds, -hospital['rating'])
-    
-    hospitals.sort(key=sort_key)
-    
-    return [Hospital(**hospital) for hospital in hospitals]
+    Each side of a rule is either a canonical ingredient or an ingredient class
+    from INGREDIENT_CLASSES; rules are expanded to ingredient pairs when loaded.
+    """
+    existing_count = await db.drug_interactions.count_documents({})
+    if existing_count == 0:
+        interaction_rules = [
+            {
+                "id": str(uuid.uuid4()),
+                "between": ["aspirin", "anticoagulant"],
+                "severity": "major",
+                "description": "Greatly increased risk of serious bleeding"
+            },
+            {
+                "id": str(uuid.uuid4()),
+                "between": ["nsaid", "anticoagulant"],
+                "severity": "major",
+                "description": "NSAIDs increase the bleeding risk of blood thinners"
+            },
+            {
+                "id": str(uuid.uuid4()),
+                "between": ["tramadol", "ssri"],
+                "severity": "major",
+                "description": "Risk of serotonin syndrome and seizures"
+            },
+            {
+                "id": str(uuid.uuid4()),
+                "between": ["serotonergic", "serotonergic"],
+                "severity": "moderate",
+                "description": "Combined serotonergic effect may cause serotonin syndrome"
+            },
+            {
+                "id": str(uuid.uuid4()),
+                "between": ["ssri", "nsaid"],
+                "severity": "moderate",
+                "description": "Increased risk of stomach bleeding"
+            },
+            {
+                "id": str(uuid.uuid4()),
+                "between": ["nsaid", "nsaid"],
+                "severity": "moderate",
+                "description": "Taking two NSAIDs together increases stomach and kidney side effects"
+            },
+            {
+                "id": str(uuid.uuid4()),
+                "between": ["nsaid", "antihypertensive"],
+                "severity": "minor",
+                "description": "NSAIDs may reduce the blood pressure lowering effect"
+            },
+            {
+                "id": str(uuid.uuid4()),
+                "between": ["opioid", "sedating antihistamine"],
+                "severity": "moderate",
+                "description": "Additive drowsiness and slowed breathing"
+            }
+        ]
 
-@api_router.get("/hospitals/{hospital_id}", response_model=Hospital)
-async def get_hospital(hospital_id: str):
-    """Get a specific hospital by ID"""
-    hospital = await db.hospitals.find_one({"id": hospital_id})
-    if not hospital:
-        raise HTTPException(status_code=404, detail="Hospital not found")
-    return Hospital(**hospital)
+        await db.drug_interactions.insert_many(interaction_rules)
+        logger.info("Drug interaction rules initialized")
 
-# Medicine API Routes
-@api_router.get("/medicines", response_model=List[Medicine])
-async def get_medicines(
-    category: Optional[str] = Query(None, description="Filter by category"),
-    search: Optional[str] = Query(None, description="Search medicines by name"),
-    prescription_required: Optional[bool] = Query(None, description="Filter by prescription requirement")
-):
-    """Get medicines with optional filters"""
-    query = {}
-    
-    if category:
-        query["category"] = category
-        
-    if prescription_required is not None:
-        query["prescriptionRequired"] = prescription_required
-        
-    if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"activeIngredients": {"$elemMatch": {"$regex": search, "$options": "i"}}}
-        ]
-    
-    medicines = await db.medicines.find(query).to_list(100)
-    return [Medicine(**medicine) for medicine in medicines]
+# Autocomplete suggestion index
+SUGGEST_LIMIT = 10
 
-@api_router.get("/medicines/categories")
-async def get_medicine_categories():
-    """Get all medicine categories"""
-    return [{"value": cat.value, "label": cat.value} for cat in MedicineCategory]
+class _TrieNode:
+    __slots__ = ("children", "terminal", "top")
 
-@api_router.get("/medicines/{medicine_id}", response_model=Medicine)
-async def get_medicine(medicine_id: str):
-    """Get a specific medicine by ID"""
-    medicine = await db.medicines.find_one({"id": medicine_id})
-    if not medicine:
-        raise HTTPException(status_code=404, detail="Medicine not found")
-    return Medicine(**medicine)
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.terminal: set = set()  # entry keys whose terms end at this node
+        self.top: List[tuple] = []  # best entry keys for this prefix, best first
 
-# Prescription API Routes
-@api_router.post("/prescriptions", response_model=Prescription)
-async def create_prescription(prescription: PrescriptionCreate):
-    """Create a new prescription"""
-    prescription_dict = prescription.dict()
-    prescription_dict["id"] = str(uuid.uuid4())
-    prescription_dict["createdAt"] = datetime.now()
-    prescription_dict["isUsed"] = False
-    
-    await db.prescriptions.insert_one(prescription_dict)
-    return Prescription(**prescription_dict)
+class SuggestionTrie:
+    """Prefix trie that keeps the top-K entries for every prefix, so a lookup only walks the prefix"""
 
-@api_router.get("/prescriptions/user/{user_id}", response_model=List[Prescription])
-async def get_user_prescriptions(user_id: str):
-    """Get all prescriptions for a user"""
-    prescriptions = await db.prescriptions.find({"userId": user_id}).to_list(100)
-    return [Prescription(**prescription) for prescription in prescriptions]
+    def __init__(self, limit: int = SUGGEST_LIMIT):
+        self.limit = limit
+        self.root = _TrieNode()
+        self.entries: Dict[tuple, Dict[str, Any]] = {}
+        self.terms: Dict[tuple, List[str]] = {}
 
-@api_router.get("/prescriptions/{prescription_id}", response_model=Prescription)
-async def get_prescription(prescription_id: str):
-    """Get a specific prescription by ID"""
-    prescription = await db.prescriptions.find_one({"id": prescription_id})
-    if not prescription:
-        raise HTTPException(status_code=404, detail="Prescription not found")
-    return Prescription(**prescription)
+    def _rank(self, key):
+        entry = self.entries[key]
+        return (-entry["score"], entry["text"])
 
-@api_router.put("/prescriptions/{prescription_id}/use")
-async def mark_prescription_used(prescription_id: str):
-    """Mark a prescription as used"""
-    result = await db.prescriptions.update_one(
-        {"id": prescription_id},
-        {"$set": {"isUsed": True}}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Prescription not found")
-    return {"message": "Prescription marked as used"}
+    def _path(self, term: str, create: bool = False):
+        nodes = [self.root]
+        for ch in term:
+            child = nodes[-1].children.get(ch)
+            if child is None:
+                if not create:
+                    return None
+                child = nodes[-1].children[ch] = _TrieNode()
+            nodes.append(child)
+        return nodes
 
-# Shopping Cart API Routes
-@api_router.get("/cart/{user_id}", response_model=Cart)
-async def get_cart(user_id: str):
-    """Get user's shopping cart"""
-    cart = await db.carts.find_one({"userId": user_id})
-    if not cart:
-        # Create empty cart if doesn't exist
-        cart_dict = {
-            "id": str(uuid.uuid4()),
-            "userId": user_id,
-            "items": [],
-            "totalAmount": 0.0,
-            "updatedAt": datetime.now()
-        }
-        await db.carts.insert_one(cart_dict)
-        return Cart(**cart_dict)
-    return Cart(**cart)
+    def _refresh(self, nodes):
+        # A node's top-K is the top-K of its own terminals plus its children's top-K
+        for node in reversed(nodes):
+            candidates = set(node.terminal)
+            for child in node.children.values():
+                candidates.update(child.top)
+            node.top = sorted(candidates, key=self._rank)[:self.limit]
 
-@api_router.post("/cart/{user_id}/add")
-async def add_to_cart(user_id: str, item: CartItem):
-    """Add item to cart"""
-    cart = await db.carts.find_one({"userId": user_id})
-    
-    if not cart:
-        # Create new cart
-        cart_dict = {
+    def upsert(self, key: tuple, text: str, kind: str, ref_id: Optional[str], terms: List[str], score: Optional[float] = None):
+        if score is None:
+            score = self.entries[key]["score"] if key in self.entries else 0.0
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = {"text": text, "type": kind, "id": ref_id, "score": score}
+        self.terms[key] = terms
+        for term in terms:
+            nodes = self._path(term, create=True)
+            nodes[-1].terminal.add(key)
+            self._refresh(nodes)
+
+    def remove(self, key: tuple):
+        if key not in self.entries:
+            return
+        for term in self.terms.pop(key):
+            nodes = self._path(term)
+            if nodes is None:
+                continue
+            nodes[-1].terminal.discard(key)
+            # Prune branches that no longer lead to any entry
+            for depth in range(len(term), 0, -1):
+                node = nodes[depth]
+                if node.terminal or node.children:
+                    break
+                del nodes[depth - 1].children[term[depth - 1]]
+            self._refresh(nodes)
+        del self.entries[key]
+
+    def bump(self, key: tuple, delta: float = 1.0):
+        if key in self.entries:
+            self.set_score(key, self.entries[key]["score"] + delta)
+
+    def set_score(self, key: tuple, score: float):
+        if key not in self.entries:
+            return
+        self.entries[key]["score"] = score
+        for term in self.terms[key]:
+            nodes = self._path(term)
+            if nodes:
+                self._refresh(nodes)
+
+    def suggest(self, prefix: str, limit: int = SUGGEST_LIMIT) -> List[Dict[str, Any]]:
+        nodes = self._path(normalize_suggestion_text(prefix))
+        if not nodes:
+            return []
+        return [
+            {"text": self.entries[key]["text"], "type": self.entries[key]["type"], "id": self.entries[key]["id"]}
+            for key in nodes[-1].top[:limit]
+        ]
+
+def normalize_suggestion_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def suggestion_terms(text: str) -> List[str]:
+    """Index every word start so "general" completes "City General Hospital" """
+    words = normalize_suggestion_text(text).split(" ")
+    return list(dict.fromkeys(" ".join(words[i:]) for i in range(len(words)) if words[i]))
+
+suggestion_indexes: Dict[SuggestionScope, SuggestionTrie] = {
+    SuggestionScope.MEDICINES: SuggestionTrie(),
+    SuggestionScope.HOSPITALS: SuggestionTrie(),
+}
+# Ingredient and location entries are derived from medicines and hospitals: each scores the sum of
+# what its sources contribute, so re-indexing a source replaces its share instead of adding to it
+derived_contributions: Dict[tuple, Dict[tuple, float]] = {}  # derived key -> source key -> contribution
+derived_entries: Dict[tuple, Dict[tuple, str]] = {}  # source key -> derived key -> display text
+
+def _drop_contribution(index: SuggestionTrie, key: tuple, source: tuple):
+    contributions = derived_contributions.get(key, {})
+    contributions.pop(source, None)
+    if contributions:
+        index.set_score(key, sum(contributions.values()))
+    else:
+        derived_contributions.pop(key, None)
+        index.remove(key)
+
+def link_derived_entries(index: SuggestionTrie, source: tuple, entries: Dict[tuple, str], contribution: float):
+    for key in derived_entries.get(source, {}):
+        if key not in entries:
+            _drop_contribution(index, key, source)
+    for key, text in entries.items():
+        contributions = derived_contributions.setdefault(key, {})
+        contributions[source] = contribution
+        if key not in index.entries:
+            index.upsert(key, text, key[0], None, suggestion_terms(text), 0.0)
+        index.set_score(key, sum(contributions.values()))
+    derived_entries[source] = entries
+
+def unlink_derived_entries(index: SuggestionTrie, source: tuple):
+    for key in derived_entries.pop(source, {}):
+        _drop_contribution(index, key, source)
+
+def index_medicine_suggestions(medicine: Dict[str, Any], popularity: Optional[float] = None):
+    """Add or refresh a medicine and its active ingredients in the suggestion index"""
+    index = suggestion_indexes[SuggestionScope.MEDICINES]
+    key = ("medicine", medicine["id"])
+    index.upsert(key, medicine["name"], "medicine", medicine["id"], suggestion_terms(medicine["name"]), popularity)
+    ingredients = {}
+    for ingredient in medicine.get("activeIngredients", []):
+        ingredient_key = ("ingredient", normalize_suggestion_text(ingredient))
+        if ingredient_key[1] != normalize_suggestion_text(medicine["name"]):  # else already suggested as the medicine itself
+            ingredients[ingredient_key] = ingredient
+    link_derived_entries(index, key, ingredients, index.entries[key]["score"])
+
+def index_hospital_suggestions(hospital: Dict[str, Any], popularity: Optional[float] = None):
+    """Add or refresh a hospital and its location; rating seeds the score until views accumulate"""
+    index = suggestion_indexes[SuggestionScope.HOSPITALS]
+    key = ("hospital", hospital["id"])
+    if popularity is None and key not in index.entries:
+        popularity = hospital.get("rating", 0.0)
+    index.upsert(key, hospital["name"], "hospital", hospital["id"], suggestion_terms(hospital["name"]), popularity)
+    # A location ranks by the number of hospitals in it
+    location_key = ("location", normalize_suggestion_text(hospital["location"]))
+    link_derived_entries(index, key, {location_key: hospital["location"]}, 1.0)
+
+def bump_medicine_popularity(medicine_id: str, quantity: int):
+    index = suggestion_indexes[SuggestionScope.MEDICINES]
+    key = ("medicine", medicine_id)
+    if key in index.entries:
+        index.bump(key, quantity)
+        link_derived_entries(index, key, derived_entries.get(key, {}), index.entries[key]["score"])
+
+# Typo-tolerant medicine search
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Optimal string alignment distance; gives up once every path exceeds max_distance"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+class NGramIndex:
+    """Character n-gram index over the catalog's vocabulary.
+
+    Postings point at distinct words rather than medicines, so candidate generation
+    scales with vocabulary size, which grows far slower than the number of SKUs.
+    """
+
+    def __init__(self, n: int = 3, max_candidates: int = 50, min_similarity: float = 0.6):
+        self.n = n
+        self.max_candidates = max_candidates
+        self.min_similarity = min_similarity
+        self.postings: Dict[str, set] = {}  # n-gram -> words
+        self.words: Dict[str, set] = {}  # word -> document ids
+        self.doc_words: Dict[str, set] = {}  # document id -> words
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return [word for word in re.findall(r"[a-z]+", text.lower()) if len(word) >= 3]
+
+    def grams(self, word: str) -> set:
+        padded = f"${word}$"
+        return {padded[i:i + self.n] for i in range(len(padded) - self.n + 1)}
+
+    def add(self, doc_id: str, texts: List[str]):
+        self.remove(doc_id)
+        words = {word for text in texts for word in self.tokenize(text)}
+        for word in words:
+            if word not in self.words:
+                self.words[word] = set()
+                for gram in self.grams(word):
+                    self.postings.setdefault(gram, set()).add(word)
+            self.words[word].add(doc_id)
+        self.doc_words[doc_id] = words
+
+    def remove(self, doc_id: str):
+        for word in self.doc_words.pop(doc_id, ()):
+            docs = self.words[word]
+            docs.discard(doc_id)
+            if not docs:
+                del self.words[word]
+                for gram in self.grams(word):
+                    self.postings[gram].discard(word)
+                    if not self.postings[gram]:
+                        del self.postings[gram]
+
+    def similar_words(self, word: str) -> List[tuple]:
+        overlap = Counter()
+        for gram in self.grams(word):
+            overlap.update(self.postings.get(gram, ()))
+        candidates = heapq.nlargest(self.max_candidates, overlap.items(), key=lambda item: item[1])
+        matches = []
+        for candidate, _ in candidates:
+            longest = max(len(word), len(candidate))
+            max_distance = int(longest * (1 - self.min_similarity))
+            distance = edit_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                matches.append((candidate, 1 - distance / longest))
+        return matches
+
+    def search(self, query: str, limit: int) -> List[tuple]:
+        """Return (document id, score) pairs, best first; score averages the best word match per query word"""
+        query_words = self.tokenize(query)
+        if not query_words:
+            return []
+        scores: Dict[str, float] = {}
+        for query_word in query_words:
+            best: Dict[str, float] = {}
+            for word, similarity in self.similar_words(query_word):
+                for doc_id in self.words[word]:
+                    if similarity > best.get(doc_id, 0.0):
+                        best[doc_id] = similarity
+            for doc_id, similarity in best.items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + similarity
+        ranked = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(doc_id, score / len(query_words)) for doc_id, score in ranked]
+
+medicine_ngram_index = NGramIndex()
+
+def index_medicine_terms(medicine: Dict[str, Any]):
+    medicine_ngram_index.add(medicine["id"], [medicine["name"]] + medicine.get("activeIngredients", []))
+
+# Drug interaction checking
+# Canonical ingredient names for common synonyms and brand/chemical names
+INGREDIENT_SYNONYMS = {
+    "acetaminophen": "paracetamol",
+    "acetylsalicylic acid": "aspirin",
+    "cholecalciferol": "vitamin d3",
+    "ascorbic acid": "vitamin c",
+    "albuterol": "salbutamol",
+}
+
+# Ingredient classes that interaction rules can refer to
+INGREDIENT_CLASSES = {
+    "aspirin": ["nsaid", "antiplatelet"],
+    "ibuprofen": ["nsaid"],
+    "naproxen": ["nsaid"],
+    "diclofenac": ["nsaid"],
+    "warfarin": ["anticoagulant"],
+    "heparin": ["anticoagulant"],
+    "apixaban": ["anticoagulant"],
+    "rivaroxaban": ["anticoagulant"],
+    "clopidogrel": ["antiplatelet"],
+    "sertraline": ["ssri", "serotonergic"],
+    "fluoxetine": ["ssri", "serotonergic"],
+    "escitalopram": ["ssri", "serotonergic"],
+    "tramadol": ["opioid", "serotonergic"],
+    "codeine": ["opioid"],
+    "dextromethorphan": ["serotonergic"],
+    "amlodipine": ["antihypertensive"],
+    "lisinopril": ["antihypertensive"],
+    "cetirizine": ["sedating antihistamine"],
+    "diphenhydramine": ["sedating antihistamine"],
+}
+
+# Salt forms and dosage units that don't change the active moiety
+_INGREDIENT_NOISE = re.compile(
+    r"\b(\d+(\.\d+)?\s*(mg|mcg|g|ml|iu|%)(/\s*\w+)?|\d+(\.\d+)?|hcl|hydrochloride|besylate|sodium|potassium)\b|%"
+)
+
+SEVERITY_RANK = {InteractionSeverity.MINOR: 0, InteractionSeverity.MODERATE: 1, InteractionSeverity.MAJOR: 2}
+
+def normalize_ingredient(text: str) -> str:
+    name = " ".join(_INGREDIENT_NOISE.sub(" ", text.lower()).split())
+    return INGREDIENT_SYNONYMS.get(name, name)
+
+def ingredient_set(ingredients: List[str]) -> frozenset:
+    """Canonical ingredients for a free-text list; comma-separated combinations are split"""
+    names = (normalize_ingredient(part) for text in ingredients for part in text.split(","))
+    return frozenset(name for name in names if name)
+
+class InteractionIndex:
+    """Pairwise interaction table keyed by sorted canonical ingredient pairs"""
+
+    def __init__(self):
+        self.pairs: Dict[tuple, Dict[str, Any]] = {}
+
+    def load(self, rules: List[Dict[str, Any]]):
+        members: Dict[str, set] = {}
+        for ingredient, classes in INGREDIENT_CLASSES.items():
+            members.setdefault(ingredient, set()).add(ingredient)
+            for ingredient_class in classes:
+                members.setdefault(ingredient_class, set()).add(ingredient)
+
+        pairs = {}
+        for rule in rules:
+            left, right = rule["between"]
+            severity = InteractionSeverity(rule["severity"])
+            for a in members.get(left, {left}):
+                for b in members.get(right, {right}):
+                    if a == b:
+                        continue
+                    key = (a, b) if a < b else (b, a)
+                    existing = pairs.get(key)
+                    # When rules overlap, the most severe one wins
+                    if existing is None or SEVERITY_RANK[severity] > SEVERITY_RANK[existing["severity"]]:
+                        pairs[key] = {"severity": severity, "description": rule["description"]}
+        self.pairs = pairs
+
+    def check(self, medicines: List[tuple]) -> List[Dict[str, Any]]:
+        """Check (medicine name, ingredient set) pairs against each other in one pass"""
+        warnings = []
+        seen = set()
+        flattened = [(name, ingredient) for name, ingredients in medicines for ingredient in ingredients]
+        for i, (name_a, a) in enumerate(flattened):
+            for name_b, b in flattened[i + 1:]:
+                if name_a == name_b:
+                    continue
+                key = (a, b) if a < b else (b, a)
+                if a == b:
+                    interaction = {
+                        "severity": InteractionSeverity.MODERATE,
+                        "description": f"Both contain {a}; check the combined dose"
+                    }
+                else:
+                    interaction = self.pairs.get(key)
+                if interaction is None or (name_a, name_b, key) in seen:
+                    continue
+                seen.add((name_a, name_b, key))
+                warnings.append({
+                    "medicines": [name_a, name_b],
+                    "ingredients": list(key) if a != b else [a],
+                    "severity": interaction["severity"],
+                    "description": interaction["description"]
+                })
+        warnings.sort(key=lambda warning: -SEVERITY_RANK[warning["severity"]])
+        return warnings
+
+interaction_index = InteractionIndex()
+# medicine id -> (name, canonical ingredients); lets checks run without touching the catalog
+medicine_ingredients: Dict[str, tuple] = {}
+
+# off: never check, warn: report interactions, block: also refuse checkout on major interactions
+INTERACTION_CHECK_MODE = os.environ.get("INTERACTION_CHECK_MODE", "warn")
+
+def index_medicine_ingredients(medicine: Dict[str, Any]):
+    medicine_ingredients[medicine["id"]] = (medicine["name"], ingredient_set(medicine.get("activeIngredients", [])))
+
+async def load_interaction_index():
+    rules = await secondary_db.drug_interactions.find({}, {"_id": 0}).to_list(10000)
+    interaction_index.load(rules)
+    logger.info("Interaction index loaded: %d ingredient pairs", len(interaction_index.pairs))
+
+async def load_medicine_ingredients(medicine_ids: List[str]):
+    """Index medicines this worker hasn't seen yet, e.g. ones just created on another worker"""
+    missing = [medicine_id for medicine_id in set(medicine_ids) if medicine_id and medicine_id not in medicine_ingredients]
+    if missing:
+        async for medicine in db.medicines.find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "name": 1, "activeIngredients": 1}):
+            index_medicine_ingredients(medicine)
+
+async def find_interactions(medicine_ids: List[str], user_id: Optional[str] = None, skip_unknown: bool = False) -> List[Dict[str, Any]]:
+    """Check a basket, plus the user's active prescriptions; the catalog is only read on a cache miss.
+
+    Basket medicines that aren't in the catalog fail the check unless skip_unknown is set, for
+    baskets such as carts that may still hold medicines deleted since they were added.
+    """
+    prescriptions = []
+    if user_id:
+        prescriptions = await db.prescriptions.find(
+            {"userId": user_id, "isUsed": False},
+            {"_id": 0, "medicines.medicineId": 1, "medicines.medicineName": 1}
+        ).to_list(100)
+    await load_medicine_ingredients(
+        list(medicine_ids) + [line.get("medicineId") for prescription in prescriptions for line in prescription.get("medicines", [])]
+    )
+    unknown = sorted({medicine_id for medicine_id in medicine_ids if medicine_id not in medicine_ingredients})
+    if unknown and skip_unknown:
+        medicine_ids = [medicine_id for medicine_id in medicine_ids if medicine_id in medicine_ingredients]
+    elif unknown:
+        raise HTTPException(status_code=404, detail={"message": "Unknown medicines", "medicineIds": unknown})
+    medicines = {medicine_id: medicine_ingredients[medicine_id] for medicine_id in medicine_ids}
+    for prescription in prescriptions:
+        for line in prescription.get("medicines", []):
+            medicine_id = line.get("medicineId")
+            if medicine_id in medicine_ingredients:
+                medicines.setdefault(medicine_id, medicine_ingredients[medicine_id])
+            elif line.get("medicineName"):
+                medicines.setdefault(medicine_id or line["medicineName"], (line["medicineName"], ingredient_set([line["medicineName"]])))
+    return interaction_index.check(list(medicines.values()))
+
+# Frequently bought together
+RELATED_LIMIT = 10
+RELATED_MIN_COUNT = 2  # pairs bought together fewer times than this are noise
+PAIR_BUFFER_SIZE = 1_000_000  # pair keys held before folding into the sparse counts
+MAX_ITEMS_PER_ORDER = 50  # bulk orders say little about what goes together
+CO_PURCHASE_PAGE = 1000  # orders read per round trip and handed to the counting thread at once
+RECOMMENDATION_REBUILD_INTERVAL = int(os.environ.get("RECOMMENDATION_REBUILD_INTERVAL", 24 * 60 * 60))
+RECOMMENDATION_POLL_INTERVAL = 15 * 60  # seconds between checks for a stale or newly published table
+
+# medicine id -> [(related medicine id, score)], best first
+related_medicines: Dict[str, List[tuple]] = {}
+
+def _merge_pair_counts(keys: np.ndarray, counts: np.ndarray, batch: List[int]):
+    """Fold a batch of pair keys into the sparse (sorted keys, counts) arrays"""
+    batch_keys, batch_counts = np.unique(np.asarray(batch, dtype=np.int64), return_counts=True)
+    merged_keys, inverse = np.unique(np.concatenate([keys, batch_keys]), return_inverse=True)
+    merged_counts = np.bincount(inverse, weights=np.concatenate([counts, batch_counts])).astype(np.int64)
+    return merged_keys, merged_counts
+
+class CoPurchaseCounter:
+    """Counts how often medicines are bought together across the orders fed to it.
+
+    Pairs are encoded as int64 keys (low index << 32 | high index) and counted in a
+    sparse form, so memory depends on the number of distinct pairs, not on orders.
+    Its methods are synchronous CPU work, meant to run off the event loop.
+    """
+
+    def __init__(self):
+        self.index_of: Dict[str, int] = {}
+        self.item_counts: List[int] = []
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.batch: List[int] = []
+
+    def add_orders(self, orders: List[Dict[str, Any]]):
+        for order in orders:
+            indices = set()
+            for item in order.get("items", [])[:MAX_ITEMS_PER_ORDER]:
+                medicine_id = item["medicineId"]
+                if medicine_id not in self.index_of:
+                    self.index_of[medicine_id] = len(self.item_counts)
+                    self.item_counts.append(0)
+                indices.add(self.index_of[medicine_id])
+            indices = sorted(indices)
+            for position, low in enumerate(indices):
+                self.item_counts[low] += 1
+                self.batch.extend((low << 32) | high for high in indices[position + 1:])
+            if len(self.batch) >= PAIR_BUFFER_SIZE:
+                self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.keys, self.counts = _merge_pair_counts(self.keys, self.counts, self.batch)
+            self.batch = []
+
+    def top_related(self, top_k: int = RELATED_LIMIT, min_count: int = RELATED_MIN_COUNT) -> Dict[str, List[tuple]]:
+        """The top-K co-purchased medicines per medicine, best first"""
+        self.flush()
+        keep = self.counts >= min_count
+        keys, counts = self.keys[keep], self.counts[keep]
+        if keys.size == 0:
+            return {}
+
+        low = keys >> 32
+        high = keys & 0xFFFFFFFF
+        occurrences = np.asarray(self.item_counts, dtype=np.float64)
+        # Cosine similarity keeps best sellers from being "related" to everything
+        scores = counts / np.sqrt(occurrences[low] * occurrences[high])
+
+        rows = np.concatenate([low, high])
+        cols = np.concatenate([high, low])
+        scores = np.concatenate([scores, scores])
+        order = np.lexsort((-scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        rank = np.arange(rows.size) - np.searchsorted(rows, rows, side="left")
+        keep = rank < top_k
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+
+        ids = np.empty(len(self.index_of), dtype=object)
+        for medicine_id, index in self.index_of.items():
+            ids[index] = medicine_id
+        table: Dict[str, List[tuple]] = {}
+        for row, col, score in zip(ids[rows], ids[cols], scores.tolist()):
+            table.setdefault(row, []).append((col, round(score, 4)))
+        return table
+
+async def build_co_purchase_table(top_k: int = RELATED_LIMIT, min_count: int = RELATED_MIN_COUNT) -> Dict[str, List[tuple]]:
+    """Stream orders from a secondary and compute the top-K co-purchased medicines per medicine.
+
+    Orders are read a page at a time and counted in a worker thread, so the event loop only waits on I/O.
+    """
+    counter = CoPurchaseCounter()
+    cursor = secondary_db.orders.find(
+        {"status": {"$ne": OrderStatus.CANCELLED.value}},
+        {"_id": 0, "items.medicineId": 1},
+        batch_size=CO_PURCHASE_PAGE
+    )
+    page: List[Dict[str, Any]] = []
+    async for order in cursor:
+        page.append(order)
+        if len(page) >= CO_PURCHASE_PAGE:
+            await asyncio.to_thread(counter.add_orders, page)
+            page = []
+    if page:
+        await asyncio.to_thread(counter.add_orders, page)
+    return await asyncio.to_thread(counter.top_related, top_k, min_count)
+
+async def rebuild_recommendations():
+    """Recompute the co-purchase table and publish it with an atomic collection swap"""
+    table = await build_co_purchase_table()
+    generated_at = datetime.now()
+    staging = db.medicine_recommendations_staging
+    await staging.drop()
+    documents = [
+        {"medicineId": medicine_id, "related": [[related_id, score] for related_id, score in related], "generatedAt": generated_at}
+        for medicine_id, related in table.items()
+    ]
+    for start in range(0, len(documents), 1000):
+        await staging.insert_many(documents[start:start + 1000])
+    if documents:
+        await staging.rename("medicine_recommendations", dropTarget=True)
+    else:
+        await db.medicine_recommendations.drop()
+    related_medicines.clear()
+    related_medicines.update(table)
+    logger.info("Recommendations rebuilt for %d medicines", len(table))
+
+async def load_recommendations():
+    table = {
+        document["medicineId"]: [tuple(pair) for pair in document["related"]]
+        async for document in secondary_db.medicine_recommendations.find({}, {"_id": 0})
+    }
+    related_medicines.clear()
+    related_medicines.update(table)
+
+async def recommendation_loop():
+    """Rebuild the co-purchase table once it's older than the rebuild interval, and otherwise load the published one.
+
+    Only the worker holding the recommendations lease rebuilds; the others load what it publishes.
+    """
+    while True:
+        try:
+            latest = await db.medicine_recommendations.find_one({}, {"_id": 0, "generatedAt": 1})
+            stale = not latest or datetime.now() - latest["generatedAt"] >= timedelta(seconds=RECOMMENDATION_REBUILD_INTERVAL)
+            if stale and await hold_lease("recommendations", RECOMMENDATION_POLL_INTERVAL):
+                await rebuild_recommendations()
+            else:
+                await load_recommendations()
+        except Exception:
+            logger.exception("Recommendation refresh failed")
+        await asyncio.sleep(RECOMMENDATION_POLL_INTERVAL)
+
+# Popularity counts orders from this many recent days, so the aggregation doesn't grow with the order history
+POPULARITY_WINDOW_DAYS = int(os.environ.get("POPULARITY_WINDOW_DAYS", 90))
+
+async def ordered_quantities(limit: Optional[int] = None) -> Dict[str, int]:
+    """Units ordered per medicine over the popularity window, most first"""
+    pipeline = [
+        {"$match": {"orderDate": {"$gte": start_of_today() - timedelta(days=POPULARITY_WINDOW_DAYS)}}},
+        {"$unwind": "$items"},
+        {"$group": {"_id": "$items.medicineId", "quantity": {"$sum": "$items.quantity"}}},
+        {"$sort": {"quantity": -1}}
+    ]
+    if limit:
+        pipeline.append({"$limit": limit})
+    return {row["_id"]: row["quantity"] async for row in secondary_db.orders.aggregate(pipeline)}
+
+async def build_search_indexes():
+    """Build the autocomplete tries and fuzzy index from the catalog, ranking medicines by recent units ordered"""
+    popularity = await ordered_quantities()
+
+    async for medicine in secondary_db.medicines.find({}, {"_id": 0, "id": 1, "name": 1, "activeIngredients": 1}):
+        index_medicine_suggestions(medicine, popularity.get(medicine["id"], 0))
+        index_medicine_terms(medicine)
+        index_medicine_ingredients(medicine)
+    async for hospital in secondary_db.hospitals.find({}, {"_id": 0, "id": 1, "name": 1, "location": 1, "rating": 1}):
+        index_hospital_suggestions(hospital)
+    logger.info(
+        "Search indexes built: %d medicine suggestions, %d hospital suggestions, %d fuzzy terms",
+        len(suggestion_indexes[SuggestionScope.MEDICINES].entries),
+        len(suggestion_indexes[SuggestionScope.HOSPITALS].entries),
+        len(medicine_ngram_index.words)
+    )
+
+def unindex_medicine(medicine_id: str):
+    """Drop a deleted medicine from every in-memory index"""
+    index = suggestion_indexes[SuggestionScope.MEDICINES]
+    index.remove(("medicine", medicine_id))
+    unlink_derived_entries(index, ("medicine", medicine_id))
+    medicine_ngram_index.remove(medicine_id)
+    medicine_ingredients.pop(medicine_id, None)
+    related_medicines.pop(medicine_id, None)
+
+def unindex_hospital(hospital_id: str):
+    index = suggestion_indexes[SuggestionScope.HOSPITALS]
+    index.remove(("hospital", hospital_id))
+    unlink_derived_entries(index, ("hospital", hospital_id))
+
+# Catalog writes only update the indexes of the worker that handled them; every worker also follows
+# the catalog change versions so writes and deletes made elsewhere reach its indexes too
+CATALOG_INDEX_REFRESH = float(os.environ.get("CATALOG_INDEX_REFRESH", 5))
+catalog_index_versions = {collection: 0 for collection in SyncCollection}
+
+async def refresh_catalog_indexes():
+    for collection in SyncCollection:
+        has_more = True
+        while has_more:
+            version, has_more, changed, deleted = await catalog_changes(collection, catalog_index_versions[collection], SYNC_PAGE_LIMIT)
+            for doc in changed:
+                if collection == SyncCollection.MEDICINES:
+                    index_medicine_suggestions(doc)
+                    index_medicine_terms(doc)
+                    index_medicine_ingredients(doc)
+                else:
+                    index_hospital_suggestions(doc)
+            for doc_id in deleted:
+                if collection == SyncCollection.MEDICINES:
+                    unindex_medicine(doc_id)
+                else:
+                    unindex_hospital(doc_id)
+            catalog_index_versions[collection] = version
+
+async def catalog_index_loop():
+    while True:
+        try:
+            await refresh_catalog_indexes()
+        except Exception:
+            logger.exception("Catalog index refresh failed")
+        await asyncio.sleep(CATALOG_INDEX_REFRESH)
+
+# Startup warm-up
+WARMUP_BUDGET = float(os.environ.get("WARMUP_BUDGET", 30))  # seconds before optional warm-up stops gating readiness
+WARMUP_TOP_MEDICINES = int(os.environ.get("WARMUP_TOP_MEDICINES", 200))
+VIEW_FLUSH_INTERVAL = 60  # seconds between writes of accumulated view counts
+WARMUP_RETRIES = 5  # attempts at an optional step; required steps are retried until they succeed
+WARMUP_RETRY_DELAY = 1  # seconds before the first retry, doubling up to WARMUP_RETRY_MAX
+WARMUP_RETRY_MAX = 60
+
+# (kind, id) -> views not yet written to catalog_views
+pending_views: Counter = Counter()
+warmup_state: Dict[str, Any] = {"ready": False, "partial": False, "startedAt": None, "steps": {}}
+
+def record_view(kind: str, doc_id: str):
+    pending_views[(kind, doc_id)] += 1
+
+async def flush_views():
+    if not pending_views:
+        return
+    views = list(pending_views.items())
+    pending_views.clear()
+    try:
+        await db.catalog_views.bulk_write([
+            UpdateOne({"kind": kind, "id": doc_id}, {"$inc": {"views": count}}, upsert=True)
+            for (kind, doc_id), count in views
+        ], ordered=False)
+    except BulkWriteError as e:
+        # Unordered, so everything but the failed updates landed
+        for error in e.details["writeErrors"]:
+            key, count = views[error["index"]]
+            pending_views[key] += count
+        raise
+    except BaseException:
+        # Counted again on the next flush; an occasional double count beats losing the views
+        pending_views.update(dict(views))
+        raise
+
+async def view_flush_loop():
+    while True:
+        await asyncio.sleep(VIEW_FLUSH_INTERVAL)
+        try:
+            await flush_views()
+        except Exception:
+            logger.exception("Failed to record catalog views")
+
+async def hot_medicine_ids(limit: int) -> List[str]:
+    """Medicines ranked by views plus units ordered"""
+    scores: Counter = Counter()
+    async for row in secondary_db.catalog_views.find({"kind": "medicine"}, {"_id": 0, "id": 1, "views": 1}).sort("views", -1).limit(limit):
+        if row.get("id"):
+            scores[row["id"]] += row.get("views", 0)
+    scores.update(await ordered_quantities(limit))
+    return [medicine_id for medicine_id, _ in scores.most_common(limit)]
+
+async def prime_hot_catalog():
+    """Pull the hottest catalog documents into Mongo's cache and the snapshot pages into memory"""
+    medicine_ids = await hot_medicine_ids(WARMUP_TOP_MEDICINES)
+    await db.medicines.find({"id": {"$in": medicine_ids}}, {"_id": 0}).to_list(None)
+    await db.hospitals.find({}, {"_id": 0}).to_list(None)
+    snapshot = snapshot_state["snapshot"]
+    if snapshot:
+        snapshot.get("hospitals")
+        snapshot.get("medicines")
+        for medicine_id in medicine_ids:
+            snapshot.get("medicine", medicine_id)
+
+# Required steps hold readiness however long they take; optional ones only until the budget runs out
+WARMUP_STEPS = [
+    ("searchIndexes", True, lambda: build_search_indexes()),
+    ("interactionIndex", True, lambda: load_interaction_index()),
+    ("catalogSnapshot", False, lambda: refresh_catalog_snapshot()),
+    ("recommendations", False, lambda: load_recommendations()),
+    ("hotCatalog", False, lambda: prime_hot_catalog()),
+]
+
+async def run_warmup_steps(required: bool):
+    for name, step_required, step in WARMUP_STEPS:
+        if step_required != required:
+            continue
+        started = time.monotonic()
+        attempt, delay = 1, WARMUP_RETRY_DELAY
+        while True:
+            try:
+                await step()
+                warmup_state["steps"][name] = {"ok": True, "seconds": round(time.monotonic() - started, 3), "attempts": attempt}
+                break
+            except Exception as e:
+                logger.exception("Warm-up step %s failed (attempt %d)", name, attempt)
+                warmup_state["steps"][name] = {"ok": False, "error": str(e), "attempts": attempt}
+                if not required and attempt >= WARMUP_RETRIES:
+                    break
+            await asyncio.sleep(delay)
+            attempt, delay = attempt + 1, min(delay * 2, WARMUP_RETRY_MAX)
+
+async def warm_up():
+    """Load caches and search structures, then mark the instance ready for traffic"""
+    warmup_state["startedAt"] = datetime.now()
+    started = time.monotonic()
+    await run_warmup_steps(required=True)
+    optional = asyncio.create_task(run_warmup_steps(required=False))
+    done, _ = await asyncio.wait({optional}, timeout=max(WARMUP_BUDGET - (time.monotonic() - started), 0))
+    # Past the budget the remaining steps keep going in the background
+    warmup_state["partial"] = not done
+    warmup_state["ready"] = True
+    logger.info("Warm-up finished in %.2fs%s", time.monotonic() - started, " (partial)" if not done else "")
+
+# Catalog change versions
+# Hospitals and medicines share one sequence; every write stamps the document with the next version
+SYNC_PAGE_LIMIT = 500
+# Versions are reserved before the write lands, so a lower version can become visible after a higher
+# one. Sync pages stop short of changes this recent to avoid skipping past a write still in flight.
+SYNC_SETTLE = timedelta(seconds=2)
+
+async def reserve_change_versions(count: int = 1) -> int:
+    """Reserve count consecutive change versions; returns the first"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": "catalogChangeVersion"},
+        {"$inc": {"seq": count}, "$setOnInsert": {"epoch": str(uuid.uuid4())}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    # This worker must not serve a snapshot older than its own writes
+    snapshot_state["latestVersion"] = max(snapshot_state["latestVersion"], counter["seq"])
+    snapshot_state["wakeup"].set()
+    return counter["seq"] - count + 1
+
+async def change_stamp() -> Dict[str, Any]:
+    return {"changeVersion": await reserve_change_versions(), "changedAt": datetime.now()}
+
+async def backfill_change_versions():
+    """Version catalog documents written without one, e.g. the seed data"""
+    for name in SyncCollection:
+        missing = await db[name.value].find({"changeVersion": {"$exists": False}}, {"_id": 0, "id": 1}).to_list(None)
+        if not missing:
+            continue
+        first = await reserve_change_versions(len(missing))
+        now = datetime.now()
+        await db[name.value].bulk_write([
+            UpdateOne({"id": doc["id"], "changeVersion": {"$exists": False}}, {"$set": {"changeVersion": first + i, "changedAt": now}})
+            for i, doc in enumerate(missing)
+        ], ordered=False)
+
+async def delete_catalog_document(name: SyncCollection, doc_id: str) -> bool:
+    """Delete a hospital or medicine and leave a tombstone for syncing clients"""
+    result = await db[name.value].delete_one({"id": doc_id})
+    if result.deleted_count == 0:
+        return False
+    await db.catalog_tombstones.insert_one({"collection": name.value, "id": doc_id, **await change_stamp()})
+    return True
+
+async def catalog_changes(collection: SyncCollection, since: int, limit: int, settle: Optional[timedelta] = None) -> tuple:
+    """(version reached, more pending, changed documents, deleted ids) for changes after since, oldest first"""
+    settled = datetime.now() - (SYNC_SETTLE if settle is None else settle)
+    changed, deleted = await asyncio.gather(
+        db[collection.value].find({"changeVersion": {"$gt": since}}, {"_id": 0}).sort("changeVersion", 1).to_list(limit + 1),
+        db.catalog_tombstones.find(
+            {"collection": collection.value, "changeVersion": {"$gt": since}}, {"_id": 0, "id": 1, "changeVersion": 1, "changedAt": 1}
+        ).sort("changeVersion", 1).to_list(limit + 1)
+    )
+    changes = sorted([(doc["changeVersion"], False, doc) for doc in changed] + [(doc["changeVersion"], True, doc) for doc in deleted],
+                     key=lambda change: change[0])
+    version, upserts, deletes = since, [], []
+    has_more = len(changes) > limit
+    for change_version, is_delete, doc in changes[:limit]:
+        if doc["changedAt"] > settled:
+            # Picked up by the next regular sync
+            has_more = False
+            break
+        version = change_version
+        if is_delete:
+            deletes.append(doc["id"])
+        else:
+            upserts.append(doc)
+    return version, has_more, upserts, deletes
+
+# Shared catalog snapshot
+# Workers on a host share one memory-mapped file of pre-encoded catalog JSON. Whichever worker holds
+# the build lock rebuilds it when the catalog version moves and publishes it with an atomic rename;
+# every worker remaps when the file changes. Reads slice bytes out of the shared mapping.
+# The builder keeps the catalog it last wrote in memory, so a rebuild reads only the documents changed
+# since and re-encodes only those; a burst of writes is collected into one rebuild.
+CATALOG_SNAPSHOT_PATH = Path(os.environ.get(
+    "CATALOG_SNAPSHOT_PATH", Path(tempfile.gettempdir()) / f"hospot-catalog-{os.environ['DB_NAME']}.snapshot"
+))
+CATALOG_SNAPSHOT_REFRESH = float(os.environ.get("CATALOG_SNAPSHOT_REFRESH", 5))
+CATALOG_SNAPSHOT_DEBOUNCE = float(os.environ.get("CATALOG_SNAPSHOT_DEBOUNCE", 1))  # seconds a write waits for others before a rebuild
+SNAPSHOT_MAGIC = b"HSPTCAT1"
+SNAPSHOT_HEADER = struct.Struct("<8sQdI")  # magic, catalog change version, built at, index length
+MEDICINE_LIST_LIMIT = 100  # same page the medicines route returns from the database
+HOSPITAL_LIST_LIMIT = 100  # same page the hospitals route returns from the database
+
+class CatalogSnapshot:
+    """A published snapshot file mapped read-only"""
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+        magic, self.version, built_at, index_length = SNAPSHOT_HEADER.unpack_from(self.buffer)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        self.builtAt = datetime.fromtimestamp(built_at)
+        self.dataStart = SNAPSHOT_HEADER.size + index_length
+        self.index = json.loads(self.buffer[SNAPSHOT_HEADER.size:self.dataStart])
+
+    def get(self, section: str, key: Optional[str] = None) -> Optional[bytes]:
+        entry = self.index[section] if key is None else self.index[section].get(key)
+        if entry is None:
+            return None
+        offset, length = entry
+        return self.buffer[self.dataStart + offset:self.dataStart + offset + length]
+
+snapshot_state: Dict[str, Any] = {"snapshot": None, "latestVersion": 0, "wakeup": asyncio.Event()}
+# The catalog as of the last snapshot this worker built, in find order, each entity's encoded JSON as
+# (changeVersion, bytes), and per collection the version up to which changes have settled
+snapshot_builder: Dict[str, Any] = {"epoch": None, "version": None, "hospitals": {}, "medicines": {}, "encoded": {}, "settled": {}}
+
+def hospital_listing_order(hospital: Dict[str, Any]):
+    """Hospitals with more beds first, then by rating"""
+    total_beds = hospital['availableBeds']['ICU'] + hospital['availableBeds']['General'] + hospital['availableBeds']['Special']
+    return (-total_beds, -hospital['rating'])
+
+def write_catalog_snapshot(path: Path, epoch: Optional[str], version: int, hospitals: List[Dict[str, Any]], medicines: List[Dict[str, Any]],
+                           encoded: Dict[tuple, tuple]):
+    """Encode the catalog into a snapshot file and publish it with an atomic rename.
+
+    Entities whose changeVersion matches their entry in encoded reuse the bytes from the last build.
+    """
+    data = bytearray()
+    def add(encoded_value: bytes) -> List[int]:
+        data.extend(encoded_value)
+        return [len(data) - len(encoded_value), len(encoded_value)]
+
+    def encode(section: str, document: Dict[str, Any], model) -> bytes:
+        cached = encoded.get((section, document["id"]))
+        if cached and cached[0] is not None and cached[0] == document.get("changeVersion"):
+            return cached[1]
+        value = json.dumps(jsonable_encoder(model(**document))).encode()
+        encoded[(section, document["id"])] = (document.get("changeVersion"), value)
+        return value
+
+    def encode_list(values: List[bytes]) -> bytes:
+        # Same bytes json.dumps gives for the list
+        return b"[" + b", ".join(values) + b"]"
+
+    hospital_json = {hospital["id"]: encode("hospital", hospital, Hospital) for hospital in hospitals}
+    medicine_json = {medicine["id"]: encode("medicine", medicine, Medicine) for medicine in medicines}
+    for section, current in (("hospital", hospital_json), ("medicine", medicine_json)):
+        for key in [key for key in encoded if key[0] == section and key[1] not in current]:
+            del encoded[key]
+
+    listed_hospitals = sorted(hospitals[:HOSPITAL_LIST_LIMIT], key=hospital_listing_order)
+    today = start_of_today().date().isoformat()
+    listed_medicines = [medicine for medicine in medicines if medicine["expiryDate"] >= today][:MEDICINE_LIST_LIMIT]
+    index = {
+        "epoch": epoch,
+        "hospitals": add(encode_list([hospital_json[hospital["id"]] for hospital in listed_hospitals])),
+        "hospital": {hospital_id: add(value) for hospital_id, value in hospital_json.items()},
+        "medicine": {medicine_id: add(value) for medicine_id, value in medicine_json.items()},
+        "medicinesDay": today,
+        "medicines": add(encode_list([medicine_json[medicine["id"]] for medicine in listed_medicines])),
+    }
+    encoded_index = json.dumps(index).encode()
+
+    staging = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(staging, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, version, time.time(), len(encoded_index)))
+        f.write(encoded_index)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(staging, path)
+
+async def load_snapshot_catalog(epoch: Optional[str], published: Optional[int]):
+    """Bring the builder's copy of the catalog up to date"""
+    if snapshot_builder["epoch"] != epoch or snapshot_builder["version"] is None or snapshot_builder["version"] != published:
+        # Another worker built the published snapshot, or nothing was built yet: start from the whole catalog
+        hospitals, medicines = await asyncio.gather(
+            db.hospitals.find({}, {"_id": 0}).to_list(None),
+            db.medicines.find({}, {"_id": 0}).to_list(None)
+        )
+        # Changes are read again from the newest one old enough that every lower version has landed
+        cutoff = datetime.now() - SYNC_SETTLE
+        snapshot_builder.update(
+            epoch=epoch, hospitals={hospital["id"]: hospital for hospital in hospitals},
+            medicines={medicine["id"]: medicine for medicine in medicines}, encoded={},
+            settled={
+                collection: max((doc["changeVersion"] for doc in documents if doc.get("changedAt") and doc["changedAt"] <= cutoff), default=0)
+                for collection, documents in ((SyncCollection.HOSPITALS, hospitals), (SyncCollection.MEDICINES, medicines))
+            }
+        )
+        return
+
+    for collection in SyncCollection:
+        documents = snapshot_builder[collection.value]
+        since, has_more = snapshot_builder["settled"][collection], True
+        while has_more:
+            since, has_more, changed, deleted = await catalog_changes(collection, since, SYNC_PAGE_LIMIT)
+            for document in changed:
+                documents[document["id"]] = document
+            for document_id in deleted:
+                documents.pop(document_id, None)
+        snapshot_builder["settled"][collection] = since
+        # Changes too recent to have settled are applied as well, and read again next time in case
+        # a write with a lower version was still in flight
+        has_more = True
+        while has_more:
+            since, has_more, changed, deleted = await catalog_changes(collection, since, SYNC_PAGE_LIMIT, settle=timedelta(0))
+            for document in changed:
+                documents[document["id"]] = document
+            for document_id in deleted:
+                documents.pop(document_id, None)
+
+async def refresh_catalog_snapshot():
+    """Map a newly published snapshot, and rebuild it if it's behind the catalog and no one else is"""
+    counter = await db.counters.find_one({"_id": "catalogChangeVersion"})
+    latest, epoch = (counter["seq"], counter.get("epoch")) if counter else (0, None)
+    snapshot_state["latestVersion"] = max(snapshot_state["latestVersion"], latest)
+
+    snapshot = snapshot_state["snapshot"]
+    try:
+        stat = os.stat(CATALOG_SNAPSHOT_PATH)
+        if snapshot is None or snapshot.identity != (stat.st_ino, stat.st_mtime_ns):
+            snapshot = CatalogSnapshot(CATALOG_SNAPSHOT_PATH)
+    except (FileNotFoundError, ValueError, struct.error):
+        snapshot = None
+    # A snapshot left over from a dropped or restored database has versions that mean nothing here
+    if snapshot and snapshot.index.get("epoch") != epoch:
+        snapshot = None
+    snapshot_state["snapshot"] = snapshot
+    if snapshot and snapshot.version >= latest and snapshot.index["medicinesDay"] == start_of_today().date().isoformat():
+        return
+
+    with open(CATALOG_SNAPSHOT_PATH.with_name(CATALOG_SNAPSHOT_PATH.name + ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # another worker is building; we'll map its result next tick
+        await load_snapshot_catalog(epoch, snapshot.version if snapshot else None)
+        hospitals, medicines = list(snapshot_builder["hospitals"].values()), list(snapshot_builder["medicines"].values())
+        try:
+            # Documents were read after the version, so the snapshot is at least this fresh
+            await asyncio.to_thread(write_catalog_snapshot, CATALOG_SNAPSHOT_PATH, epoch, latest, hospitals, medicines, snapshot_builder["encoded"])
+        except BaseException:
+            snapshot_builder["version"] = None
+            raise
+        snapshot_builder["version"] = latest
+    snapshot_state["snapshot"] = CatalogSnapshot(CATALOG_SNAPSHOT_PATH)
+    logger.info("Catalog snapshot %d published: %d hospitals, %d medicines", latest, len(hospitals), len(medicines))
+
+async def catalog_snapshot_loop():
+    while True:
+        snapshot_state["wakeup"].clear()
+        try:
+            await refresh_catalog_snapshot()
+        except Exception:
+            logger.exception("Catalog snapshot refresh failed")
+        try:
+            await asyncio.wait_for(snapshot_state["wakeup"].wait(), CATALOG_SNAPSHOT_REFRESH)
+        except asyncio.TimeoutError:
+            continue
+        # Let the rest of a burst of writes land so it costs one rebuild
+        await asyncio.sleep(CATALOG_SNAPSHOT_DEBOUNCE)
+
+def snapshot_response(section: str, key: Optional[str] = None) -> Optional[Response]:
+    """Pre-encoded catalog JSON from the shared snapshot, or None if it's missing or behind our writes"""
+    snapshot = snapshot_state["snapshot"]
+    if snapshot is None or snapshot.version < snapshot_state["latestVersion"]:
+        return None
+    body = snapshot.get(section, key)
+    return Response(content=body, media_type="application/json") if body is not None else None
+
+# Request coalescing
+class SingleFlight:
+    """Lets concurrent callers with the same key share one execution of the work"""
+
+    def __init__(self):
+        self.calls: Dict[Any, asyncio.Task] = {}
+
+    async def do(self, key, work):
+        task = self.calls.get(key)
+        if task is None:
+            # Run as its own task so the caller that started it can disconnect without failing the rest
+            task = self.calls[key] = asyncio.ensure_future(work())
+            task.add_done_callback(lambda done: self._release(key, done))
+            request_profiler.follow(task, asyncio.current_task())
+        return await asyncio.shield(task)
+
+    def _release(self, key, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved; every waiter has already seen it
+
+read_flights = SingleFlight()
+
+async def coalesced_json(key, load) -> Response:
+    """Serve identical concurrent reads from one query and one JSON encoding"""
+    async def work():
+        return json.dumps(jsonable_encoder(await load())).encode()
+    return Response(content=await read_flights.do(key, work), media_type="application/json")
+
+# API Routes
+@api_router.get("/")
+async def root():
+    return {"message": "Hospot API - Find & Book Hospital Beds in Real Time"}
+
+@api_router.get("/ready")
+async def readiness():
+    """Readiness probe; not ready until startup warm-up has loaded the caches"""
+    body = jsonable_encoder(warmup_state)
+    return JSONResponse(status_code=200 if warmup_state["ready"] else 503, content=body)
+
+@api_router.get("/suggest", response_model=List[Suggestion])
+async def get_suggestions(
+    q: str = Query(..., min_length=1, description="Prefix typed so far"),
+    scope: SuggestionScope = Query(SuggestionScope.MEDICINES, description="Which catalog to complete against"),
+    limit: int = Query(SUGGEST_LIMIT, ge=1, le=SUGGEST_LIMIT, description="Maximum number of suggestions")
+):
+    """Get top name completions from the in-memory suggestion index (no database access)"""
+    return suggestion_indexes[scope].suggest(q, limit)
+
+@api_router.get("/hospitals", response_model=List[Hospital])
+async def get_hospitals(search: Optional[str] = Query(None, description="Search hospitals by name or location")):
+    """Get all hospitals or search hospitals by name/location"""
+    # Matching is case-insensitive, so searches differing only in case share a query
+    search = search.strip() if search else None
+    if not search:
+        cached = snapshot_response("hospitals")
+        if cached:
+            return cached
+    return await coalesced_json(("hospitals", search.lower() if search else None), lambda: load_hospitals(search))
+
+async def load_hospitals(search: Optional[str]) -> List[Hospital]:
+    if search:
+        # Case-insensitive search in name and location fields
+        query = {
+            "$or": [
+                {"name": {"$regex": search, "$options": "i"}},
+                {"location": {"$regex": search, "$options": "i"}},
+                {"address": {"$regex": search, "$options": "i"}}
+            ]
+        }
+    else:
+        query = {}
+    
+    hospitals = await db.hospitals.find(query).to_list(HOSPITAL_LIST_LIMIT)
+    
+    # Sort by availability (hospitals with more beds first) and rating
+    hospitals.sort(key=hospital_listing_order)
+    
+    return [Hospital(**hospital) for hospital in hospitals]
+
+@api_router.get("/hospitals/{hospital_id}", response_model=Hospital)
+async def get_hospital(hospital_id: str):
+    """Get a specific hospital by ID"""
+    async def load():
+        hospital = await db.hospitals.find_one({"id": hospital_id})
+        if not hospital:
+            raise HTTPException(status_code=404, detail="Hospital not found")
+        return Hospital(**hospital)
+    response = snapshot_response("hospital", hospital_id) or await coalesced_json(("hospital", hospital_id), load)
+    suggestion_indexes[SuggestionScope.HOSPITALS].bump(("hospital", hospital_id), 1)
+    record_view("hospital", hospital_id)
+    return response
+
+@api_router.post("/hospitals", response_model=Hospital)
+async def create_hospital(hospital: HospitalCreate):
+    """Add a hospital to the directory"""
+    hospital_dict = Hospital(**hospital.dict()).dict()
+    hospital_dict.update(await change_stamp())
+    await db.hospitals.insert_one(hospital_dict)
+    index_hospital_suggestions(hospital_dict)
+    return Hospital(**hospital_dict)
+
+@api_router.put("/hospitals/{hospital_id}/beds", response_model=Hospital)
+async def update_hospital_beds(hospital_id: str, beds: BedAvailability):
+    """Update a hospital's available bed counts"""
+    hospital = await db.hospitals.find_one_and_update(
+        {"id": hospital_id},
+        {"$set": {"availableBeds": beds.dict(), **await change_stamp()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not hospital:
+        raise HTTPException(status_code=404, detail="Hospital not found")
+    return Hospital(**hospital)
+
+@api_router.delete("/hospitals/{hospital_id}")
+async def delete_hospital(hospital_id: str):
+    """Remove a hospital from the directory"""
+    if not await delete_catalog_document(SyncCollection.HOSPITALS, hospital_id):
+        raise HTTPException(status_code=404, detail="Hospital not found")
+    unindex_hospital(hospital_id)
+    return {"message": "Hospital deleted"}
+
+# Medicine API Routes
+@api_router.get("/medicines", response_model=List[Medicine])
+async def get_medicines(
+    category: Optional[str] = Query(None, description="Filter by category"),
+    search: Optional[str] = Query(None, description="Search medicines by name"),
+    prescription_required: Optional[bool] = Query(None, description="Filter by prescription requirement"),
+    include_expired: bool = Query(False, description="Include medicines with no unexpired stock")
+):
+    """Get medicines with optional filters"""
+    search = search.strip() if search else None
+    snapshot = snapshot_state["snapshot"]
+    if not (category or search or include_expired or prescription_required is not None) and snapshot \
+            and snapshot.index["medicinesDay"] == start_of_today().date().isoformat():
+        cached = snapshot_response("medicines")
+        if cached:
+            return cached
+    key = ("medicines", category, search.lower() if search else None, prescription_required, include_expired, start_of_today())
+    return await coalesced_json(key, lambda: load_medicines(category, search, prescription_required, include_expired))
+
+async def load_medicines(category: Optional[str], search: Optional[str], prescription_required: Optional[bool], include_expired: bool) -> List[Medicine]:
+    query = {}
+    
+    if not include_expired:
+        query["expiryDate"] = {"$gte": start_of_today()}
+    
+    if category:
+        query["category"] = category
+        
+    if prescription_required is not None:
+        query["prescriptionRequired"] = prescription_required
+        
+    if search:
+        query["$or"] = [
+            {"name": {"$regex": search, "$options": "i"}},
+            {"description": {"$regex": search, "$options": "i"}},
+            {"activeIngredients": {"$elemMatch": {"$regex": search, "$options": "i"}}}
+        ]
+    
+    medicines = await db.medicines.find(query).to_list(MEDICINE_LIST_LIMIT)
+    return [Medicine(**medicine) for medicine in medicines]
+
+@api_router.get("/medicines/fuzzy", response_model=List[MedicineMatch])
+async def fuzzy_search_medicines(
+    q: str = Query(..., min_length=3, description="Search text, misspellings allowed"),
+    category: Optional[str] = Query(None, description="Filter by category"),
+    prescription_required: Optional[bool] = Query(None, description="Filter by prescription requirement"),
+    limit: int = Query(20, ge=1, le=100, description="Maximum number of matches")
+):
+    """Typo-tolerant medicine search over names and active ingredients, best matches first"""
+    matches = medicine_ngram_index.search(q, 100)
+    if not matches:
+        return []
+
+    query = {"id": {"$in": [doc_id for doc_id, _ in matches]}, "expiryDate": {"$gte": start_of_today()}}
+    if category:
+        query["category"] = category
+    if prescription_required is not None:
+        query["prescriptionRequired"] = prescription_required
+
+    medicines = {medicine["id"]: medicine for medicine in await db.medicines.find(query).to_list(len(matches))}
+    return [
+        MedicineMatch(medicine=Medicine(**medicines[doc_id]), score=round(score, 3))
+        for doc_id, score in matches if doc_id in medicines
+    ][:limit]
+
+@api_router.post("/medicines", response_model=Medicine)
+async def create_medicine(medicine: MedicineCreate):
+    """Add a medicine to the catalog"""
+    medicine_dict = Medicine(**medicine.dict()).dict()
+    if not medicine_dict["batches"]:
+        medicine_dict["batches"] = [{"lotNumber": "INITIAL", "quantity": medicine.inStock, "expiryDate": medicine.expiryDate}]
+    medicine_dict["inStock"], medicine_dict["expiryDate"] = summarize_batches(medicine_dict["batches"], medicine.expiryDate)
+    medicine_dict.update(await change_stamp())
+    await db.medicines.insert_one(medicine_dict)
+    index_medicine_suggestions(medicine_dict, 0)
+    index_medicine_terms(medicine_dict)
+    index_medicine_ingredients(medicine_dict)
+    return Medicine(**medicine_dict)
+
+@api_router.get("/medicines/categories")
+async def get_medicine_categories():
+    """Get all medicine categories"""
+    return [{"value": cat.value, "label": cat.value} for cat in MedicineCategory]
+
+@api_router.get("/medicines/{medicine_id}/related", response_model=List[RelatedMedicine])
+async def get_related_medicines(medicine_id: str, limit: int = Query(5, ge=1, le=RELATED_LIMIT)):
+    """Get medicines frequently bought together with this one, served from the precomputed table"""
+    related = []
+    for related_id, score in related_medicines.get(medicine_id, []):
+        if related_id in medicine_ingredients:
+            related.append(RelatedMedicine(medicineId=related_id, medicineName=medicine_ingredients[related_id][0], score=score))
+        if len(related) == limit:
+            break
+    return related
+
+@api_router.get("/medicines/{medicine_id}", response_model=Medicine)
+async def get_medicine(medicine_id: str):
+    """Get a specific medicine by ID"""
+    async def load():
+        medicine = await db.medicines.find_one({"id": medicine_id})
+        if not medicine:
+            raise HTTPException(status_code=404, detail="Medicine not found")
+        return Medicine(**medicine)
+    response = snapshot_response("medicine", medicine_id) or await coalesced_json(("medicine", medicine_id), load)
+    record_view("medicine", medicine_id)
+    return response
+
+@api_router.delete("/medicines/{medicine_id}")
+async def delete_medicine(medicine_id: str):
+    """Remove a medicine from the catalog"""
+    if not await delete_catalog_document(SyncCollection.MEDICINES, medicine_id):
+        raise HTTPException(status_code=404, detail="Medicine not found")
+    unindex_medicine(medicine_id)
+    return {"message": "Medicine deleted"}
+
+# Sync API Routes
+@api_router.get("/sync/{collection}", response_model=CatalogSync)
+async def sync_catalog(
+    collection: SyncCollection,
+    since: int = Query(0, ge=0, description="Version returned by the previous sync; 0 for a full download"),
+    limit: int = Query(SYNC_PAGE_LIMIT, ge=1, le=SYNC_PAGE_LIMIT)
+):
+    """Get hospitals or medicines created, updated or deleted after a change version"""
+    version, has_more, changed, deletes = await catalog_changes(collection, since, limit)
+    model = Hospital if collection == SyncCollection.HOSPITALS else Medicine
+    return CatalogSync(version=version, hasMore=has_more, upserts=[model(**doc).dict() for doc in changed], deletes=deletes)
+
+# Prescription API Routes
+@api_router.post("/prescriptions", response_model=Prescription)
+async def create_prescription(prescription: PrescriptionCreate):
+    """Create a new prescription"""
+    prescription_dict = prescription.dict()
+    prescription_dict["id"] = str(uuid.uuid4())
+    prescription_dict["createdAt"] = datetime.now()
+    prescription_dict["isUsed"] = False
+    for line in prescription_dict["medicines"]:
+        line["quantityRemaining"] = line["quantity"]
+    
+    await db.prescriptions.insert_one(prescription_dict)
+    return Prescription(**prescription_dict)
+
+@api_router.get("/prescriptions/user/{user_id}", response_model=List[Prescription])
+async def get_user_prescriptions(user_id: str):
+    """Get all prescriptions for a user"""
+    prescriptions = await db.prescriptions.find({"userId": user_id}).to_list(100)
+    return [Prescription(**prescription) for prescription in prescriptions]
+
+@api_router.get("/prescriptions/{prescription_id}", response_model=Prescription)
+async def get_prescription(prescription_id: str):
+    """Get a specific prescription by ID"""
+    prescription = await db.prescriptions.find_one({"id": prescription_id})
+    if not prescription:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    return Prescription(**prescription)
+
+@api_router.put("/prescriptions/{prescription_id}/use")
+async def mark_prescription_used(prescription_id: str):
+    """Mark a prescription as used; only one caller can ever succeed"""
+    prescription = await redeem_prescription(prescription_id, [])
+    if prescription is None:
+        await raise_redemption_failure(prescription_id)
+    return {"message": "Prescription marked as used"}
+
+@api_router.post("/prescriptions/{prescription_id}/redeem", response_model=Prescription)
+async def redeem_prescription_lines(prescription_id: str, redemption: PrescriptionRedemption):
+    """Atomically redeem quantities from individual prescription lines"""
+    prescription = await redeem_prescription(prescription_id, redemption.lines)
+    if prescription is None:
+        await raise_redemption_failure(prescription_id)
+    return Prescription(**prescription)
+
+# Dashboard API Routes
+@api_router.get("/users/{user_id}/dashboard", response_model=UserDashboard)
+async def get_user_dashboard(user_id: str, recent_orders: int = Query(5, ge=1, le=20, description="Number of recent orders to include")):
+    """Get a user's cart, recent orders and active prescriptions in one call"""
+    cart, orders, prescriptions, order_count = await asyncio.gather(
+        db.carts.find_one({"userId": user_id}, {"_id": 0}),
+        db.orders.find(
+            {"userId": user_id},
+            {"_id": 0, "id": 1, "status": 1, "totalAmount": 1, "orderDate": 1, "estimatedDelivery": 1, "items.quantity": 1}
+        ).sort("orderDate", -1).limit(recent_orders).to_list(recent_orders),
+        db.prescriptions.find({"userId": user_id, "isUsed": False}, {"_id": 0}).to_list(100),
+        db.orders.count_documents({"userId": user_id})
+    )
+
+    cart = Cart(**cart) if cart else Cart(userId=user_id)
+    return UserDashboard(
+        cart=cart,
+        recentOrders=[
+            OrderSummary(**order, itemCount=sum(item["quantity"] for item in order.pop("items", [])))
+            for order in orders
+        ],
+        activePrescriptions=[Prescription(**prescription) for prescription in prescriptions],
+        counts=DashboardCounts(
+            cartItems=sum(item.quantity for item in cart.items),
+            orders=order_count,
+            activePrescriptions=len(prescriptions)
+        )
+    )
+
+# Drug Interaction API Routes
+@api_router.post("/interactions/check", response_model=List[InteractionWarning])
+async def check_interactions(request: InteractionCheckRequest):
+    """Check a set of medicines, and optionally the user's active prescriptions, for interactions"""
+    return await find_interactions(request.medicineIds, request.userId)
+
+# Order event log
+ORDER_STREAM_HEARTBEAT = 15  # seconds between keep-alive comments on idle streams
+ORDER_STREAM_BACKLOG = 100  # events buffered per subscriber before the oldest are dropped
+BULK_STATUS_LIMIT = 1000  # orders one bulk status request may touch
+ORDER_EVENT_RETRY = 5  # seconds before a dropped event log tail reconnects
+# Without a replica set there are no change streams and the log is polled instead, re-reading a
+# short window so events written by other workers with slightly older timestamps aren't missed
+ORDER_EVENT_POLL = 1
+ORDER_EVENT_POLL_LAG = timedelta(seconds=5)
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+class OrderEventBroker:
+    """Tails the order event log, so every worker sees every event, and fans events out to the status streams open in this process"""
+
+    def __init__(self):
+        self.subscribers: Dict[str, set] = {}
+        self.resume_token = None
+        self.polled: deque = deque()  # (at, id) of events already published by the poller
+        self.polled_ids: set = set()
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        subscriber = asyncio.Queue(ORDER_STREAM_BACKLOG)
+        self.subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id: str, subscriber: asyncio.Queue):
+        subscribers = self.subscribers.get(user_id)
+        if subscribers:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[user_id]
+
+    def publish(self, event: OrderEvent):
+        for subscriber in self.subscribers.get(event.userId, ()):
+            if subscriber.full():
+                # A slow client loses its oldest event rather than holding up the publisher
+                subscriber.get_nowait()
+            subscriber.put_nowait(event)
+
+    async def run(self):
+        while True:
+            try:
+                await self.watch()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code != CHANGE_STREAMS_UNSUPPORTED:
+                    logger.exception("Order event stream failed")
+                    await asyncio.sleep(ORDER_EVENT_RETRY)
+                    continue
+                logger.warning("Change streams are unavailable; polling the order event log")
+                await self.poll()
+            except Exception:
+                logger.exception("Order event stream failed")
+                await asyncio.sleep(ORDER_EVENT_RETRY)
+
+    async def watch(self):
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        async with db.order_events.raw.watch(pipeline, resume_after=self.resume_token) as changes:
+            async for change in changes:
+                self.resume_token = changes.resume_token
+                self.publish(OrderEvent(**from_storage(change["fullDocument"])))
+
+    async def poll(self):
+        since = datetime.now()
+        while True:
+            await asyncio.sleep(ORDER_EVENT_POLL)
+            try:
+                events = await db.order_events.find({"at": {"$gte": since - ORDER_EVENT_POLL_LAG}}, {"_id": 0}).sort("at", 1).to_list(None)
+            except Exception:
+                logger.exception("Order event poll failed")
+                continue
+            for event in events:
+                if event["id"] not in self.polled_ids:
+                    self.polled.append((event["at"], event["id"]))
+                    self.polled_ids.add(event["id"])
+                    self.publish(OrderEvent(**event))
+                since = max(since, event["at"])
+            while self.polled and self.polled[0][0] < since - ORDER_EVENT_POLL_LAG:
+                self.polled_ids.discard(self.polled.popleft()[1])
+
+order_events = OrderEventBroker()
+
+async def record_order_events(events: List[OrderEvent]):
+    """Append to the order event log; open streams on every worker pick the events up from there"""
+    if not events:
+        return
+    await db.order_events.insert_many([event.dict() for event in events])
+
+def order_event_message(event: OrderEvent) -> str:
+    return f"id: {event.id}\nevent: order_status\ndata: {event.json()}\n\n"
+
+# Worker leases
+# Every worker starts the periodic loops, but those that act on shared data only do their work in the
+# worker holding the loop's lease. The holder renews it each round and it outlasts two rounds, so it
+# passes to another worker only once the holder stops renewing it.
+WORKER_ID = str(uuid.uuid4())
+
+async def hold_lease(name: str, interval: int) -> bool:
+    """Take or renew this worker's lease on a loop that runs every interval seconds; False if another worker holds it"""
+    now = datetime.now()
+    try:
+        await db.leases.update_one(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"leaseUntil": {"$lt": now}}]},
+            {"$set": {"owner": WORKER_ID, "leaseUntil": now + timedelta(seconds=2 * interval)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def release_leases():
+    """Let other workers take this worker's loops over without waiting for the leases to run out"""
+    await db.leases.delete_many({"owner": WORKER_ID})
+
+# Inventory and expiry tracking
+LOW_STOCK_THRESHOLD = int(os.environ.get("LOW_STOCK_THRESHOLD", 20))
+NEAR_EXPIRY_DAYS = int(os.environ.get("NEAR_EXPIRY_DAYS", 60))
+INVENTORY_RETIRE_ATTEMPTS = 3  # re-reads of a medicine whose lots changed while its expired ones were retired
+INVENTORY_SCAN_INTERVAL = int(os.environ.get("INVENTORY_SCAN_INTERVAL", 60 * 60))
+
+def start_of_today() -> datetime:
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+def summarize_batches(batches: List[Dict[str, Any]], fallback_expiry: str) -> tuple:
+    """(units in unexpired lots, latest expiry among them) for a medicine's lots"""
+    today = start_of_today().date().isoformat()
+    live = [batch for batch in batches if batch["expiryDate"] >= today and batch["quantity"] > 0]
+    if not live:
+        return 0, max((batch["expiryDate"] for batch in batches), default=fallback_expiry)
+    return sum(batch["quantity"] for batch in live), max(batch["expiryDate"] for batch in live)
+
+async def backfill_medicine_batches():
+    """Give medicines created before lot tracking a single lot holding their stock, and store expiry
+    dates still held as strings as BSON dates, which the expiry range filters need to match them"""
+    legacy = {"$or": [
+        {"batches": {"$exists": False}},
+        {"expiryDate": {"$type": "string"}},
+        {"batches.expiryDate": {"$type": "string"}}
+    ]}
+    # Read and matched in stored form, so the string dates aren't converted before they're compared
+    async for medicine in db.medicines.raw.find(legacy, {"_id": 1, "inStock": 1, "expiryDate": 1, "batches": 1}):
+        batches = medicine.get("batches")
+        if batches is None:
+            batches = [{"lotNumber": "INITIAL", "quantity": medicine.get("inStock", 0), "expiryDate": medicine["expiryDate"]}]
+        await db.medicines.raw.update_one(
+            {"_id": medicine["_id"], "expiryDate": medicine["expiryDate"], "batches": medicine.get("batches", {"$exists": False})},
+            to_storage({"$set": {"expiryDate": medicine["expiryDate"], "batches": batches, **await change_stamp()}})
+        )
+
+async def scan_inventory() -> Dict[str, int]:
+    """Retire expired lots and refresh low-stock and near-expiry alerts with indexed range queries"""
+    now = datetime.now()
+    today = start_of_today()
+
+    retired = 0
+    expiring = {"batches": {"$elemMatch": {"expiryDate": {"$lt": today}, "quantity": {"$gt": 0}}}}
+    projection = {"_id": 0, "id": 1, "batches": 1, "expiryDate": 1, "changeVersion": 1}
+    async for medicine in db.medicines.find(expiring, projection):
+        today_str = today.date().isoformat()
+        for attempt in range(INVENTORY_RETIRE_ATTEMPTS):
+            live = [batch for batch in medicine["batches"] if batch["expiryDate"] >= today_str]
+            expired = [batch for batch in medicine["batches"] if batch["expiryDate"] < today_str]
+            in_stock, expiry = summarize_batches(live or expired, medicine["expiryDate"])
+            # Lots are rewritten whole, so only over the version they were read at
+            result = await db.medicines.update_one(
+                {"id": medicine["id"], "changeVersion": medicine.get("changeVersion")},
+                {"$set": {"batches": live, "inStock": in_stock, "expiryDate": expiry, **await change_stamp()}, "$push": {"expiredBatches": {"$each": expired}}}
+            )
+            if result.modified_count:
+                retired += len(expired)
+                break
+            medicine = await db.medicines.find_one({"id": medicine["id"], **expiring}, projection)
+            if medicine is None:
+                break  # deleted, or its expired lots were retired by the write that raced us
+        else:
+            logger.warning("Left expired lots of medicine %s for the next scan after concurrent changes", medicine["id"])
+
+    alerts = []
+    async for medicine in db.medicines.find(
+        {"inStock": {"$lt": LOW_STOCK_THRESHOLD}, "expiryDate": {"$gte": today}},
+        {"_id": 0, "id": 1, "name": 1, "inStock": 1}
+    ):
+        alerts.append({
+            "key": f"low_stock:{medicine['id']}",
+            "type": InventoryAlertType.LOW_STOCK.value,
+            "medicineId": medicine["id"],
+            "medicineName": medicine["name"],
+            "inStock": medicine["inStock"]
+        })
+    horizon = today + timedelta(days=NEAR_EXPIRY_DAYS)
+    async for medicine in db.medicines.find(
+        {"batches": {"$elemMatch": {"expiryDate": {"$gte": today, "$lt": horizon}, "quantity": {"$gt": 0}}}},
+        {"_id": 0, "id": 1, "name": 1, "batches": 1}
+    ):
+        horizon_str = horizon.date().isoformat()
+        for batch in medicine["batches"]:
+            if batch["expiryDate"] < horizon_str and batch["quantity"] > 0:
+                alerts.append({
+                    "key": f"near_expiry:{medicine['id']}:{batch['lotNumber']}",
+                    "type": InventoryAlertType.NEAR_EXPIRY.value,
+                    "medicineId": medicine["id"],
+                    "medicineName": medicine["name"],
+                    "lotNumber": batch["lotNumber"],
+                    "expiryDate": batch["expiryDate"],
+                    "inStock": batch["quantity"]
+                })
+
+    if alerts:
+        await db.inventory_alerts.bulk_write([
+            UpdateOne(
+                {"key": alert["key"]},
+                {"$set": {**alert, "lastSeenAt": now, "resolved": False}, "$setOnInsert": {"detectedAt": now}},
+                upsert=True
+            )
+            for alert in alerts
+        ], ordered=False)
+    # Anything not seen in this scan has been restocked, sold or retired
+    await db.inventory_alerts.update_many(
+        {"resolved": False, "lastSeenAt": {"$lt": now}},
+        {"$set": {"resolved": True, "resolvedAt": now}}
+    )
+    summary = {"retiredLots": retired, "activeAlerts": len(alerts)}
+    logger.info("Inventory scan: %s", summary)
+    return summary
+
+async def inventory_scan_loop():
+    while True:
+        try:
+            if await hold_lease("inventory_scan", INVENTORY_SCAN_INTERVAL):
+                await scan_inventory()
+        except Exception:
+            logger.exception("Inventory scan failed")
+        await asyncio.sleep(INVENTORY_SCAN_INTERVAL)
+
+# Delivery dispatch
+DISPATCH_INTERVAL = int(os.environ.get("DISPATCH_INTERVAL", 5 * 60))
+DISPATCH_COURIERS = int(os.environ.get("DISPATCH_COURIERS", 10))
+DISPATCH_MAX_ORDERS = 50000  # open orders considered in one tick
+COURIER_BATCH_SIZE = 8  # orders a courier carries on one trip, all to the same zone
+COURIER_SPEED_KMH = 25.0
+STOP_MINUTES = 6.0  # handover time at each address
+HANDOVER_MINUTES = 30.0  # picking and packing before an order can leave the pharmacy
+ETA_REWRITE_TOLERANCE = timedelta(minutes=5)  # smaller ETA changes aren't written back
+DISPATCH_STATUSES = [OrderStatus.CONFIRMED.value, OrderStatus.PREPARING.value]
+
+# Delivery zones as (east, north) km offsets from the pharmacy, which is downtown
+DELIVERY_ZONES = {
+    "downtown": (0.0, 0.0),
+    "midtown": (0.0, 3.0),
+    "medical district": (2.0, -2.0),
+    "westside": (-6.0, 1.0),
+    "eastside": (6.0, 0.0),
+    "northside": (0.0, 8.0),
+    "southside": (0.0, -7.0),
+}
+UNKNOWN_ZONE = "other"
+UNKNOWN_ZONE_KM = 12.0
+ZONE_NAMES = list(DELIVERY_ZONES) + [UNKNOWN_ZONE]
+ZONE_DISTANCE_KM = np.array([np.hypot(*offset) for offset in DELIVERY_ZONES.values()] + [UNKNOWN_ZONE_KM])
+# Longest names first so "medical district" wins over any shorter zone it contains
+_ZONE_PATTERN = re.compile("|".join(re.escape(zone) for zone in sorted(DELIVERY_ZONES, key=len, reverse=True)))
+
+# Courier availability from the last plan, in minutes after plannedAt
+dispatch_state: Dict[str, Any] = {"plannedAt": None, "courierFree": np.zeros(DISPATCH_COURIERS)}
+
+def delivery_zone(address: str) -> int:
+    """Index into ZONE_NAMES of the zone an address is in"""
+    match = _ZONE_PATTERN.search(address.lower())
+    return ZONE_NAMES.index(match.group(0)) if match else len(ZONE_NAMES) - 1
+
+def plan_deliveries(zones: np.ndarray, order_minutes: np.ndarray, couriers: int = DISPATCH_COURIERS):
+    """Batch orders into same-zone trips and spread the trips across couriers.
+
+    zones holds each order's zone index and order_minutes its age ordering key. Returns per-order
+    arrival minutes from now, courier and trip number, plus each courier's minutes until free.
+    """
+    n = len(zones)
+    if n == 0:
+        return np.zeros(0), np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(couriers)
+
+    # Oldest orders first within each zone, then cut each zone into trips of COURIER_BATCH_SIZE
+    by_zone = np.lexsort((order_minutes, zones))
+    sorted_zones = zones[by_zone]
+    _, zone_starts, zone_counts = np.unique(sorted_zones, return_index=True, return_counts=True)
+    rank = np.arange(n) - np.repeat(zone_starts, zone_counts)
+    _, trip_of, trip_sizes = np.unique(
+        sorted_zones * (n // COURIER_BATCH_SIZE + 1) + rank // COURIER_BATCH_SIZE, return_inverse=True, return_counts=True
+    )
+    trips = len(trip_sizes)
+    trip_zone = np.empty(trips, dtype=int)
+    trip_zone[trip_of] = sorted_zones
+    trip_oldest = np.full(trips, np.inf)
+    np.minimum.at(trip_oldest, trip_of, order_minutes[by_zone])
+
+    one_way = ZONE_DISTANCE_KM[trip_zone] / COURIER_SPEED_KMH * 60
+    duration = 2 * one_way + trip_sizes * STOP_MINUTES
+
+    # Trips holding the oldest orders leave first, dealt round-robin to couriers
+    priority = np.argsort(trip_oldest, kind="stable")
+    waves = -(-trips // couriers)
+    padded = np.zeros(waves * couriers)
+    padded[:trips] = duration[priority]
+    finish = np.cumsum(padded.reshape(waves, couriers), axis=0)
+    departure = np.empty(trips)
+    departure[priority] = HANDOVER_MINUTES + (finish.ravel() - padded)[:trips]
+    trip_courier = np.empty(trips, dtype=int)
+    trip_courier[priority] = np.arange(trips) % couriers
+
+    arrival = np.empty(n)
+    arrival[by_zone] = departure[trip_of] + one_way[trip_of] + (rank % COURIER_BATCH_SIZE + 1) * STOP_MINUTES
+    courier = np.empty(n, dtype=int)
+    courier[by_zone] = trip_courier[trip_of]
+    trip = np.empty(n, dtype=int)
+    trip[by_zone] = trip_of
+    return arrival, courier, trip, finish[-1]
+
+def quote_delivery(address: str, now: datetime) -> datetime:
+    """ETA for a new order from courier availability in the last dispatch plan"""
+    waited = (now - dispatch_state["plannedAt"]).total_seconds() / 60 if dispatch_state["plannedAt"] else 0.0
+    free = max(float(dispatch_state["courierFree"].min()) - waited, 0.0)
+    one_way = ZONE_DISTANCE_KM[delivery_zone(address)] / COURIER_SPEED_KMH * 60
+    return now + timedelta(minutes=HANDOVER_MINUTES + free + one_way + STOP_MINUTES)
+
+async def dispatch_orders() -> Dict[str, int]:
+    """Plan deliveries for every confirmed order and write changed ETAs back in one bulk write"""
+    now = datetime.now()
+    orders = await db.orders.find(
+        {"status": {"$in": DISPATCH_STATUSES}},
+        {"_id": 0, "id": 1, "deliveryAddress": 1, "orderDate": 1, "estimatedDelivery": 1}
+    ).to_list(DISPATCH_MAX_ORDERS)
+
+    zones = np.array([delivery_zone(order["deliveryAddress"]) for order in orders], dtype=int)
+    order_minutes = np.array([(order["orderDate"] - now).total_seconds() / 60 for order in orders])
+    arrival, courier, trip, courier_free = plan_deliveries(zones, order_minutes)
+    dispatch_state.update(plannedAt=now, courierFree=courier_free)
+
+    operations = []
+    for i, order in enumerate(orders):
+        eta = now + timedelta(minutes=float(arrival[i]))
+        previous = order.get("estimatedDelivery")
+        if previous and abs(eta - previous) < ETA_REWRITE_TOLERANCE:
+            continue
+        operations.append(UpdateOne(
+            {"id": order["id"], "status": {"$in": DISPATCH_STATUSES}},
+            {"$set": {
+                "estimatedDelivery": eta,
+                "dispatch": {"zone": ZONE_NAMES[zones[i]], "courier": int(courier[i]), "trip": int(trip[i]), "plannedAt": now}
+            }}
+        ))
+    if operations:
+        await db.orders.bulk_write(operations, ordered=False)
+    summary = {"orders": len(orders), "trips": int(trip.max()) + 1 if len(trip) else 0, "etasUpdated": len(operations)}
+    logger.info("Dispatch plan: %s", summary)
+    return summary
+
+async def dispatch_loop():
+    while True:
+        try:
+            if await hold_lease("dispatch", DISPATCH_INTERVAL):
+                await dispatch_orders()
+        except Exception:
+            logger.exception("Dispatch planning failed")
+        await asyncio.sleep(DISPATCH_INTERVAL)
+
+# Order archive
+# Delivered and cancelled orders older than ORDER_ARCHIVE_AFTER_DAYS move in batches to orders_archive,
+# a zstd-compressed collection, so the hot orders collection and its indexes only hold recent history.
+ORDER_ARCHIVE_AFTER_DAYS = int(os.environ.get("ORDER_ARCHIVE_AFTER_DAYS", 90))
+ORDER_ARCHIVE_INTERVAL = int(os.environ.get("ORDER_ARCHIVE_INTERVAL", 6 * 60 * 60))
+ORDER_ARCHIVE_BATCH = 500  # orders copied and deleted per round trip
+ARCHIVED_ORDER_STATUSES = [OrderStatus.DELIVERED.value, OrderStatus.CANCELLED.value]
+
+async def create_order_archive():
+    """Create orders_archive with zstd block compression; an existing collection is left as it is"""
+    try:
+        await db.raw.create_collection("orders_archive", storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}})
+    except CollectionInvalid:
+        pass
+
+async def archive_orders(max_batches: Optional[int] = None) -> Dict[str, Any]:
+    """Move old terminal orders from the hot collection to the archive.
+
+    Each batch is upserted into the archive by id before it is deleted from orders, so an
+    interrupted run leaves orders in both tiers, where hot-first reads still see each once.
+    """
+    cutoff = start_of_today() - timedelta(days=ORDER_ARCHIVE_AFTER_DAYS)
+    archived = batches = 0
+    while max_batches is None or batches < max_batches:
+        orders = await db.orders.find(
+            {"status": {"$in": ARCHIVED_ORDER_STATUSES}, "orderDate": {"$lt": cutoff}}, {"_id": 0}
+        ).sort("orderDate", 1).to_list(ORDER_ARCHIVE_BATCH)
+        if not orders:
+            break
+        archived_at = datetime.now()
+        await db.orders_archive.bulk_write(
+            [ReplaceOne({"id": order["id"]}, {**order, "archivedAt": archived_at}, upsert=True) for order in orders],
+            ordered=False
+        )
+        result = await db.orders.delete_many({"id": {"$in": [order["id"] for order in orders]}, "status": {"$in": ARCHIVED_ORDER_STATUSES}})
+        archived += result.deleted_count
+        batches += 1
+        if result.deleted_count == 0:
+            break
+    if archived:
+        logger.info("Archived %d orders placed before %s", archived, cutoff.date())
+    return {"archived": archived, "batches": batches, "cutoff": cutoff}
+
+async def order_archive_loop():
+    while True:
+        try:
+            if await hold_lease("order_archive", ORDER_ARCHIVE_INTERVAL):
+                await archive_orders()
+        except Exception:
+            logger.exception("Order archiving failed")
+        await asyncio.sleep(ORDER_ARCHIVE_INTERVAL)
+
+# Analytics export
+# Orders and prescriptions are copied from secondaries into date-partitioned Parquet files with one row
+# per order item or prescription line, so reports read files instead of scanning the primary.
+# Documents are exported once, as they stand when they settle; later status changes are exported from
+# the append-only order event log.
+# The default is outside the app tree but may be cleaned up by the OS; a wiped directory is exported
+# again from scratch, since the export state lives next to the files. Point it at durable storage.
+ANALYTICS_EXPORT_DIR = Path(os.environ.get(
+    "ANALYTICS_EXPORT_DIR", Path(tempfile.gettempdir()) / f"hospot-exports-{os.environ['DB_NAME']}"
+))
+ANALYTICS_EXPORT_INTERVAL = int(os.environ.get("ANALYTICS_EXPORT_INTERVAL", 60 * 60))
+ANALYTICS_EXPORT_BATCH = 5000  # source documents read per round trip, which bounds memory per run
+ANALYTICS_EXPORT_SETTLE = timedelta(minutes=5)  # newer documents may still be in flight or unreplicated
+
+def flatten_order(order: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "orderId": order["id"],
+            "userId": order["userId"],
+            "status": order["status"],
+            "paymentMethod": order["paymentMethod"],
+            "orderDate": order["orderDate"],
+            "estimatedDelivery": order.get("estimatedDelivery"),
+            "totalAmount": order["totalAmount"],
+            "line": line,
+            "medicineId": item["medicineId"],
+            "medicineName": item["medicineName"],
+            "price": item["price"],
+            "quantity": item["quantity"],
+            "prescriptionId": item.get("prescriptionId"),
+        }
+        for line, item in enumerate(order.get("items", []))
+    ]
+
+def flatten_order_event(event: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{
+        "eventId": event["id"],
+        "orderId": event["orderId"],
+        "userId": event["userId"],
+        "status": event["status"],
+        "previousStatus": event.get("previousStatus"),
+        "at": event["at"],
+    }]
+
+def flatten_prescription(prescription: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "prescriptionId": prescription["id"],
+            "userId": prescription["userId"],
+            "doctorName": prescription["doctorName"],
+            "hospitalName": prescription["hospitalName"],
+            "prescriptionDate": prescription["prescriptionDate"],
+            "createdAt": prescription["createdAt"],
+            "isUsed": prescription.get("isUsed", False),
+            "line": line,
+            "medicineId": medicine.get("medicineId"),
+            "medicineName": medicine.get("medicineName"),
+            "dosage": medicine.get("dosage"),
+            "duration": medicine.get("duration"),
+            "quantity": medicine.get("quantity"),
+            "quantityRemaining": medicine.get("quantityRemaining"),
+        }
+        for line, medicine in enumerate(prescription.get("medicines", []))
+    ]
+
+# dataset: (watermark field, row builder, column dtypes); fixed dtypes keep every file's schema identical
+ANALYTICS_DATASETS = {
+    "orders": ("orderDate", flatten_order, {
+        "orderId": "string", "userId": "string", "status": "string", "paymentMethod": "string",
+        "orderDate": "datetime64[ms]", "estimatedDelivery": "datetime64[ms]", "totalAmount": "float64",
+        "line": "int32", "medicineId": "string", "medicineName": "string", "price": "float64",
+        "quantity": "int32", "prescriptionId": "string",
+    }),
+    "prescriptions": ("createdAt", flatten_prescription, {
+        "prescriptionId": "string", "userId": "string", "doctorName": "string", "hospitalName": "string",
+        "prescriptionDate": "datetime64[ms]", "createdAt": "datetime64[ms]", "isUsed": "boolean",
+        "line": "int32", "medicineId": "string", "medicineName": "string", "dosage": "string",
+        "duration": "string", "quantity": "Int32", "quantityRemaining": "Int32",
+    }),
+    "order_events": ("at", flatten_order_event, {
+        "eventId": "string", "orderId": "string", "userId": "string", "status": "string",
+        "previousStatus": "string", "at": "datetime64[ms]",
+    }),
+}
+
+def read_export_state(directory: Path) -> Dict[str, Any]:
+    try:
+        return json.loads((directory / "_watermark.json").read_text())
+    except FileNotFoundError:
+        return {}
+
+def write_export_batch(directory: Path, partitions: Dict[str, Any], name: str, state: Dict[str, Any]):
+    """Write one batch's partition files, then move the watermark past them"""
+    for day, frame in partitions.items():
+        path = directory / f"date={day}" / name
+        path.parent.mkdir(exist_ok=True)
+        staging = path.with_name(path.name + ".tmp")
+        frame.to_parquet(staging, index=False)
+        os.replace(staging, path)
+    staging = directory / "_watermark.json.tmp"
+    staging.write_text(json.dumps(state))
+    os.replace(staging, directory / "_watermark.json")
+
+async def export_dataset(dataset: str) -> Dict[str, int]:
+    """Append documents newer than the dataset's watermark as Parquet files, one per batch and day.
+
+    The watermark is the (timestamp, _id) of the last exported document and only moves after the
+    batch's files are in place. _id breaks ties because it keeps one type while ids are migrated. File names come from the batch's first document, so a batch
+    repeated after a crash overwrites its earlier files instead of duplicating rows.
+    """
+    field, flatten, columns = ANALYTICS_DATASETS[dataset]
+    directory = ANALYTICS_EXPORT_DIR / dataset
+    directory.mkdir(parents=True, exist_ok=True)
+    state = read_export_state(directory)
+    settled = {field: {"$lt": datetime.now() - ANALYTICS_EXPORT_SETTLE}}
+    documents = rows = 0
+    while True:
+        query = settled
+        if state:
+            after = datetime.fromisoformat(state["watermark"])
+            query = {"$and": [settled, {"$or": [{field: {"$gt": after}}, {field: after, "_id": {"$gt": ObjectId(state["lastId"])}}]}]}
+        batch = await secondary_db[dataset].find(query).sort([(field, 1), ("_id", 1)]).to_list(ANALYTICS_EXPORT_BATCH)
+        if not batch:
+            break
+        frame = pd.DataFrame.from_records(
+            [row for document in batch for row in flatten(document)], columns=list(columns)
+        ).astype(columns)
+        partitions = {str(day): group for day, group in frame.groupby(frame[field].dt.date)} if len(frame) else {}
+        first, last = batch[0], batch[-1]
+        name = f"part-{first[field]:%Y%m%dT%H%M%S%f}-{first['_id']}.parquet"
+        state = {"watermark": last[field].isoformat(), "lastId": str(last["_id"]), "exportedAt": datetime.now().isoformat()}
+        await asyncio.to_thread(write_export_batch, directory, partitions, name, state)
+        documents += len(batch)
+        rows += len(frame)
+        if len(batch) < ANALYTICS_EXPORT_BATCH:
+            break
+    return {"documents": documents, "rows": rows}
+
+async def export_analytics() -> Dict[str, Any]:
+    """Export every dataset unless another worker or request already holds the export lock"""
+    ANALYTICS_EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(ANALYTICS_EXPORT_DIR / ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return {"skipped": "export already running"}
+        results = {dataset: await export_dataset(dataset) for dataset in ANALYTICS_DATASETS}
+    if any(result["documents"] for result in results.values()):
+        logger.info("Analytics export: %s", results)
+    return results
+
+async def analytics_export_loop():
+    while True:
+        try:
+            await export_analytics()
+        except Exception:
+            logger.exception("Analytics export failed")
+        await asyncio.sleep(ANALYTICS_EXPORT_INTERVAL)
+
+# Background jobs
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", 4))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+JOB_POLL_INTERVAL = 5  # seconds between polls when no enqueue has woken the workers
+JOB_LEASE = timedelta(minutes=5)  # a running job older than this belongs to a worker that died
+# Jobs can be written into an outbox field of the document they follow, in the same insert, and are
+# relayed to the queue after the response. Outboxes older than this were orphaned by a crash.
+OUTBOX_SWEEP_AGE = timedelta(minutes=1)
+OUTBOX_SWEEP_INTERVAL = 30
+
+class MongoJobBackend:
+    """Durable job store on a local collection; failed-out jobs move to a dead-letter collection"""
+
+    def __init__(self, collection: str = "jobs", dead_letter_collection: str = "dead_jobs"):
+        self.collection = collection
+        self.dead_letter_collection = dead_letter_collection
+
+    async def push(self, job: Dict[str, Any]):
+        await db[self.collection].insert_one(job)
+
+    async def claim(self) -> Optional[Dict[str, Any]]:
+        now = datetime.now()
+        return await db[self.collection].find_one_and_update(
+            {"$or": [
+                {"status": "pending", "runAt": {"$lte": now}},
+                {"status": "running", "leaseUntil": {"$lt": now}}
+            ]},
+            {"$set": {"status": "running", "leaseUntil": now + JOB_LEASE}, "$inc": {"attempts": 1}},
+            sort=[("runAt", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def complete(self, job: Dict[str, Any]):
+        await db[self.collection].delete_one({"id": job["id"]})
+
+    async def retry(self, job: Dict[str, Any], run_at: datetime, error: str):
+        await db[self.collection].update_one(
+            {"id": job["id"]},
+            {"$set": {"status": "pending", "runAt": run_at, "lastError": error}, "$unset": {"leaseUntil": ""}}
+        )
+
+    async def dead_letter(self, job: Dict[str, Any], error: str):
+        job.pop("leaseUntil", None)
+        await db[self.dead_letter_collection].insert_one({**job, "status": "dead", "lastError": error, "deadAt": datetime.now()})
+        await db[self.collection].delete_one({"id": job["id"]})
+
+class JobQueue:
+    """In-process async job queue for side effects that don't need to finish before the response"""
+
+    def __init__(self, backend, concurrency: int = JOB_CONCURRENCY, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.backend = backend
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.handlers: Dict[str, Any] = {}
+        self.limits: Dict[str, asyncio.Semaphore] = {}
+        self.wakeup = asyncio.Event()
+        self.workers: List[asyncio.Task] = []
+        self.outbox_collections: List[str] = []
+        self.relays: set = set()
+
+    def task(self, name: str, concurrency: Optional[int] = None):
+        """Register a handler; concurrency caps how many jobs of this kind run at once"""
+        def register(handler):
+            self.handlers[name] = handler
+            if concurrency:
+                self.limits[name] = asyncio.Semaphore(concurrency)
+            return handler
+        return register
+
+    def job(self, name: str, **payload) -> Dict[str, Any]:
+        """A job document, to enqueue or to write into an outbox"""
+        if name not in self.handlers:
+            raise ValueError(f"No job handler registered for {name}")
+        return {
             "id": str(uuid.uuid4()),
-            "userId": user_id,
-            "items": [item.dict()],
-            "totalAmount": item.price * item.quantity,
-            "updatedAt": datetime.now()
+            "name": name,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "runAt": datetime.now(),
+            "createdAt": datetime.now()
         }
-        await db.carts.insert_one(cart_dict)
-    else:
-        # Update existing cart
-        items = cart.get("items", [])
-        existing_item = None
-        
-        for i, existing in enumerate(items):
-            if existing["medicineId"] == item.medicineId:
-                existing_item = i
-                break
-        
-        if existing_item is not None:
-            # Update quantity if item exists
-            items[existing_item]["quantity"] += item.quantity
+
+    async def enqueue(self, name: str, **payload):
+        await self.backend.push(self.job(name, **payload))
+        self.wakeup.set()
+
+    def relay_outbox(self, collection: str, doc_id: str, outbox: List[Dict[str, Any]]):
+        """Move the jobs in a just-written document's outbox to the queue without holding up the caller"""
+        task = asyncio.create_task(self._relay(collection, doc_id, outbox))
+        self.relays.add(task)
+        task.add_done_callback(self.relays.discard)
+
+    async def _relay(self, collection: str, doc_id: str, outbox: List[Dict[str, Any]]):
+        try:
+            for job in outbox:
+                try:
+                    await self.backend.push(job)
+                except DuplicateKeyError:
+                    pass  # relayed before the outbox was cleared
+            await db[collection].update_one({"id": doc_id}, {"$unset": {"outbox": ""}})
+            self.wakeup.set()
+        except Exception:
+            logger.exception("Failed to relay the outbox of %s %s; the sweep will retry", collection, doc_id)
+
+    async def _sweep_outboxes(self):
+        while True:
+            await asyncio.sleep(OUTBOX_SWEEP_INTERVAL)
+            cutoff = datetime.now() - OUTBOX_SWEEP_AGE
+            for collection in self.outbox_collections:
+                try:
+                    orphaned = await db[collection].find({"outbox.createdAt": {"$lt": cutoff}}, {"_id": 0, "id": 1, "outbox": 1}).to_list(100)
+                except Exception:
+                    logger.exception("Outbox sweep of %s failed", collection)
+                    continue
+                for doc in orphaned:
+                    await self._relay(collection, doc["id"], doc["outbox"])
+
+    def start(self):
+        self.workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+        self.workers.append(asyncio.create_task(self._sweep_outboxes()))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def _work(self):
+        while True:
+            # Clear before claiming so an enqueue that lands mid-claim still wakes us
+            self.wakeup.clear()
+            try:
+                job = await self.backend.claim()
+            except Exception:
+                logger.exception("Failed to claim job")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Dict[str, Any]):
+        handler = self.handlers.get(job["name"])
+        if handler is None:
+            await self.backend.dead_letter(job, f"No job handler registered for {job['name']}")
+            return
+        try:
+            limit = self.limits.get(job["name"])
+            if limit:
+                async with limit:
+                    await handler(**job["payload"])
+            else:
+                await handler(**job["payload"])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job["attempts"] >= self.max_attempts:
+                logger.error("Job %s (%s) dead-lettered after %d attempts: %s", job["id"], job["name"], job["attempts"], error)
+                await self.backend.dead_letter(job, error)
+            else:
+                # Exponential backoff: 2s, 4s, 8s ... capped at five minutes
+                delay = min(2 ** job["attempts"], 300)
+                await self.backend.retry(job, datetime.now() + timedelta(seconds=delay), error)
+            return
+        await self.backend.complete(job)
+
+jobs = JobQueue(MongoJobBackend())
+jobs.outbox_collections.append("orders")
+
+# Idempotent request handling
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+IDEMPOTENCY_PENDING_TIMEOUT = timedelta(seconds=60)  # a claim this old belongs to a request that died
+
+async def run_idempotent(scope: str, key: Optional[str], payload: BaseModel, handler):
+    """Run handler once per (scope, key); replays get the stored response without re-running it.
+
+    handler is passed a commit coroutine to await with its response as soon as its main effect is
+    durable. A committed key is never released, so a failure in follow-up work can't let a retry
+    repeat the effect. Handlers shield the write and commit from cancellation, so a cancelled request
+    leaves its key pending rather than released: the shielded work may still land and commit.
+    """
+    if not key:
+        async def skip_commit(response):
+            pass
+        return await handler(skip_commit)
+
+    record_id = f"{scope}:{key}"
+    fingerprint = hashlib.sha256(payload.json().encode()).hexdigest()
+    now = datetime.now()
+    # Claim the key and learn whether it was already used in a single indexed round trip
+    existing = await db.idempotency_keys.find_one_and_update(
+        {"_id": record_id},
+        {"$setOnInsert": {"fingerprint": fingerprint, "state": "pending", "createdAt": now}},
+        upsert=True
+    )
+    if existing:
+        if existing["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency key was already used for a different request")
+        if existing["state"] == "done":
+            return existing["response"]
+        retaken = None
+        if existing["createdAt"] < now - IDEMPOTENCY_PENDING_TIMEOUT:
+            retaken = await db.idempotency_keys.find_one_and_update(
+                {"_id": record_id, "state": "pending", "createdAt": existing["createdAt"]},
+                {"$set": {"createdAt": now}}
+            )
+        if retaken is None:
+            raise HTTPException(status_code=409, detail="A request with this idempotency key is still in progress")
+
+    committed = []
+
+    async def commit(response):
+        committed.append(response)
+        await db.idempotency_keys.update_one(
+            {"_id": record_id},
+            {"$set": {"state": "done", "response": jsonable_encoder(response)}}
+        )
+
+    try:
+        response = await handler(commit)
+    except asyncio.CancelledError:
+        # A retry sees the request in progress until the shielded work commits, or until
+        # IDEMPOTENCY_PENDING_TIMEOUT lets it take the key over
+        raise
+    except BaseException:
+        if not committed:
+            # Release the key so the client can retry a failed or cancelled request
+            await asyncio.shield(db.idempotency_keys.delete_one({"_id": record_id}))
+        raise
+    if not committed or committed[-1] is not response:
+        await commit(response)
+    return response
+
+# Prescription redemption
+REDEEM_ATTEMPTS = 3  # compare-and-set retries when concurrent redemptions touch the same prescription
+
+def plan_redemption(medicines: List[Dict[str, Any]], lines: List[PrescriptionLineRedemption]) -> tuple:
+    """(units to take from each prescription line, requested lines that can't be covered).
+
+    A medicine reference takes from the first line for that medicine with enough left, so
+    duplicate lines for one medicine are never both charged. No lines takes everything left.
+    """
+    remaining = [max(line.get("quantityRemaining") or 0, 0) for line in medicines]
+    if not lines:
+        return remaining, []
+    taken, uncovered = [0] * len(medicines), []
+    for line in lines:
+        if line.line is not None:
+            candidates = [line.line] if 0 <= line.line < len(medicines) else []
         else:
-            # Add new item
-            items.append(item.dict())
-        
-        # Calculate total
-        total_amount = sum(i["price"] * i["quantity"] for i in items)
-        
-        await db.carts.update_one(
-            {"userId": user_id},
+            candidates = [i for i, medicine in enumerate(medicines) if medicine.get("medicineId") == line.medicineId]
+        index = next((i for i in candidates if remaining[i] - taken[i] >= line.quantity), None)
+        if index is None:
+            uncovered.append(line)
+        else:
+            taken[index] += line.quantity
+    return taken, uncovered
+
+async def redeem_prescription(prescription_id: str, lines: List[PrescriptionLineRedemption], user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Take quantities off prescription lines with a compare-and-set on every line's remaining quantity.
+
+    Because the update only applies to the quantities it was planned from, it can also set isUsed
+    in the same write once nothing is left. Returns the updated prescription, or None if it is
+    missing, used, or can't cover every line.
+    """
+    query: Dict[str, Any] = {"id": prescription_id, "isUsed": False}
+    if user_id:
+        query["userId"] = user_id
+    for _ in range(REDEEM_ATTEMPTS):
+        prescription = await db.prescriptions.find_one(query, {"_id": 0, "medicines.medicineId": 1, "medicines.quantityRemaining": 1})
+        if prescription is None:
+            return None
+        medicines = prescription.get("medicines", [])
+        taken, uncovered = plan_redemption(medicines, lines)
+        if uncovered:
+            return None
+        observed = [line.get("quantityRemaining") for line in medicines]
+        update: Dict[str, Any] = {"$set": {
+            "isUsed": all((remaining or 0) - units <= 0 for remaining, units in zip(observed, taken))
+        }}
+        if any(taken):
+            update["$inc"] = {f"medicines.{i}.quantityRemaining": -units for i, units in enumerate(taken) if units}
+        updated = await db.prescriptions.find_one_and_update(
+            {**query, **{f"medicines.{i}.quantityRemaining": remaining for i, remaining in enumerate(observed)}},
+            update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated:
+            return updated
+    return None
+
+async def restore_prescription(prescription_id: str, lines: List[PrescriptionLineRedemption]):
+    """Give back quantities taken by redeem_prescription when the order they were for fails; lines are given by index"""
+    await db.prescriptions.update_one(
+        {"id": prescription_id},
+        {"$inc": {f"medicines.{line.line}.quantityRemaining": line.quantity for line in lines}, "$set": {"isUsed": False}}
+    )
+
+async def raise_redemption_failure(prescription_id: str):
+    """Explain why a redemption matched nothing; only runs on the failure path"""
+    prescription = await db.prescriptions.find_one({"id": prescription_id}, {"_id": 0, "isUsed": 1})
+    if not prescription:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    if prescription.get("isUsed"):
+        raise HTTPException(status_code=409, detail="Prescription has already been used")
+    raise HTTPException(status_code=409, detail="Prescription does not cover the requested quantities")
+
+async def consume_order_prescriptions(user_id: str, items: List[OrderItem]) -> Dict[str, List[PrescriptionLineRedemption]]:
+    """Validate every prescription referenced by an order with one query, then redeem the linked lines.
+
+    Lines without a catalog medicineId can't be matched to items, so for those the
+    prescription only has to belong to the user and be unused.
+    """
+    wanted: Dict[str, Dict[str, int]] = {}
+    for item in items:
+        if item.prescriptionId:
+            lines = wanted.setdefault(item.prescriptionId, {})
+            lines[item.medicineId] = lines.get(item.medicineId, 0) + item.quantity
+    if not wanted:
+        return {}
+
+    prescriptions = await db.prescriptions.find(
+        {"id": {"$in": list(wanted)}},
+        {"_id": 0, "id": 1, "userId": 1, "isUsed": 1, "medicines.medicineId": 1, "medicines.quantityRemaining": 1}
+    ).to_list(len(wanted))
+    prescriptions = {prescription["id"]: prescription for prescription in prescriptions}
+
+    problems = []
+    redemptions: Dict[str, List[PrescriptionLineRedemption]] = {}
+    for prescription_id, quantities in wanted.items():
+        prescription = prescriptions.get(prescription_id)
+        if prescription is None or prescription["userId"] != user_id:
+            problems.append(f"Prescription {prescription_id} not found")
+            continue
+        if prescription.get("isUsed"):
+            problems.append(f"Prescription {prescription_id} has already been used")
+            continue
+        medicines = prescription.get("medicines", [])
+        linked = {line.get("medicineId") for line in medicines}
+        requested = [
+            PrescriptionLineRedemption(medicineId=medicine_id, quantity=quantity)
+            for medicine_id, quantity in quantities.items() if medicine_id in linked
+        ]
+        if not requested:
+            continue
+        taken, uncovered = plan_redemption(medicines, requested)
+        for line in uncovered:
+            problems.append(f"Prescription {prescription_id} does not cover {line.quantity} of medicine {line.medicineId}")
+        lines = [PrescriptionLineRedemption(line=i, quantity=units) for i, units in enumerate(taken) if units]
+        if lines and not uncovered:
+            redemptions[prescription_id] = lines
+    if problems:
+        raise HTTPException(status_code=409, detail={"message": "Prescription check failed", "problems": problems})
+
+    results = await asyncio.gather(*(
+        redeem_prescription(prescription_id, lines, user_id) for prescription_id, lines in redemptions.items()
+    ))
+    if not all(results):
+        # Lost a race with another checkout; hand back whatever this one took
+        await asyncio.gather(*(
+            restore_prescription(prescription_id, lines)
+            for (prescription_id, lines), result in zip(redemptions.items(), results) if result
+        ))
+        raise HTTPException(status_code=409, detail="Prescription was redeemed by another order")
+    return redemptions
+
+async def backfill_prescription_quantities():
+    """Give prescriptions created before per-line tracking a single unit per line"""
+    await db.prescriptions.update_many(
+        {"medicines": {"$elemMatch": {"quantityRemaining": {"$exists": False}}}},
+        {"$set": {"medicines.$[line].quantity": 1, "medicines.$[line].quantityRemaining": 1}},
+        array_filters=[{"line.quantityRemaining": {"$exists": False}}]
+    )
+
+# Shopping Cart storage
+EMPTY_CART_TTL = timedelta(days=7)  # empty carts are dropped by the TTL index after this long
+
+def cart_items_update(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Update document replacing a cart's items; empty carts are given an expiry for the TTL index"""
+    now = datetime.now()
+    update = {
+        "$set": {
+            "items": items,
+            "totalAmount": sum(i["price"] * i["quantity"] for i in items),
+            "updatedAt": now
+        }
+    }
+    if items:
+        update["$unset"] = {"expiresAt": ""}
+    else:
+        update["$set"]["expiresAt"] = now + EMPTY_CART_TTL
+    return update
+
+async def dedupe_carts():
+    """Keep the most recently updated cart per user; duplicates predate the unique userId index"""
+    async for group in db.carts.raw.aggregate([
+        {"$sort": {"updatedAt": -1}},
+        {"$group": {"_id": "$userId", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True):
+        await db.carts.raw.delete_many({"_id": {"$in": group["ids"][1:]}})
+        logger.warning("Removed %d duplicate carts for user %s", group["count"] - 1, group["_id"])
+
+@jobs.task("record_order_events")
+async def record_order_events_job(events: List[Dict[str, Any]]):
+    # Events keep their ids, so a retried job can't log one twice
+    recorded = {event["id"] for event in await db.order_events.find({"id": {"$in": [e["id"] for e in events]}}, {"_id": 0, "id": 1}).to_list(None)}
+    await record_order_events([OrderEvent(**event) for event in events if event["id"] not in recorded])
+
+@jobs.task("clear_cart")
+async def clear_cart_after_order(user_id: str, ordered_at: datetime):
+    """Empty the cart an order was placed from, unless the user has changed it since"""
+    await db.carts.update_one(
+        {"userId": user_id, "$or": [{"updatedAt": {"$lte": ordered_at}}, {"updatedAt": {"$exists": False}}]},
+        cart_items_update([])
+    )
+
+async def add_cart_item(user_id: str, item: CartItem) -> Dict[str, Any]:
+    """Add an item in place, upserting the cart if the user has none yet; returns the updated cart"""
+    line_total = item.price * item.quantity
+    now = datetime.now()
+    # Bump the quantity if the medicine is already in the cart
+    increment = (
+        {"userId": user_id, "items.medicineId": item.medicineId},
+        {
+            "$inc": {"items.$.quantity": item.quantity, "totalAmount": line_total},
+            "$set": {"updatedAt": now},
+            "$unset": {"expiresAt": ""}
+        }
+    )
+    cart = await db.carts.find_one_and_update(*increment, return_document=ReturnDocument.AFTER)
+    if cart:
+        return cart
+    try:
+        return await db.carts.find_one_and_update(
+            {"userId": user_id, "items.medicineId": {"$ne": item.medicineId}},
             {
-                "$set": {
-                    "items": items,
-                    "totalAmount": total_amount,
-                    "updatedAt": datetime.now()
-                }
-            }
+                "$push": {"items": item.dict()},
+                "$inc": {"totalAmount": line_total},
+                "$set": {"updatedAt": now},
+                "$unset": {"expiresAt": ""},
+                "$setOnInsert": {"id": str(uuid.uuid4())}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
         )
-    
-    return {"message": "Item added to cart"}
+    except DuplicateKeyError:
+        # A concurrent request added the same medicine between the two updates
+        return await db.carts.find_one_and_update(*increment, return_document=ReturnDocument.AFTER)
+
+# Shopping Cart API Routes
+@api_router.get("/cart/{user_id}", response_model=Cart)
+async def get_cart(user_id: str):
+    """Get user's shopping cart"""
+    cart = await db.carts.find_one({"userId": user_id})
+    if not cart:
+        # Carts are only stored once something is added; until then return an empty one
+        return Cart(userId=user_id)
+    return Cart(**cart)
+
+async def require_sellable(medicine_id: str):
+    """404 for a medicine not in the catalog, 409 for one with no unexpired stock"""
+    medicine = await db.medicines.find_one({"id": medicine_id}, {"_id": 0, "expiryDate": 1})
+    if not medicine:
+        raise HTTPException(status_code=404, detail="Medicine not found")
+    if str(medicine["expiryDate"])[:10] < start_of_today().date().isoformat():
+        raise HTTPException(status_code=409, detail="Medicine is expired or no longer available")
+
+@api_router.post("/cart/{user_id}/add")
+async def add_to_cart(user_id: str, item: CartItem, idempotency_key: Optional[str] = Header(None)):
+    """Add item to cart, creating the cart on first use"""
+    async def add(commit):
+        await require_sellable(item.medicineId)
+        response = {"message": "Item added to cart"}
+        # Checked before the write, so the stored response and a replay of it carry the same warnings
+        if INTERACTION_CHECK_MODE != "off":
+            cart = await db.carts.find_one({"userId": user_id}, {"_id": 0, "items.medicineId": 1})
+            basket = [line["medicineId"] for line in (cart or {}).get("items", [])] + [item.medicineId]
+            response["interactions"] = await find_interactions(list(dict.fromkeys(basket)), user_id, skip_unknown=True)
+        async def write():
+            await add_cart_item(user_id, item)
+            await commit(response)
+        await asyncio.shield(write())
+        return response
+
+    return await run_idempotent(f"cart:{user_id}", idempotency_key, item, add)
 
 @api_router.put("/cart/{user_id}/update")
 async def update_cart_item(user_id: str, medicine_id: str, quantity: int):
@@ -978,19 +4027,7 @@ async def update_cart_item(user_id: str, medicine_id: str, quantity: int):
                 item["quantity"] = quantity
             break
     
-    # Calculate total
-    total_amount = sum(i["price"] * i["quantity"] for i in items)
-    
-    await db.carts.update_one(
-        {"userId": user_id},
-        {
-            "$set": {
-                "items": items,
-                "totalAmount": total_amount,
-                "updatedAt": datetime.now()
-            }
-        }
-    )
+    await db.carts.update_one({"userId": user_id}, cart_items_update(items))
     
     return {"message": "Cart updated"}
 
@@ -1004,65 +4041,77 @@ async def remove_from_cart(user_id: str, medicine_id: str):
     items = cart.get("items", [])
     items = [item for item in items if item["medicineId"] != medicine_id]
     
-    # Calculate total
-    total_amount = sum(i["price"] * i["quantity"] for i in items)
-    
-    await db.carts.update_one(
-        {"userId": user_id},
-        {
-            "$set": {
-                "items": items,
-                "totalAmount": total_amount,
-                "updatedAt": datetime.now()
-            }
-        }
-    )
+    await db.carts.update_one({"userId": user_id}, cart_items_update(items))
     
     return {"message": "Item removed from cart"}
 
 @api_router.delete("/cart/{user_id}/clear")
 async def clear_cart(user_id: str):
     """Clear user's cart"""
-    await db.carts.update_one(
-        {"userId": user_id},
-        {
-            "$set": {
-                "items": [],
-                "totalAmount": 0.0,
-                "updatedAt": datetime.now()
-            }
-        }
-    )
+    await db.carts.update_one({"userId": user_id}, cart_items_update([]))
     return {"message": "Cart cleared"}
 
 # Order API Routes
 @api_router.post("/orders", response_model=Order)
-async def create_order(order: OrderCreate):
-    """Create a new order"""
+async def create_order(order: OrderCreate, idempotency_key: Optional[str] = Header(None)):
+    """Create a new order; a retry with the same Idempotency-Key returns the original order"""
+    return await run_idempotent(f"orders:{order.userId}", idempotency_key, order, lambda commit: place_order(order, commit))
+
+async def store_order(order_dict: Dict[str, Any], order: OrderCreate, commit) -> Order:
+    """Redeem the order's prescriptions and insert it, giving the prescriptions back if the insert fails"""
+    redemptions = await consume_order_prescriptions(order.userId, order.items)
+    try:
+        await db.orders.insert_one(order_dict)
+    except BaseException:
+        await asyncio.shield(asyncio.gather(*(restore_prescription(pid, lines) for pid, lines in redemptions.items())))
+        raise
+    created = Order(**order_dict)
+    await commit(created)
+    return created
+
+async def place_order(order: OrderCreate, commit):
     order_dict = order.dict()
     order_dict["id"] = str(uuid.uuid4())
     order_dict["orderDate"] = datetime.now()
     order_dict["status"] = OrderStatus.PENDING
     
-    # Set estimated delivery (2-3 days from now)
-    from datetime import timedelta
-    order_dict["estimatedDelivery"] = datetime.now() + timedelta(days=2)
+    # Provisional estimate until the dispatcher plans the order's trip
+    order_dict["estimatedDelivery"] = quote_delivery(order.deliveryAddress, order_dict["orderDate"])
     
-    await db.orders.insert_one(order_dict)
+    medicine_ids = list({item.medicineId for item in order.items})
+    sellable = await db.medicines.find(
+        {"id": {"$in": medicine_ids}, "expiryDate": {"$gte": start_of_today()}}, {"_id": 0, "id": 1}
+    ).to_list(len(medicine_ids))
+    unavailable = set(medicine_ids) - {medicine["id"] for medicine in sellable}
+    if unavailable:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Some items are expired or no longer available", "medicineIds": sorted(unavailable)}
+        )
     
-    # Clear user's cart after order
-    await db.carts.update_one(
-        {"userId": order.userId},
-        {
-            "$set": {
-                "items": [],
-                "totalAmount": 0.0,
-                "updatedAt": datetime.now()
-            }
-        }
-    )
+    if INTERACTION_CHECK_MODE != "off":
+        interactions = await find_interactions([item.medicineId for item in order.items], order.userId)
+        if INTERACTION_CHECK_MODE == "block" and any(i["severity"] == InteractionSeverity.MAJOR for i in interactions):
+            raise HTTPException(
+                status_code=409,
+                detail={"message": "Order contains medicines with major interactions", "interactions": interactions}
+            )
+        order_dict["interactionWarnings"] = interactions
+    
+    # Follow-up work is written with the order in one insert and relayed to the job queue afterwards
+    created_event = OrderEvent(orderId=order_dict["id"], userId=order.userId, status=OrderStatus.PENDING, at=order_dict["orderDate"])
+    order_dict["outbox"] = [
+        jobs.job("record_order_events", events=[created_event.dict()]),
+        jobs.job("clear_cart", user_id=order.userId, ordered_at=order_dict["orderDate"]),
+    ]
     
-    return Order(**order_dict)
+    # Shielded so a client disconnect can't stop it between taking prescriptions and storing the order
+    created = await asyncio.shield(store_order(order_dict, order, commit))
+    jobs.relay_outbox("orders", order_dict["id"], order_dict["outbox"])
+    for item in order.items:
+        bump_medicine_popularity(item.medicineId, item.quantity)
+    
+    return created
 
 @api_router.get("/orders/user/{user_id}", response_model=List[Order])
 async def get_user_orders(user_id: str):
@@ -1070,30 +4119,811 @@ async def get_user_orders(user_id: str):
     orders = await db.orders.find({"userId": user_id}).sort("orderDate", -1).to_list(100)
     return [Order(**order) for order in orders]
 
+@api_router.get("/orders/user/{user_id}/history", response_model=List[Order])
+async def get_user_order_history(
+    user_id: str,
+    before: Optional[datetime] = Query(None, description="orderDate of the last order on the previous page"),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """Get a page of a user's archived orders, newest first"""
+    query: Dict[str, Any] = {"userId": user_id}
+    if before:
+        query["orderDate"] = {"$lt": before}
+    orders = await db.orders_archive.find(query, {"_id": 0}).sort("orderDate", -1).to_list(limit)
+    return [Order(**order) for order in orders]
+
 @api_router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str):
     """Get a specific order by ID"""
-    order = await db.orders.find_one({"id": order_id})
+    order = await db.orders.find_one({"id": order_id}) or await db.orders_archive.find_one({"id": order_id})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     return Order(**order)
 
+@api_router.get("/orders/{order_id}/events", response_model=List[OrderEvent])
+async def get_order_events(order_id: str):
+    """Get an order's status history, oldest first"""
+    events = await db.order_events.find({"orderId": order_id}, {"_id": 0}).sort("at", 1).to_list(100)
+    return [OrderEvent(**event) for event in events]
+
+@api_router.get("/orders/user/{user_id}/stream")
+async def stream_user_orders(user_id: str, last_event_id: Optional[str] = Header(None)):
+    """Server-sent events for status changes on a user's orders; replays anything after Last-Event-ID"""
+    subscriber = order_events.subscribe(user_id)
+    missed = []
+    if last_event_id:
+        last = await db.order_events.find_one({"id": last_event_id, "userId": user_id})
+        if last:
+            missed = await db.order_events.find(
+                {"userId": user_id, "at": {"$gte": last["at"]}, "id": {"$ne": last_event_id}}, {"_id": 0}
+            ).sort("at", 1).to_list(1000)
+
+    # The subscription is taken before the replay query, so an event can arrive both ways
+    replayed = {event["id"] for event in missed}
+
+    async def stream():
+        try:
+            for event in missed:
+                yield order_event_message(OrderEvent(**event))
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.get(), ORDER_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                if event.id in replayed:
+                    continue
+                yield order_event_message(event)
+        finally:
+            order_events.unsubscribe(user_id, subscriber)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@api_router.post("/orders/status/bulk", response_model=BulkOrderStatusResponse)
+async def bulk_update_order_status(request: BulkOrderStatusUpdate):
+    """Move many orders to one status with a single bulk write, reporting the outcome per order"""
+    if request.orderIds:
+        if len(request.orderIds) > BULK_STATUS_LIMIT:
+            raise HTTPException(status_code=422, detail=f"At most {BULK_STATUS_LIMIT} orders per request")
+        order_ids = list(dict.fromkeys(request.orderIds))
+        query: Dict[str, Any] = {"id": {"$in": order_ids}}
+    elif request.filter:
+        query = {"status": request.filter.status.value}
+        if request.filter.userId:
+            query["userId"] = request.filter.userId
+        if request.filter.orderedBefore:
+            query["orderDate"] = {"$lt": request.filter.orderedBefore}
+    else:
+        raise HTTPException(status_code=422, detail="Provide orderIds or a filter")
+
+    orders = await db.orders.find(query, {"_id": 0, "id": 1, "userId": 1, "status": 1}).sort("orderDate", 1).to_list(BULK_STATUS_LIMIT)
+    if not request.orderIds:
+        order_ids = [order["id"] for order in orders]
+    found = {order["id"]: order for order in orders}
+
+    now = datetime.now()
+    results: Dict[str, OrderStatusResult] = {}
+    operations = []
+    for order_id in order_ids:
+        order = found.get(order_id)
+        if not order:
+            results[order_id] = OrderStatusResult(orderId=order_id, outcome=OrderStatusOutcome.NOT_FOUND)
+            continue
+        current = OrderStatus(order["status"])
+        if request.status not in ORDER_TRANSITIONS[current]:
+            results[order_id] = OrderStatusResult(orderId=order_id, outcome=OrderStatusOutcome.INVALID_TRANSITION, previousStatus=current)
+            continue
+        results[order_id] = OrderStatusResult(orderId=order_id, outcome=OrderStatusOutcome.UPDATED, previousStatus=current)
+        operations.append(UpdateOne(
+            {"id": order_id, "status": current.value},
+            {"$set": {"status": request.status.value, "statusUpdatedAt": now}}
+        ))
+
+    if operations:
+        result = await db.orders.bulk_write(operations, ordered=False)
+        if result.modified_count < len(operations):
+            # Some orders moved between our read and the write; find which ones took our update
+            pending = [order_id for order_id, r in results.items() if r.outcome == OrderStatusOutcome.UPDATED]
+            applied = await db.orders.find(
+                {"id": {"$in": pending}, "status": request.status.value, "statusUpdatedAt": now}, {"_id": 0, "id": 1}
+            ).to_list(len(pending))
+            applied_ids = {order["id"] for order in applied}
+            for order_id in pending:
+                if order_id not in applied_ids:
+                    results[order_id].outcome = OrderStatusOutcome.CONFLICT
+
+    updated = [r for r in results.values() if r.outcome == OrderStatusOutcome.UPDATED]
+    await record_order_events([
+        OrderEvent(orderId=r.orderId, userId=found[r.orderId]["userId"], status=request.status, previousStatus=r.previousStatus, at=now)
+        for r in updated
+    ])
+    return BulkOrderStatusResponse(status=request.status, updated=len(updated), results=[results[order_id] for order_id in order_ids])
+
 @api_router.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: OrderStatus):
     """Update order status"""
+    order = await db.orders.find_one({"id": order_id}, {"_id": 0, "userId": 1, "status": 1})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    current = OrderStatus(order["status"])
+    if status not in ORDER_TRANSITIONS[current]:
+        raise HTTPException(status_code=409, detail=f"Cannot move order from {current.value} to {status.value}")
+    # Only apply the change if nobody else moved the order in the meantime
     result = await db.orders.update_one(
-        {"id": order_id},
-        {"$set": {"status": status.value}}
+        {"id": order_id, "status": current.value},
+        {"$set": {"status": status.value, "statusUpdatedAt": datetime.now()}}
     )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Order not found")
+    if result.modified_count == 0:
+        raise HTTPException(status_code=409, detail="Order status changed concurrently, please retry")
+    await record_order_events([OrderEvent(orderId=order_id, userId=order["userId"], status=status, previousStatus=current)])
     return {"message": f"Order status updated to {status.value}"}
 
+# Inventory API Routes
+@api_router.get("/inventory/alerts", response_model=List[InventoryAlert])
+async def get_inventory_alerts(type: Optional[InventoryAlertType] = Query(None, description="Filter by alert type")):
+    """Get unresolved low-stock and near-expiry alerts"""
+    query: Dict[str, Any] = {"resolved": False}
+    if type:
+        query["type"] = type.value
+    alerts = await db.inventory_alerts.find(query, {"_id": 0}).sort("detectedAt", -1).to_list(1000)
+    return [InventoryAlert(**alert) for alert in alerts]
+
+# Admin API Routes
+@api_router.post("/admin/recommendations/rebuild")
+async def rebuild_recommendations_job(background_tasks: BackgroundTasks):
+    """Recompute "frequently bought together" recommendations from order history"""
+    background_tasks.add_task(rebuild_recommendations)
+    return {"message": "Recommendation rebuild started"}
+
+@api_router.get("/admin/jobs/dead")
+async def get_dead_jobs(limit: int = Query(100, ge=1, le=1000)):
+    """List background jobs that exhausted their retries"""
+    return await db.dead_jobs.find({}, {"_id": 0}).sort("deadAt", -1).to_list(limit)
+
+@api_router.post("/admin/jobs/dead/{job_id}/retry")
+async def retry_dead_job(job_id: str):
+    """Put a dead-lettered job back on the queue with a fresh attempt count"""
+    job = await db.dead_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    await jobs.enqueue(job["name"], **job["payload"])
+    await db.dead_jobs.delete_one({"id": job_id})
+    return {"message": f"Job {job['name']} requeued"}
+
+@api_router.get("/admin/profile")
+async def get_profile_summary():
+    """Profiled request and sample counts per route"""
+    return {
+        route: {"requests": request_profiler.requests[route], "samples": sum(stacks.values())}
+        for route, stacks in request_profiler.routes.items()
+    }
+
+@api_router.get("/admin/profile/flamegraph")
+async def get_profile_flamegraph(route: Optional[str] = Query(None, description='Route such as "GET /api/hospitals"; all routes when omitted')):
+    """Aggregated stacks in folded format, ready for flamegraph.pl or speedscope"""
+    if route and route not in request_profiler.routes:
+        raise HTTPException(status_code=404, detail="No samples for this route")
+    return Response(content=request_profiler.folded(route), media_type="text/plain")
+
+@api_router.delete("/admin/profile")
+async def reset_profile():
+    """Discard collected profiles"""
+    request_profiler.routes.clear()
+    request_profiler.requests.clear()
+    return {"message": "Profiles cleared"}
+
+@api_router.get("/admin/traces")
+async def list_traces(limit: int = 50):
+    """Most recent root spans from the in-memory exporter"""
+    exporter = span_processor.exporter
+    if not isinstance(exporter, InMemorySpanExporter):
+        raise HTTPException(status_code=404, detail="Traces are not kept in memory; set TRACE_EXPORTER=memory")
+    roots = [span for span in list(exporter.spans) if "http.method" in span.attributes]
+    return {"dropped": span_processor.dropped, "traces": [span.to_dict() for span in roots[-limit:][::-1]]}
+
+@api_router.get("/admin/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Spans of one trace from the in-memory exporter, in start order"""
+    exporter = span_processor.exporter
+    if not isinstance(exporter, InMemorySpanExporter):
+        raise HTTPException(status_code=404, detail="Traces are not kept in memory; set TRACE_EXPORTER=memory")
+    spans = exporter.trace(trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return [span.to_dict() for span in spans]
+
+@api_router.get("/admin/loop")
+async def get_loop_lag():
+    """Event loop lag summary and the stacks captured during recent stalls"""
+    return {
+        "samples": loop_watchdog.lag_count,
+        "meanSeconds": loop_watchdog.lag_sum / loop_watchdog.lag_count if loop_watchdog.lag_count else 0.0,
+        "maxSeconds": loop_watchdog.lag_max,
+        "buckets": dict(zip(map(str, LOOP_LAG_BUCKETS), loop_watchdog.bucket_counts)),
+        "stalls": list(reversed(loop_watchdog.stalls)),
+    }
+
+@api_router.get("/admin/metrics")
+async def get_metrics():
+    """Event loop and logging metrics in Prometheus text format"""
+    return Response(content=loop_watchdog.prometheus() + log_metrics(), media_type="text/plain; version=0.0.4")
+
+@api_router.get("/admin/admission")
+async def get_admission_stats():
+    """Requests in flight, shed and rate-limited per route class"""
+    return {
+        "capacity": ADMISSION_CAPACITY,
+        "inFlight": dict(admission_state["inFlight"]),
+        "shed": dict(admission_state["shed"]),
+        "rateLimited": dict(admission_state["rateLimited"]),
+        "trackedClients": len(admission_state["userBuckets"]),
+    }
+
+@api_router.post("/admin/dispatch/run")
+async def run_dispatch():
+    """Re-plan deliveries and refresh ETAs now instead of waiting for the next tick"""
+    return await dispatch_orders()
+
+@api_router.post("/admin/inventory/scan")
+async def run_inventory_scan():
+    """Run the inventory expiry and stock scan now instead of waiting for the next tick"""
+    return await scan_inventory()
+
+@api_router.get("/admin/migrations/storage-formats")
+async def get_storage_migration():
+    """Progress of the storage format migration"""
+    marker = await db.migrations.find_one({"_id": STORAGE_MIGRATION_ID}, {"_id": 0, "owner": 0})
+    return {**(marker or {"state": "pending"}), "legacyMatching": legacy_storage_formats}
+
+@api_router.post("/admin/migrations/storage-formats", status_code=202)
+async def start_storage_migration():
+    """Start or resume the storage format migration; run it once every worker is on the current release"""
+    task = getattr(app.state, "storage_migration", None)
+    if task is None or task.done():
+        app.state.storage_migration = asyncio.create_task(run_storage_migration())
+    return {"message": "Storage format migration started"}
+
+@api_router.post("/admin/orders/archive")
+async def run_order_archive(max_batches: int = Query(10, ge=1, le=1000)):
+    """Archive old delivered and cancelled orders now instead of waiting for the next tick"""
+    return await archive_orders(max_batches)
+
+@api_router.post("/admin/exports/run")
+async def run_analytics_export():
+    """Export new orders and prescriptions to Parquet now instead of waiting for the next tick"""
+    return await export_analytics()
+
+@api_router.get("/admin/exports")
+async def get_analytics_exports():
+    """Where each analytics dataset is written and how far it has been exported"""
+    return {
+        dataset: {"path": str(ANALYTICS_EXPORT_DIR / dataset), **read_export_state(ANALYTICS_EXPORT_DIR / dataset)}
+        for dataset in ANALYTICS_DATASETS
+    }
+
+# Request profiling
+# Selected requests (X-Profile: 1, or a random PROFILE_SAMPLE_RATE share) are sampled by a background
+# thread that reads the event loop thread's stack whenever one of their tasks is the one running.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_ALLOW_HEADER = os.environ.get("PROFILE_ALLOW_HEADER", "on") != "off"
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))  # seconds between samples
+PROFILE_MAX_ACTIVE = 8  # profiled requests in flight at once; more are served unprofiled
+PROFILE_MAX_DEPTH = 64
+
+class SamplingProfiler:
+    """Folded-stack sampler for the event loop thread, attributing samples to profiled tasks"""
+
+    def __init__(self):
+        self.active: Dict[asyncio.Task, Counter] = {}
+        self.routes: Dict[str, Counter] = {}
+        self.requests: Counter = Counter()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.switch_interval = sys.getswitchinterval()
+
+    def begin(self, task: asyncio.Task) -> bool:
+        if len(self.active) >= PROFILE_MAX_ACTIVE:
+            return False
+        if self.thread is None:
+            self.loop = task.get_loop()
+            self.loop_thread_id = threading.get_ident()
+            self.thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+            self.thread.start()
+        if not self.active:
+            # The sampler only gets the GIL at a switch; the default 5ms would miss most short requests
+            sys.setswitchinterval(min(self.switch_interval, PROFILE_INTERVAL / 5))
+        self.active[task] = Counter()
+        self.wakeup.set()
+        return True
+
+    def follow(self, child: asyncio.Task, parent: Optional[asyncio.Task]):
+        """Count a task spawned on a profiled request's behalf towards that request"""
+        stacks = self.active.get(parent)
+        if stacks is not None:
+            self.active[child] = stacks
+            child.add_done_callback(self._unfollow)
+
+    def _unfollow(self, child: asyncio.Task):
+        self.active.pop(child, None)
+        if not self.active:
+            sys.setswitchinterval(self.switch_interval)
+
+    def end(self, task: asyncio.Task, route: str):
+        stacks = self.active.pop(task, None)
+        if stacks is None:
+            return
+        if not self.active:
+            sys.setswitchinterval(self.switch_interval)
+        self.routes.setdefault(route, Counter()).update(stacks)
+        self.requests[route] += 1
+
+    def _run(self):
+        while True:
+            if not self.active:
+                self.wakeup.clear()
+                self.wakeup.wait()
+            time.sleep(PROFILE_INTERVAL)
+            # Holding the GIL here pauses the loop thread, so the running task and its frame agree
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stacks = self.active.get(asyncio.current_task(self.loop)) if frame else None
+            if stacks is not None:
+                stacks[self._fold(frame)] += 1
+
+    @staticmethod
+    def _fold(frame) -> str:
+        names = []
+        while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def folded(self, route: Optional[str] = None) -> str:
+        """Stacks in the folded format flamegraph.pl and speedscope read"""
+        routes = [route] if route else list(self.routes)
+        lines = []
+        for name in routes:
+            for stack, count in self.routes.get(name, Counter()).most_common():
+                lines.append(f"{name};{stack} {count}" if not route else f"{stack} {count}")
+        return "\n".join(lines) + "\n"
+
+request_profiler = SamplingProfiler()
+
+class RequestProfilerMiddleware:
+    """Pure ASGI so the profiled task is the one that runs the endpoint"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.selected(scope):
+            return await self.app(scope, receive, send)
+        task = asyncio.current_task()
+        if not request_profiler.begin(task):
+            return await self.app(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            request_profiler.end(task, f"{scope['method']} {route.path if route else scope['path']}")
+
+    @staticmethod
+    def selected(scope) -> bool:
+        if PROFILE_ALLOW_HEADER and (b"x-profile", b"1") in scope["headers"]:
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+app.add_middleware(RequestProfilerMiddleware)
+
+# Event loop watchdog
+LOOP_LAG_INTERVAL = 0.1  # seconds the monitor sleeps between lag measurements
+LOOP_LAG_THRESHOLD = float(os.environ.get("LOOP_LAG_THRESHOLD", 0.1))  # lag beyond this captures the blocking stack
+LOOP_LAG_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+LOOP_STALL_HISTORY = 50
+
+class LoopWatchdog:
+    """Measures event loop lag, and from a second thread captures what the loop is stuck running"""
+
+    def __init__(self):
+        self.heartbeat = time.monotonic()
+        self.bucket_counts = [0] * len(LOOP_LAG_BUCKETS)
+        self.lag_sum = 0.0
+        self.lag_count = 0
+        self.lag_max = 0.0
+        self.stalls = deque(maxlen=LOOP_STALL_HISTORY)
+        self.stall_count = 0
+        self.pending_stall: Optional[Dict[str, Any]] = None
+        self.loop_thread_id: Optional[int] = None
+
+    async def monitor(self):
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(loop.time() - started - LOOP_LAG_INTERVAL, 0.0)
+            self.observe(lag)
+            stall, self.pending_stall = self.pending_stall, None
+            if stall is not None:
+                stall["lagSeconds"] = round(lag, 4)
+                self.stalls.append(stall)
+                self.stall_count += 1
+                logger.warning("Event loop blocked for %.0f ms in:\n%s", lag * 1000, "".join(stall["stack"]))
+
+    def observe(self, lag: float):
+        for i, bound in enumerate(LOOP_LAG_BUCKETS):
+            if lag <= bound:
+                self.bucket_counts[i] += 1
+        self.lag_sum += lag
+        self.lag_count += 1
+        self.lag_max = max(self.lag_max, lag)
+
+    def _watch(self):
+        while True:
+            time.sleep(LOOP_LAG_THRESHOLD / 2)
+            if self.pending_stall is not None:
+                continue
+            if time.monotonic() - self.heartbeat > LOOP_LAG_INTERVAL + LOOP_LAG_THRESHOLD:
+                # The loop hasn't come back from its sleep: whatever it's running now is the culprit
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self.pending_stall = {"at": datetime.now(), "stack": traceback.format_stack(frame)}
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP hospot_event_loop_lag_seconds Delay between when the event loop should have resumed a task and when it did",
+            "# TYPE hospot_event_loop_lag_seconds histogram",
+        ]
+        for bound, count in zip(LOOP_LAG_BUCKETS, self.bucket_counts):
+            lines.append(f'hospot_event_loop_lag_seconds_bucket{{le="{bound}"}} {count}')
+        lines += [
+            f'hospot_event_loop_lag_seconds_bucket{{le="+Inf"}} {self.lag_count}',
+            f"hospot_event_loop_lag_seconds_sum {self.lag_sum}",
+            f"hospot_event_loop_lag_seconds_count {self.lag_count}",
+            "# HELP hospot_event_loop_stalls_total Times the loop was blocked longer than the stack capture threshold",
+            "# TYPE hospot_event_loop_stalls_total counter",
+            f"hospot_event_loop_stalls_total {self.stall_count}",
+        ]
+        return "\n".join(lines) + "\n"
+
+loop_watchdog = LoopWatchdog()
+
+# Admission control
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "on") != "off"
+ADMISSION_CAPACITY = int(os.environ.get("ADMISSION_CAPACITY", 200))  # requests in flight across all route classes
+ADMISSION_MAX_BUCKETS = 100000  # per-user buckets kept before idle ones are dropped
+# Peers whose X-Forwarded-For is believed, like uvicorn's --forwarded-allow-ips: comma-separated
+# addresses or networks, or * for any. Behind an ingress, list its addresses so clients aren't all
+# limited as one.
+ADMISSION_TRUSTED_PROXIES = [
+    entry if entry == "*" else ipaddress.ip_network(entry, strict=False)
+    for entry in (item.strip() for item in os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1").split(","))
+    if entry
+]
+
+class RouteClass(str, Enum):
+    HOSPITALS = "hospitals"
+    CHECKOUT = "checkout"
+    CATALOG = "catalog"
+    SEARCH = "search"
+    STREAM = "stream"
+    ADMIN = "admin"
+
+# concurrency: requests of the class in flight at once; userRate/userBurst: per-client token bucket;
+# routeRate/routeBurst: token bucket shared by all clients; shedAt: fraction of ADMISSION_CAPACITY
+# in flight beyond which the class is refused, so low-priority classes give way first
+ROUTE_POLICIES = {
+    RouteClass.HOSPITALS: {"concurrency": 60, "userRate": 10.0, "userBurst": 30, "routeRate": 500.0, "routeBurst": 1000, "shedAt": 1.0},
+    RouteClass.CHECKOUT: {"concurrency": 60, "userRate": 5.0, "userBurst": 20, "routeRate": 300.0, "routeBurst": 600, "shedAt": 1.0},
+    RouteClass.CATALOG: {"concurrency": 50, "userRate": 10.0, "userBurst": 40, "routeRate": 500.0, "routeBurst": 1000, "shedAt": 0.85},
+    RouteClass.SEARCH: {"concurrency": 30, "userRate": 5.0, "userBurst": 15, "routeRate": 200.0, "routeBurst": 300, "shedAt": 0.6},
+    RouteClass.STREAM: {"concurrency": None, "userRate": 0.2, "userBurst": 5, "routeRate": 50.0, "routeBurst": 200, "shedAt": 1.0},
+    RouteClass.ADMIN: {"concurrency": 5, "userRate": 1.0, "userBurst": 10, "routeRate": 10.0, "routeBurst": 20, "shedAt": 0.5},
+}
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Take a token; returns 0 on success or the seconds until one is available"""
+        self.refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+admission_state: Dict[str, Any] = {
+    "inFlight": Counter(),
+    "shed": Counter(),
+    "rateLimited": Counter(),
+    "routeBuckets": {route: TokenBucket(policy["routeRate"], policy["routeBurst"]) for route, policy in ROUTE_POLICIES.items()},
+    "userBuckets": {},
+}
+
+def route_class(path: str, query_params) -> Optional[RouteClass]:
+    if not path.startswith("/api/"):
+        return None
+    path = path[len("/api/"):]
+    if path == "ready":
+        return None  # probes must see readiness even when the instance is shedding
+    if path.startswith("admin/"):
+        return RouteClass.ADMIN
+    if path.endswith("/stream"):
+        return RouteClass.STREAM
+    if path.startswith("hospitals"):
+        return RouteClass.HOSPITALS
+    if path.startswith(("orders", "cart", "prescriptions", "interactions")):
+        return RouteClass.CHECKOUT
+    if path.startswith(("suggest", "medicines/fuzzy")) or (path == "medicines" and "search" in query_params):
+        return RouteClass.SEARCH
+    return RouteClass.CATALOG
+
+def user_bucket(route: RouteClass, client_key: str) -> TokenBucket:
+    buckets = admission_state["userBuckets"]
+    bucket = buckets.get((route, client_key))
+    if bucket is None:
+        if len(buckets) >= ADMISSION_MAX_BUCKETS:
+            # A bucket that has refilled to capacity holds no state worth keeping
+            now = time.monotonic()
+            for key in [key for key, b in buckets.items() if b.tokens + (now - b.updated) * b.rate >= b.capacity]:
+                del buckets[key]
+        policy = ROUTE_POLICIES[route]
+        bucket = buckets[(route, client_key)] = TokenBucket(policy["userRate"], policy["userBurst"])
+    return bucket
+
+def refuse(status_code: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(status_code=status_code, content={"detail": detail}, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+def trusted_proxy(host: str) -> bool:
+    if "*" in ADMISSION_TRUSTED_PROXIES:
+        return True
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in ADMISSION_TRUSTED_PROXIES if network != "*")
+
+def client_address(scope) -> Optional[str]:
+    """The connecting address, or, for requests through trusted proxies, the nearest hop in
+    X-Forwarded-For that isn't one of them"""
+    client = scope.get("client")
+    host = client[0] if client else None
+    if host is None or not trusted_proxy(host):
+        return host
+    forwarded = b",".join(value for name, value in scope["headers"] if name == b"x-forwarded-for")
+    hops = [hop.strip() for hop in forwarded.decode("latin-1").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else host
+
+def client_key(scope) -> str:
+    """Who a request is rate-limited as: the authenticated principal when an authentication
+    middleware has set one, otherwise the client's address. X-User-Id and other client-supplied
+    headers aren't trusted; X-Forwarded-For only when the peer is a trusted proxy."""
+    user = scope.get("user")
+    if user is not None and getattr(user, "is_authenticated", False):
+        return f"user:{user.identity}"
+    return f"addr:{client_address(scope) or 'unknown'}"
+
+class AdmissionControlMiddleware:
+    """Rate-limit and shed load per route class before a request reaches the database"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or not ADMISSION_CONTROL:
+            return await self.app(scope, receive, send)
+        route = route_class(scope["path"], parse_qs(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        if route is None:
+            return await self.app(scope, receive, send)
+        policy = ROUTE_POLICIES[route]
+        in_flight = admission_state["inFlight"]
+
+        # Refuse before taking tokens so shed requests don't also use up the client's rate
+        total = sum(in_flight.values())
+        if total >= ADMISSION_CAPACITY * policy["shedAt"] or (policy["concurrency"] and in_flight[route] >= policy["concurrency"]):
+            admission_state["shed"][route] += 1
+            return await refuse(503, "Server is busy, please retry shortly", 1)(scope, receive, send)
+
+        wait = user_bucket(route, client_key(scope)).take()
+        if wait:
+            admission_state["rateLimited"][route] += 1
+            return await refuse(429, "Too many requests", wait)(scope, receive, send)
+        wait = admission_state["routeBuckets"][route].take()
+        if wait:
+            admission_state["shed"][route] += 1
+            return await refuse(503, "Server is busy, please retry shortly", wait)(scope, receive, send)
+
+        in_flight[route] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            in_flight[route] -= 1
+
+# Added here so it sits inside CORS and the request id middleware; an authentication middleware
+# must be added after this one for its principal to be used as the rate-limit key
+app.add_middleware(AdmissionControlMiddleware)
+
+# Storage format migration
+STORAGE_MIGRATION_COLLECTIONS = ["hospitals", "medicines", "prescriptions", "carts", "orders", "drug_interactions", "medicine_recommendations"]
+
+# The migration runs once per database, started by an operator after every worker runs this code, and
+# records its progress and completion in the migrations collection. Workers keep matching legacy string
+# ids until they see the completion marker.
+STORAGE_MIGRATION_ID = "storageFormats"
+STORAGE_MIGRATION_LEASE = timedelta(minutes=2)  # a runner that hasn't saved progress for this long has died
+STORAGE_MIGRATION_POLL = 30  # seconds between marker checks while legacy matching is on
+
+async def load_storage_migration_state():
+    """Turn legacy id matching off once the migration has completed; a fresh database has nothing to migrate"""
+    global legacy_storage_formats
+    marker = await db.migrations.find_one({"_id": STORAGE_MIGRATION_ID})
+    if marker is None:
+        existing = await asyncio.gather(*(db[name].raw.find_one({}, {"_id": 1}) for name in STORAGE_MIGRATION_COLLECTIONS))
+        if not any(existing):
+            marker = await db.migrations.find_one_and_update(
+                {"_id": STORAGE_MIGRATION_ID},
+                {"$setOnInsert": {"state": "done", "completedAt": datetime.now()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+    legacy_storage_formats = not (marker and marker["state"] == "done")
+
+async def storage_migration_watch_loop():
+    while legacy_storage_formats:
+        await asyncio.sleep(STORAGE_MIGRATION_POLL)
+        try:
+            await load_storage_migration_state()
+        except Exception:
+            logger.exception("Storage migration state check failed")
+
+async def migrate_storage_formats(batch_size: int = 500):
+    """Rewrite documents still holding string ids or dates into the compact storage form.
+
+    Collections are walked in _id order and the position is saved after every batch under a lease,
+    so a run that dies is resumed by the next one instead of starting over. Each field is only
+    replaced if it still holds the value that was read, so racing writes win.
+    """
+    global legacy_storage_formats
+    owner = str(uuid.uuid4())
+    now = datetime.now()
+    try:
+        marker = await db.migrations.find_one_and_update(
+            {"_id": STORAGE_MIGRATION_ID, "state": {"$ne": "done"}, "$or": [{"leaseUntil": {"$lt": now}}, {"leaseUntil": {"$exists": False}}]},
+            {
+                "$set": {"state": "running", "owner": owner, "leaseUntil": now + STORAGE_MIGRATION_LEASE},
+                "$setOnInsert": {"collection": 0, "lastId": None, "converted": 0, "startedAt": now}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return  # already done, or another runner holds the lease
+
+    position, last_id, converted = marker["collection"], marker["lastId"], marker["converted"]
+    while position < len(STORAGE_MIGRATION_COLLECTIONS):
+        collection = db[STORAGE_MIGRATION_COLLECTIONS[position]].raw
+        documents = await collection.find({"_id": {"$gt": last_id}} if last_id is not None else {}).sort("_id", 1).to_list(batch_size)
+        operations = []
+        for document in documents:
+            stored = to_storage(document)
+            changed = {key: value for key, value in stored.items() if value != document[key] or type(value) is not type(document[key])}
+            if changed:
+                operations.append(UpdateOne(
+                    {"_id": document["_id"], **{key: document[key] for key in changed}},
+                    {"$set": changed}
+                ))
+        if operations:
+            converted += (await collection.bulk_write(operations, ordered=False)).modified_count
+        if len(documents) < batch_size:
+            position, last_id = position + 1, None
+        else:
+            last_id = documents[-1]["_id"]
+        saved = await db.migrations.update_one(
+            {"_id": STORAGE_MIGRATION_ID, "owner": owner},
+            {"$set": {"collection": position, "lastId": last_id, "converted": converted, "leaseUntil": datetime.now() + STORAGE_MIGRATION_LEASE}}
+        )
+        if saved.matched_count == 0:
+            logger.warning("Storage migration lease lost; leaving the rest to the new runner")
+            return
+
+    await db.migrations.update_one(
+        {"_id": STORAGE_MIGRATION_ID, "owner": owner},
+        {"$set": {"state": "done", "completedAt": datetime.now()}, "$unset": {"leaseUntil": "", "owner": ""}}
+    )
+    legacy_storage_formats = False
+    logger.info("Storage format migration complete: %d documents converted", converted)
+
+async def run_storage_migration():
+    try:
+        await migrate_storage_formats()
+    except Exception:
+        logger.exception("Storage format migration failed; start it again to resume")
+
+# Indexes
+async def ensure_indexes():
+    """Create the indexes the API relies on; existing indexes are left untouched"""
+    try:
+        await db.carts.create_index("userId", unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        await dedupe_carts()
+        await db.carts.create_index("userId", unique=True)
+    await db.carts.create_index("expiresAt", expireAfterSeconds=0)
+    await db.idempotency_keys.create_index("createdAt", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    await db.hospitals.create_index("id", unique=True)
+    await db.hospitals.create_index("changeVersion")
+    await db.catalog_views.create_index([("kind", 1), ("id", 1)], unique=True)
+    await db.catalog_views.create_index([("kind", 1), ("views", -1)])
+    await db.catalog_tombstones.create_index([("collection", 1), ("changeVersion", 1)])
+    await db.medicines.create_index("id", unique=True)
+    await db.medicines.create_index("changeVersion")
+    await db.medicines.create_index("expiryDate")
+    await db.medicines.create_index("batches.expiryDate")
+    await db.medicines.create_index("inStock")
+    await db.inventory_alerts.create_index("key", unique=True)
+    await db.inventory_alerts.create_index([("resolved", 1), ("lastSeenAt", 1)])
+    await db.order_events.create_index([("orderId", 1), ("at", 1)])
+    await db.order_events.create_index([("userId", 1), ("at", 1)])
+    await db.order_events.create_index("id", unique=True)
+    await db.order_events.create_index([("at", 1), ("_id", 1)])
+    await db.jobs.create_index("id", unique=True)
+    await db.jobs.create_index([("status", 1), ("runAt", 1)])
+    await db.dead_jobs.create_index("id", unique=True)
+    await db.orders.create_index("id", unique=True)
+    await db.orders.create_index([("userId", 1), ("orderDate", -1)])
+    await db.orders.create_index("outbox.createdAt", sparse=True)
+    await db.orders.create_index([("status", 1), ("orderDate", 1)])
+    await db.orders.create_index([("orderDate", 1), ("_id", 1)])
+    await create_order_archive()
+    await db.orders_archive.create_index("id", unique=True)
+    await db.orders_archive.create_index([("userId", 1), ("orderDate", -1)])
+    await db.prescriptions.create_index("id", unique=True)
+    await db.prescriptions.create_index([("userId", 1), ("isUsed", 1)])
+    await db.prescriptions.create_index([("createdAt", 1), ("_id", 1)])
+
 # Initialize data on startup
 @app.on_event("startup")
 async def startup_event():
+    app.state.loop_watchdog = asyncio.create_task(loop_watchdog.monitor())
+    await ensure_indexes()
+    await backfill_prescription_quantities()
+    await load_storage_migration_state()
+    app.state.storage_migration_watch = asyncio.create_task(storage_migration_watch_loop())
     await init_dummy_data()
     await init_medicine_data()
+    await backfill_medicine_batches()
+    await backfill_change_versions()
+    await init_interaction_data()
+    app.state.warmup = asyncio.create_task(warm_up())
+    app.state.catalog_index = asyncio.create_task(catalog_index_loop())
+    app.state.view_flush = asyncio.create_task(view_flush_loop())
+    app.state.inventory_scan = asyncio.create_task(inventory_scan_loop())
+    app.state.dispatch = asyncio.create_task(dispatch_loop())
+    app.state.order_archive = asyncio.create_task(order_archive_loop())
+    app.state.recommendations = asyncio.create_task(recommendation_loop())
+    app.state.analytics_export = asyncio.create_task(analytics_export_loop())
+    app.state.catalog_snapshot = asyncio.create_task(catalog_snapshot_loop())
+    app.state.order_event_tail = asyncio.create_task(order_events.run())
+    jobs.start()
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -1106,13 +4936,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+# Outermost, so requests refused by admission control still carry a request id
+app.add_middleware(CorrelationIdMiddleware)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await jobs.stop()
+    await flush_views()
+    await release_leases()
     client.close()
\ No newline at end of file
@@ -15,7 +15,7 @@ class HospotAPITester:
         self.test_prescription_id = None
         self.test_order_id = None
 
-    def run_test(self, name, method, endpoint, expected_status, params=None, data=None, expected_count=None):
+    def run_test(self, name, method, endpoint, expected_status, params=None, data=None, expected_count=None, headers=None):
         """Run a single API test"""
         url = f"{self.api_url}/{endpoint}"
         
@@ -24,16 +24,16 @@ class HospotAPITester:
         print(f"   URL: {url}")
         
         try:
-            headers = {'Content-Type': 'application/json'}
+            headers = {'Content-Type': 'application/json', **(headers or {})}
             
             if method == 'GET':
-                response = requests.get(url, params=params, timeout=10)
+                response = requests.get(url, params=params, headers=headers, timeout=10)
             elif method == 'POST':
                 response = requests.post(url, json=data, headers=headers, timeout=10)
             elif method == 'PUT':
                 response = requests.put(url, json=data, headers=headers, timeout=10)
             elif method == 'DELETE':
-                response = requests.delete(url, timeout=10)
+                response = requests.delete(url, headers=headers, timeout=10)
             
             print(f"   Status Code: {response.status_code}")
             
@@ -68,6 +68,13 @@ class HospotAPITester:
             print(f"❌ Failed - Error: {str(e)}")
             return False, {}
 
+    def check(self, condition, message):
+        """Count the test just run as failed when its response content is wrong"""
+        if not condition:
+            self.tests_passed -= 1
+            print(f"❌ Failed - {message}")
+        return condition
+
     # Medicine API Tests
     def test_get_all_medicines(self):
         """Test getting all medicines"""
@@ -333,6 +340,75 @@ class HospotAPITester:
         
         return success
 
+    def test_partial_prescription_redemption(self):
+        """Test redeeming a prescription line in parts until it is used up"""
+        prescription_data = {
+            "userId": self.test_user_id,
+            "doctorName": "Dr. Sarah Johnson",
+            "hospitalName": "City General Hospital",
+            "prescriptionDate": datetime.now().isoformat(),
+            "medicines": [
+                {
+                    "medicineName": "Amoxicillin 500mg",
+                    "dosage": "1 capsule 3 times daily",
+                    "duration": "7 days",
+                    "quantity": 3
+                }
+            ]
+        }
+        success, prescription = self.run_test(
+            "Create Prescription with Quantity",
+            "POST",
+            "prescriptions",
+            200,
+            data=prescription_data
+        )
+        if not success or not isinstance(prescription, dict):
+            return False
+        prescription_id = prescription["id"]
+
+        success, response = self.run_test(
+            "Redeem Part of a Prescription Line",
+            "POST",
+            f"prescriptions/{prescription_id}/redeem",
+            200,
+            data={"lines": [{"line": 0, "quantity": 2}]}
+        )
+        if success:
+            remaining = response["medicines"][0].get("quantityRemaining")
+            print(f"   Remaining: {remaining}, Used: {response.get('isUsed')}")
+            if not self.check(remaining == 1 and not response.get("isUsed"), "Expected 1 remaining on an unused prescription"):
+                return False
+
+        success, _ = self.run_test(
+            "Redeem More Than Remains",
+            "POST",
+            f"prescriptions/{prescription_id}/redeem",
+            409,
+            data={"lines": [{"line": 0, "quantity": 2}]}
+        )
+
+        success, response = self.run_test(
+            "Redeem the Rest of a Prescription Line",
+            "POST",
+            f"prescriptions/{prescription_id}/redeem",
+            200,
+            data={"lines": [{"line": 0, "quantity": 1}]}
+        )
+        if success:
+            print(f"   Remaining: {response['medicines'][0].get('quantityRemaining')}, Used: {response.get('isUsed')}")
+            if not self.check(response.get("isUsed"), "A fully redeemed prescription should be marked used"):
+                return False
+
+        success, _ = self.run_test(
+            "Reject Non-Positive Redemption Quantity",
+            "POST",
+            f"prescriptions/{prescription_id}/redeem",
+            422,
+            data={"lines": [{"line": 0, "quantity": 0}]}
+        )
+        return success
+
     # Shopping Cart API Tests
     def test_get_cart(self):
         """Test getting user's cart"""
@@ -412,6 +488,81 @@ class HospotAPITester:
         
         return success
 
+    def test_cart_created_on_first_add(self):
+        """Test that reading a missing cart doesn't store one and the first add creates it"""
+        if not self.test_medicine_id:
+            print("⚠️  Skipping - No medicine ID available")
+            return True
+
+        user_id = str(uuid.uuid4())
+        success, response = self.run_test(
+            "Get Cart of New User",
+            "GET",
+            f"cart/{user_id}",
+            200
+        )
+        if success and not self.check(not response.get("items"), "Expected an empty cart"):
+            return False
+
+        cart_item = {
+            "medicineId": self.test_medicine_id,
+            "medicineName": "Paracetamol 500mg",
+            "price": 15.99,
+            "quantity": 1
+        }
+        for attempt in range(2):
+            self.run_test(
+                f"Add Item to New Cart ({attempt + 1})",
+                "POST",
+                f"cart/{user_id}/add",
+                200,
+                data=cart_item
+            )
+
+        success, response = self.run_test(
+            "Get Cart After Adds",
+            "GET",
+            f"cart/{user_id}",
+            200
+        )
+        if success:
+            items = response.get("items", [])
+            print(f"   Items: {len(items)}, Quantity: {sum(item['quantity'] for item in items)}")
+            if not self.check(len(items) == 1 and items[0]["quantity"] == 2, "Expected one line with quantity 2"):
+                return False
+
+        self.run_test("Clear New Cart", "DELETE", f"cart/{user_id}/clear", 200)
+        return success
+
+    def test_add_unknown_medicine_to_cart(self):
+        """Test that adding a medicine missing from the catalog is refused without touching the cart"""
+        user_id = str(uuid.uuid4())
+        cart_item = {
+            "medicineId": str(uuid.uuid4()),
+            "medicineName": "Discontinued 10mg",
+            "price": 9.99,
+            "quantity": 1
+        }
+        success, _ = self.run_test(
+            "Add Unknown Medicine to Cart",
+            "POST",
+            f"cart/{user_id}/add",
+            404,
+            data=cart_item
+        )
+        if not success:
+            return False
+
+        success, response = self.run_test(
+            "Get Cart After Refused Add",
+            "GET",
+            f"cart/{user_id}",
+            200
+        )
+        if success and not self.check(not response.get("items"), "Refused item was stored in the cart"):
+            return False
+        return success
+
     def test_clear_cart(self):
         """Test clearing user's cart"""
         success, response = self.run_test(
@@ -516,6 +667,60 @@ class HospotAPITester:
         
         return success
 
+    def test_invalid_order_status_transition(self):
+        """Test that an order can't move backwards through its statuses"""
+        if not self.test_order_id:
+            print("⚠️  Skipping - No order ID available")
+            return True
+
+        success, response = self.run_test(
+            "Reject Invalid Status Transition",
+            "PUT",
+            f"orders/{self.test_order_id}/status?status=pending",
+            409
+        )
+        if success and isinstance(response, dict):
+            print(f"   Detail: {response.get('detail', 'No detail')}")
+        return success
+
+    def test_idempotent_order_replay(self):
+        """Test that retrying an order with the same Idempotency-Key returns the original order"""
+        order_data = {
+            "userId": self.test_user_id,
+            "items": [
+                {
+                    "medicineId": self.test_medicine_id or "test-medicine-id",
+                    "medicineName": "Paracetamol 500mg",
+                    "price": 15.99,
+                    "quantity": 1
+                }
+            ],
+            "totalAmount": 15.99,
+            "deliveryAddress": "123 Main Street, Downtown, City 12345",
+            "contactNumber": "+1-555-0123",
+            "paymentMethod": "cash_on_delivery"
+        }
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+        success, first = self.run_test("Create Order with Idempotency Key", "POST", "orders", 200, data=order_data, headers=headers)
+        if not success:
+            return False
+        success, replay = self.run_test("Retry Order with Same Key", "POST", "orders", 200, data=order_data, headers=headers)
+        if success:
+            print(f"   Original: {first.get('id')}, Replay: {replay.get('id')}")
+            if not self.check(replay.get("id") == first.get("id"), "Retry created a second order"):
+                return False
+
+        success, _ = self.run_test(
+            "Reuse Key for a Different Order",
+            "POST",
+            "orders",
+            422,
+            data={**order_data, "notes": "Different request"},
+            headers=headers
+        )
+        return success
+
     def test_api_root(self):
         """Test API root endpoint"""
         success, response = self.run_test(
@@ -686,6 +891,7 @@ def main():
     tester.test_get_user_prescriptions()
     tester.test_get_specific_prescription()
     tester.test_mark_prescription_used()
+    tester.test_partial_prescription_redemption()
     
     print("\n" + "=" * 60)
     print("🛒 SHOPPING CART SYSTEM TESTS")
@@ -697,6 +903,8 @@ def main():
     tester.test_update_cart_item()
     tester.test_remove_from_cart()
     tester.test_clear_cart()
+    tester.test_cart_created_on_first_add()
+    tester.test_add_unknown_medicine_to_cart()
     
     print("\n" + "=" * 60)
     print("📦 ORDER SYSTEM TESTS")
@@ -707,6 +915,8 @@ def main():
     tester.test_get_user_orders()
     tester.test_get_specific_order()
     tester.test_update_order_status()
+    tester.test_invalid_order_status_transition()
+    tester.test_idempotent_order_replay()
     
     # Print final results
     print("\n" + "=" * 60)
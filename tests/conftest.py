@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# server reads its settings at import time; the Motor client it creates doesn't connect until used
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
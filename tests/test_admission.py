@@ -0,0 +1,74 @@
+import ipaddress
+
+import pytest
+
+import server
+from server import TokenBucket, client_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_reports_the_wait(clock):
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.5)
+    clock.now += 0.25
+    assert bucket.take() == pytest.approx(0.25)
+
+
+def test_bucket_refills_at_its_rate_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    for _ in range(3):
+        bucket.take()
+    clock.now += 1.0
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.0
+    assert bucket.take() > 0
+    clock.now += 60
+    bucket.refill(clock.now)
+    assert bucket.tokens == 3
+
+
+def scope(client, forwarded=None, user=None):
+    headers = [(b"x-forwarded-for", value.encode()) for value in forwarded or []]
+    request = {"type": "http", "client": (client, 5000), "headers": headers}
+    if user is not None:
+        request["user"] = user
+    return request
+
+
+@pytest.fixture
+def proxies(monkeypatch):
+    monkeypatch.setattr(server, "ADMISSION_TRUSTED_PROXIES", [ipaddress.ip_network("10.0.0.0/8")])
+
+
+def test_client_key_ignores_forwarded_for_from_untrusted_peers(proxies):
+    assert client_key(scope("203.0.113.7", ["198.51.100.1"])) == "addr:203.0.113.7"
+
+
+def test_client_key_takes_the_nearest_untrusted_hop(proxies):
+    assert client_key(scope("10.0.0.2", ["198.51.100.9, 198.51.100.1, 10.0.0.5"])) == "addr:198.51.100.1"
+    assert client_key(scope("10.0.0.2", ["198.51.100.9", "198.51.100.1"])) == "addr:198.51.100.1"
+    assert client_key(scope("10.0.0.2")) == "addr:10.0.0.2"
+
+
+def test_client_key_prefers_the_authenticated_principal(proxies):
+    class User:
+        is_authenticated = True
+        identity = "u1"
+
+    assert client_key(scope("10.0.0.2", ["198.51.100.1"], User())) == "user:u1"
+    assert client_key({"type": "http", "client": None, "headers": []}) == "addr:unknown"
@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+from server import SyncCollection, catalog_changes
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, key, direction):
+        self.documents = sorted(self.documents, key=lambda document: document[key], reverse=direction < 0)
+        return self
+
+    async def to_list(self, length):
+        return self.documents[:length]
+
+
+class FakeCollection:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection=None):
+        since = query["changeVersion"]["$gt"]
+        return FakeCursor([
+            document for document in self.documents
+            if document["changeVersion"] > since and all(document.get(key) == value for key, value in query.items() if key != "changeVersion")
+        ])
+
+
+class FakeDatabase:
+    def __init__(self, **collections):
+        self.collections = collections
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection([]))
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+def changes(**kwargs):
+    return asyncio.run(catalog_changes(SyncCollection.MEDICINES, **kwargs))
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    old = datetime.now() - timedelta(minutes=1)
+    database = FakeDatabase(
+        medicines=FakeCollection([
+            {"id": "a", "changeVersion": 1, "changedAt": old},
+            {"id": "c", "changeVersion": 3, "changedAt": old},
+            {"id": "d", "changeVersion": 5, "changedAt": datetime.now()},
+        ]),
+        catalog_tombstones=FakeCollection([
+            {"collection": "medicines", "id": "b", "changeVersion": 2, "changedAt": old},
+            {"collection": "hospitals", "id": "h", "changeVersion": 4, "changedAt": old},
+        ]),
+    )
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+def test_changes_interleave_upserts_and_deletes_up_to_the_unsettled_tail(catalog):
+    version, has_more, upserts, deletes = changes(since=0, limit=10)
+    assert version == 3
+    assert not has_more
+    assert [document["id"] for document in upserts] == ["a", "c"]
+    assert deletes == ["b"]
+
+
+def test_changes_page_by_version(catalog):
+    version, has_more, upserts, deletes = changes(since=0, limit=2)
+    assert (version, has_more, [document["id"] for document in upserts], deletes) == (2, True, ["a"], ["b"])
+    version, has_more, upserts, deletes = changes(since=version, limit=2)
+    assert (version, has_more, [document["id"] for document in upserts], deletes) == (3, False, ["c"], [])
+
+
+def test_changes_without_settle_include_the_latest_writes(catalog):
+    version, has_more, upserts, _ = changes(since=3, limit=10, settle=timedelta(0))
+    assert version == 5
+    assert [document["id"] for document in upserts] == ["d"]
+
+
+def test_no_changes_keep_the_version(catalog):
+    assert changes(since=5, limit=10) == (5, False, [], [])
@@ -0,0 +1,50 @@
+import numpy as np
+
+from server import CoPurchaseCounter, _merge_pair_counts
+
+
+def test_merge_pair_counts_folds_batches_into_sorted_counts():
+    keys, counts = _merge_pair_counts(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), [5, 3, 5])
+    assert keys.tolist() == [3, 5]
+    assert counts.tolist() == [1, 2]
+    keys, counts = _merge_pair_counts(keys, counts, [1, 5])
+    assert keys.tolist() == [1, 3, 5]
+    assert counts.tolist() == [1, 1, 3]
+    assert counts.dtype == np.int64
+
+
+def order(*medicine_ids):
+    return {"items": [{"medicineId": medicine_id} for medicine_id in medicine_ids]}
+
+
+def test_top_related_scores_by_cosine_similarity():
+    counter = CoPurchaseCounter()
+    counter.add_orders([order("a", "b")] * 3 + [order("a", "c"), order("a", "c")])
+    table = counter.top_related(top_k=10, min_count=2)
+    assert table["a"] == [("b", round(3 / np.sqrt(5 * 3), 4)), ("c", round(2 / np.sqrt(5 * 2), 4))]
+    assert table["b"] == [("a", round(3 / np.sqrt(5 * 3), 4))]
+
+
+def test_top_related_drops_rare_pairs_and_limits_per_medicine():
+    counter = CoPurchaseCounter()
+    counter.add_orders([order("a", "b", "c")] * 2 + [order("a", "d")])
+    table = counter.top_related(top_k=1, min_count=2)
+    assert set(table) == {"a", "b", "c"}
+    assert all(len(related) == 1 for related in table.values())
+    assert "d" not in {related_id for related in table.values() for related_id, _ in related}
+
+
+def test_repeated_items_count_once_per_order():
+    counter = CoPurchaseCounter()
+    counter.add_orders([order("a", "a", "b"), order("b", "a")])
+    assert counter.top_related(min_count=1) == {"a": [("b", 1.0)], "b": [("a", 1.0)]}
+
+
+def test_buffered_pairs_merge_across_pages(monkeypatch):
+    monkeypatch.setattr("server.PAIR_BUFFER_SIZE", 1)
+    counter = CoPurchaseCounter()
+    counter.add_orders([order("a", "b")])
+    counter.add_orders([order("a", "b"), order("c")])
+    assert counter.keys.size == 1 and counter.batch == []
+    assert counter.top_related(min_count=2) == {"a": [("b", 1.0)], "b": [("a", 1.0)]}
+    assert CoPurchaseCounter().top_related() == {}
@@ -0,0 +1,48 @@
+import numpy as np
+
+import server
+from server import COURIER_BATCH_SIZE, COURIER_SPEED_KMH, HANDOVER_MINUTES, STOP_MINUTES, ZONE_DISTANCE_KM, plan_deliveries
+
+
+def one_way(zone):
+    return ZONE_DISTANCE_KM[zone] / COURIER_SPEED_KMH * 60
+
+
+def test_no_orders_leaves_couriers_free():
+    arrival, courier, trip, free = plan_deliveries(np.zeros(0, dtype=int), np.zeros(0), couriers=3)
+    assert arrival.size == courier.size == trip.size == 0
+    assert free.tolist() == [0.0, 0.0, 0.0]
+
+
+def test_same_zone_orders_share_a_trip_in_age_order():
+    zones = np.array([1, 1, 1])
+    order_minutes = np.array([30.0, 10.0, 20.0])
+    arrival, courier, trip, free = plan_deliveries(zones, order_minutes, couriers=2)
+    assert len(set(trip.tolist())) == 1
+    assert courier.tolist() == [0, 0, 0]
+    expected = HANDOVER_MINUTES + one_way(1) + np.array([3, 1, 2]) * STOP_MINUTES
+    assert np.allclose(arrival, expected)
+    assert np.allclose(free, [2 * one_way(1) + 3 * STOP_MINUTES, 0.0])
+
+
+def test_zones_are_cut_into_trips_of_the_batch_size():
+    zones = np.zeros(COURIER_BATCH_SIZE + 1, dtype=int)
+    arrival, courier, trip, free = plan_deliveries(zones, np.arange(zones.size, dtype=float), couriers=2)
+    assert np.bincount(trip).tolist() == [COURIER_BATCH_SIZE, 1]
+    # The trip holding the oldest orders goes first, to the first courier
+    assert courier[0] == 0 and courier[-1] == 1
+
+
+def test_trips_queue_behind_each_other_when_couriers_run_out():
+    zones = np.array([0, len(ZONE_DISTANCE_KM) - 1])
+    arrival, courier, trip, free = plan_deliveries(zones, np.array([5.0, 1.0]), couriers=1)
+    far, near = 2 * one_way(zones[1]) + STOP_MINUTES, 2 * one_way(zones[0]) + STOP_MINUTES
+    assert courier.tolist() == [0, 0]
+    assert np.isclose(arrival[1], HANDOVER_MINUTES + one_way(zones[1]) + STOP_MINUTES)
+    assert np.isclose(arrival[0], HANDOVER_MINUTES + far + one_way(zones[0]) + STOP_MINUTES)
+    assert np.allclose(free, [far + near])
+
+
+def test_default_courier_count():
+    _, _, _, free = plan_deliveries(np.array([0]), np.array([0.0]))
+    assert free.size == server.DISPATCH_COURIERS
@@ -0,0 +1,58 @@
+from server import NGramIndex, edit_distance
+
+
+def test_edit_distance_counts_transpositions_once():
+    assert edit_distance("paracetamol", "paracetamol", 2) == 0
+    assert edit_distance("paracetmaol", "paracetamol", 2) == 1
+    assert edit_distance("ibuprofen", "ibuprofin", 2) == 1
+    assert edit_distance("asprin", "aspirin", 2) == 1
+
+
+def test_edit_distance_gives_up_past_the_limit():
+    assert edit_distance("abc", "abcdef", 2) == 3
+    assert edit_distance("cetirizine", "omeprazole", 3) == 4
+
+
+def make_index():
+    index = NGramIndex()
+    index.add("para", ["Paracetamol 500mg", "Paracetamol"])
+    index.add("ibu", ["Ibuprofen 400mg", "Ibuprofen"])
+    index.add("combo", ["Cold Relief", "Paracetamol, Phenylephrine"])
+    return index
+
+
+def test_search_tolerates_typos():
+    ids = [doc_id for doc_id, _ in make_index().search("paracetmol", 10)]
+    assert set(ids) == {"para", "combo"}
+    assert [doc_id for doc_id, _ in make_index().search("ibuprofin", 10)] == ["ibu"]
+
+
+def test_search_reranks_by_edit_distance():
+    index = NGramIndex()
+    index.add("exact", ["Cetirizine"])
+    index.add("close", ["Cetirizone"])
+    ranked = index.search("cetirizine", 10)
+    assert [doc_id for doc_id, _ in ranked] == ["exact", "close"]
+    assert ranked[0][1] == 1.0
+    assert ranked[1][1] == 0.9
+
+
+def test_search_averages_over_query_words():
+    ranked = dict(make_index().search("paracetamol relief", 10))
+    assert ranked["combo"] == 1.0
+    assert ranked["para"] == 0.5
+
+
+def test_search_ignores_dissimilar_and_short_words():
+    index = make_index()
+    assert index.search("zzzzzz", 10) == []
+    assert index.search("mg", 10) == []
+
+
+def test_remove_drops_unshared_vocabulary():
+    index = make_index()
+    index.remove("ibu")
+    assert "ibuprofen" not in index.words
+    assert not any("ibuprofen" in words for words in index.postings.values())
+    index.remove("para")
+    assert index.words["paracetamol"] == {"combo"}
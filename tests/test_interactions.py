@@ -0,0 +1,53 @@
+from server import InteractionIndex, InteractionSeverity, ingredient_set, normalize_ingredient
+
+RULES = [
+    {"between": ["anticoagulant", "nsaid"], "severity": "major", "description": "Bleeding risk"},
+    {"between": ["warfarin", "aspirin"], "severity": "moderate", "description": "Overlapping rule"},
+    {"between": ["nsaid", "antihypertensive"], "severity": "minor", "description": "Weaker blood pressure control"},
+]
+
+
+def make_index():
+    index = InteractionIndex()
+    index.load(RULES)
+    return index
+
+
+def test_normalize_ingredient_strips_doses_salts_and_synonyms():
+    assert normalize_ingredient("Acetaminophen 500mg") == "paracetamol"
+    assert normalize_ingredient("Amlodipine Besylate 5 mg") == "amlodipine"
+    assert ingredient_set(["Paracetamol 500mg, Caffeine 65mg"]) == frozenset({"paracetamol", "caffeine"})
+
+
+def test_class_rules_expand_to_members_and_most_severe_wins():
+    index = make_index()
+    assert index.pairs[("ibuprofen", "warfarin")]["severity"] == InteractionSeverity.MAJOR
+    assert index.pairs[("aspirin", "warfarin")]["severity"] == InteractionSeverity.MAJOR
+
+
+def test_check_reports_pairs_most_severe_first():
+    warnings = make_index().check([
+        ("Brufen", frozenset({"ibuprofen"})),
+        ("Norvasc", frozenset({"amlodipine"})),
+        ("Coumadin", frozenset({"warfarin"})),
+    ])
+    assert [(w["medicines"], w["severity"]) for w in warnings] == [
+        (["Brufen", "Coumadin"], InteractionSeverity.MAJOR),
+        (["Brufen", "Norvasc"], InteractionSeverity.MINOR),
+    ]
+    assert warnings[0]["ingredients"] == ["ibuprofen", "warfarin"]
+
+
+def test_check_flags_duplicate_ingredients_across_medicines():
+    warnings = make_index().check([
+        ("Panadol", frozenset({"paracetamol"})),
+        ("Cold Relief", frozenset({"paracetamol", "phenylephrine"})),
+    ])
+    assert len(warnings) == 1
+    assert warnings[0]["ingredients"] == ["paracetamol"]
+    assert warnings[0]["severity"] == InteractionSeverity.MODERATE
+
+
+def test_check_ignores_ingredients_within_one_medicine():
+    assert make_index().check([("Combo", frozenset({"ibuprofen", "warfarin"}))]) == []
+    assert make_index().check([]) == []
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from server import SingleFlight
+
+
+def test_concurrent_callers_share_one_execution():
+    async def scenario():
+        flights, calls = SingleFlight(), []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"value": len(calls)}
+
+        results = await asyncio.gather(*(flights.do("key", work) for _ in range(5)))
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+        assert flights.calls == {}
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_and_later_calls_run_again():
+    async def scenario():
+        flights, calls = SingleFlight(), []
+
+        async def work():
+            calls.append(1)
+            call = len(calls)
+            await asyncio.sleep(0)
+            return call
+
+        assert sorted(await asyncio.gather(flights.do("a", work), flights.do("b", work))) == [1, 2]
+        assert await flights.do("a", work) == 3
+
+    asyncio.run(scenario())
+
+
+def test_errors_reach_every_waiter_and_are_not_cached():
+    async def scenario():
+        flights, calls = SingleFlight(), []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0)
+            if len(calls) == 1:
+                raise ValueError("boom")
+            return "ok"
+
+        results = await asyncio.gather(flights.do("key", work), flights.do("key", work), return_exceptions=True)
+        assert [type(result) for result in results] == [ValueError, ValueError]
+        assert await flights.do("key", work) == "ok"
+
+    asyncio.run(scenario())
+
+
+def test_a_cancelled_caller_leaves_the_work_running_for_the_rest():
+    async def scenario():
+        flights, release = SingleFlight(), asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "done"
+
+        first = asyncio.ensure_future(flights.do("key", work))
+        second = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        assert await second == "done"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+import uuid
+from datetime import datetime
+
+from server import from_storage, to_storage
+
+MEDICINE_ID = "0f8fad5b-d9cb-469f-a165-70867728950e"
+ORDER_ID = "7c9e6679-7425-40de-944b-e07fc1f90ae7"
+
+
+def test_document_round_trip():
+    document = {
+        "id": ORDER_ID,
+        "userId": "user-1",
+        "items": [{"medicineId": MEDICINE_ID, "quantity": 2}],
+        "prescriptionIds": [MEDICINE_ID],
+        "expiryDate": "2026-12-31",
+        "distance": "2.5 km",
+        "orderDate": datetime(2026, 1, 1, 9, 30),
+    }
+    stored = to_storage(document)
+    assert stored["id"] == uuid.UUID(ORDER_ID)
+    assert stored["items"][0]["medicineId"] == uuid.UUID(MEDICINE_ID)
+    assert stored["prescriptionIds"] == [uuid.UUID(MEDICINE_ID)]
+    assert stored["expiryDate"] == datetime(2026, 12, 31)
+    assert stored["distance"] == 2.5
+    assert stored["userId"] == "user-1"
+    assert from_storage(stored) == document
+
+
+def test_non_uuid_ids_and_unparseable_values_are_kept():
+    stored = to_storage({"id": "EXT-42", "expiryDate": "soon", "distance": "far"})
+    assert stored == {"id": "EXT-42", "expiryDate": "soon", "distance": "far"}
+    assert to_storage({"distance": "750 m"})["distance"] == 0.75
+
+
+def test_updates_convert_nested_operator_values():
+    update = to_storage({"$set": {"items.0.medicineId": MEDICINE_ID}, "$push": {"prescriptionIds": ORDER_ID}})
+    assert update == {"$set": {"items.0.medicineId": uuid.UUID(MEDICINE_ID)}, "$push": {"prescriptionIds": uuid.UUID(ORDER_ID)}}
+
+
+def test_filters_match_only_the_stored_form_once_migrated():
+    query = {"id": {"$in": [ORDER_ID, MEDICINE_ID]}, "expiryDate": {"$gte": "2026-01-01"}}
+    assert to_storage(query, query=True, legacy=False) == {
+        "id": {"$in": [uuid.UUID(ORDER_ID), uuid.UUID(MEDICINE_ID)]},
+        "expiryDate": {"$gte": datetime(2026, 1, 1)},
+    }
+
+
+def test_legacy_filters_also_match_string_ids():
+    assert to_storage({"id": ORDER_ID}, query=True, legacy=True) == {"id": {"$in": [uuid.UUID(ORDER_ID), ORDER_ID]}}
+    assert to_storage({"id": {"$in": [ORDER_ID, "EXT-42"]}}, query=True, legacy=True) == {
+        "id": {"$in": [uuid.UUID(ORDER_ID), ORDER_ID, "EXT-42"]}
+    }
+    assert to_storage({"id": {"$ne": ORDER_ID}}, query=True, legacy=True) == {"id": {"$nin": [uuid.UUID(ORDER_ID), ORDER_ID]}}
+    assert to_storage({"id": "EXT-42"}, query=True, legacy=True) == {"id": "EXT-42"}
+
+
+def test_legacy_expansion_reaches_nested_filters():
+    query = {"$or": [{"medicineId": MEDICINE_ID}], "items": {"$elemMatch": {"medicineId": {"$eq": MEDICINE_ID}}}}
+    assert to_storage(query, query=True, legacy=True) == {
+        "$or": [{"medicineId": {"$in": [uuid.UUID(MEDICINE_ID), MEDICINE_ID]}}],
+        "items": {"$elemMatch": {"medicineId": {"$in": [uuid.UUID(MEDICINE_ID), MEDICINE_ID]}}},
+    }
+
+
+def test_legacy_upsert_filters_keep_equality_fields_canonical():
+    assert to_storage({"id": ORDER_ID}, query=True, legacy=False) == {"id": uuid.UUID(ORDER_ID)}
@@ -0,0 +1,53 @@
+from server import SuggestionTrie, suggestion_terms
+
+
+def make_trie(limit=10):
+    trie = SuggestionTrie(limit=limit)
+    for ref_id, text, score in [("1", "Paracetamol 500mg", 5), ("2", "Pantoprazole 40mg", 9), ("3", "Ibuprofen 400mg", 1)]:
+        trie.upsert(("medicine", ref_id), text, "medicine", ref_id, suggestion_terms(text), score)
+    return trie
+
+
+def texts(results):
+    return [result["text"] for result in results]
+
+
+def test_suggest_ranks_prefix_matches_by_score():
+    trie = make_trie()
+    assert texts(trie.suggest("pa")) == ["Pantoprazole 40mg", "Paracetamol 500mg"]
+    assert texts(trie.suggest("  PARA ")) == ["Paracetamol 500mg"]
+    assert trie.suggest("xyz") == []
+
+
+def test_suggest_matches_later_words():
+    trie = SuggestionTrie()
+    trie.upsert(("hospital", "h"), "City General Hospital", "hospital", "h", suggestion_terms("City General Hospital"), 1)
+    assert texts(trie.suggest("general")) == ["City General Hospital"]
+    assert texts(trie.suggest("hosp")) == ["City General Hospital"]
+
+
+def test_top_k_is_limited_per_prefix():
+    trie = make_trie(limit=1)
+    assert texts(trie.suggest("p")) == ["Pantoprazole 40mg"]
+
+
+def test_bump_reorders_suggestions():
+    trie = make_trie()
+    trie.bump(("medicine", "1"), 10)
+    assert texts(trie.suggest("pa")) == ["Paracetamol 500mg", "Pantoprazole 40mg"]
+
+
+def test_upsert_keeps_score_and_replaces_terms():
+    trie = make_trie()
+    trie.upsert(("medicine", "1"), "Acetaminophen 500mg", "medicine", "1", suggestion_terms("Acetaminophen 500mg"))
+    assert trie.entries[("medicine", "1")]["score"] == 5
+    assert texts(trie.suggest("para")) == []
+    assert texts(trie.suggest("acet")) == ["Acetaminophen 500mg"]
+
+
+def test_remove_prunes_branches():
+    trie = make_trie()
+    trie.remove(("medicine", "3"))
+    assert trie.suggest("ibu") == []
+    assert "i" not in trie.root.children
+    assert texts(trie.suggest("p")) == ["Pantoprazole 40mg", "Paracetamol 500mg"]